@@ -1,17 +1,29 @@
 """
-TCP client to send an image to the socket_server.
+TCP client to send images to the socket_server.
+Command line front end for ingest_client.IngestClient: files and whole
+directories are sent concurrently over a small pool of framed-protocol
+connections, with retries. Large files are sent as resumable uploads and
+compressible ones (uncompressed DICOM, BMP) are compressed on the wire.
+--legacy sends a single file with the original one-image-per-connection protocol.
 """
+import argparse
+import asyncio
 import socket
 import os
 import sys
 
+from ingest_client import (
+    DEFAULT_HOST, DEFAULT_PORT, DEFAULT_WINDOW, RESUMABLE_THRESHOLD, COMPRESSION_CHOICES, IngestClient, iter_files,
+)
+from routes.ingest_protocol import encode_extension
+
 # --- Configuration ---
-HOST = '127.0.0.1'
-PORT = 8001
+HOST = DEFAULT_HOST
+PORT = DEFAULT_PORT
 
 def send_image(exam_id: str, file_path: str):
     """
-    Connects to the TCP server and sends the image with its metadata.
+    Connects to the TCP server and sends the image with its metadata (legacy protocol).
     """
     # 1. Validate inputs
     if not os.path.exists(file_path):
@@ -32,26 +44,17 @@ def send_image(exam_id: str, file_path: str):
 
             # b. File extension (padded to 10 bytes)
             file_ext = os.path.splitext(file_path)[1]
-            file_ext_bytes = file_ext.ljust(10).encode('utf-8')
 
-            # c. Image data and its size
             with open(file_path, 'rb') as f:
-                image_bytes = f.read()
-            image_size_bytes = len(image_bytes).to_bytes(8, 'big')
-
-            # 4. Send all data in order
-            print(f"Sending Exam ID: {exam_id}")
-            s.sendall(exam_id_bytes)
-            
-            print(f"Sending File Extension: {file_ext}")
-            s.sendall(file_ext_bytes)
-
-            print(f"Sending Image Size: {len(image_bytes)} bytes")
-            s.sendall(image_size_bytes)
-            
-            print("Sending Image Data...")
-            s.sendall(image_bytes)
-            
+                # c. Image size; the body is streamed from disk
+                image_size = os.fstat(f.fileno()).st_size
+
+                # 4. Send all data in order
+                print(f"Sending Exam ID: {exam_id}, File Extension: {file_ext}, Image Size: {image_size} bytes")
+                s.sendall(exam_id_bytes + encode_extension(file_ext) + image_size.to_bytes(8, 'big'))
+                print("Sending Image Data...")
+                s.sendfile(f)
+
             print("Data sent successfully.")
 
             # 5. Wait for a response
@@ -63,17 +66,77 @@ def send_image(exam_id: str, file_path: str):
     except Exception as e:
         print(f"An error occurred: {e}")
 
+def send_images(uploads, connections: int = 4, retries: int = 5):
+    """
+    Sends many images using the framed protocol.
+    `uploads` is a list of (exam_id, file_path) tuples; returns a dict of file_path -> status name.
+    """
+    async def run():
+        async with IngestClient(HOST, PORT, connections=connections, retries=retries) as client:
+            return await client.send_files(uploads)
+
+    return {result.file_path: result.status for result in asyncio.run(run())}
+
+def expand_paths(paths, recursive: bool):
+    """Files named on the command line, with directories replaced by the files inside them."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(iter_files(path, recursive))
+        else:
+            files.append(path)
+    return files
+
+async def run_cli(args) -> int:
+    uploads = [(args.exam_id, path) for path in expand_paths(args.paths, not args.no_recursive)]
+    print(f"Sending {len(uploads)} file(s) to {args.host}:{args.port} over up to {args.connections} connection(s)")
+
+    async with IngestClient(args.host, args.port, connections=args.connections, window=args.window,
+                            retries=args.retries, resumable_threshold=args.resumable_threshold,
+                            compression=args.compression) as client:
+        results = await client.send_files(uploads, args.concurrency)
+
+    for result in results:
+        attempts = f" ({result.attempts} attempts)" if result.attempts > 1 else ""
+        print(f"{result.status:10s} {result.file_path}{attempts}")
+    failed = [result for result in results if not result.ok]
+    print(f"{len(results) - len(failed)} sent, {len(failed)} failed")
+    return 1 if failed else 0
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Send exam images to the EZRAD TCP ingest server.")
+    parser.add_argument("exam_id", help="Exam UUID the images belong to")
+    parser.add_argument("paths", nargs="+", help="Image files and/or directories of images")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--connections", type=int, default=4, help="Connections in the pool")
+    parser.add_argument("--window", type=int, default=DEFAULT_WINDOW, help="Unacknowledged images per connection")
+    parser.add_argument("--concurrency", type=int, default=None,
+                        help="Files open at once (default: connections x window)")
+    parser.add_argument("--retries", type=int, default=5)
+    parser.add_argument("--resumable-threshold", type=int, default=RESUMABLE_THRESHOLD,
+                        help="Send files of at least this many bytes as resumable uploads")
+    parser.add_argument("--compression", choices=list(COMPRESSION_CHOICES), default="auto",
+                        help="Codec for compressible files (auto: zstd if both sides have it, else deflate)")
+    parser.add_argument("--no-recursive", action="store_true", help="Don't descend into subdirectories")
+    parser.add_argument("--legacy", action="store_true", help="Send one file with the legacy protocol")
+    return parser.parse_args(argv)
+
 if __name__ == '__main__':
     # --- How to run this script ---
-    # python tcp_client.py <your_exam_id> <path_to_your_image>
+    # python TCPClient.py <your_exam_id> <path_to_your_image>
     # python -u "c:\Users\luisg\Downloads\TCPClient.py" "58c19e87-6b60-4c1a-beb9-d60ed3861b4b" "C:\Users\luisg\Downloads\Screenshot 2025-08-04 152403.png"
-    # Example: python tcp_client.py 58c19e87-6b60-4c1a-beb9-d60ed3861b4b /path/to/image.png
-
-    if len(sys.argv) != 3:
-        print("Usage: python tcp_client.py <exam_id> <file_path>")
-        sys.exit(1)
-        
-    exam_id_arg = sys.argv[1]
-    file_path_arg = sys.argv[2]
-    
-    send_image(exam_id_arg, file_path_arg)
+    # Example: python TCPClient.py 58c19e87-6b60-4c1a-beb9-d60ed3861b4b /path/to/image.png
+
+    # Several images, or whole directories, for the same exam:
+    # python TCPClient.py <your_exam_id> <image_1> <image_2> <directory> ... --connections 8
+
+    args = parse_args(sys.argv[1:])
+    if args.legacy:
+        if len(args.paths) != 1:
+            print("--legacy sends exactly one file")
+            sys.exit(1)
+        HOST, PORT = args.host, args.port
+        send_image(args.exam_id, args.paths[0])
+    else:
+        sys.exit(asyncio.run(run_cli(args)))
@@ -0,0 +1,80 @@
+"""
+Compare two benchmark result files produced by run_benchmarks.py
+
+    python -m benchmarks.compare benchmarks/results/<baseline>.json benchmarks/results/<candidate>.json
+    python -m benchmarks.compare old.json new.json --fail-above 10
+
+Exits with status 1 when --fail-above is given and any scenario's p50 or p99
+latency regressed by more than that percentage, and whenever a scenario's error
+rate differs between the runs by more than --max-error-change percentage points
+(latencies only cover successful requests, so such runs aren't comparable).
+"""
+
+import argparse
+import json
+import sys
+
+
+def load(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def change(old: float, new: float) -> float:
+    if not old:
+        return 0.0
+    return (new - old) / old * 100.0
+
+
+def error_rate(result: dict) -> float:
+    """Failed requests as a percentage of all requests in the scenario."""
+    total = result.get("count", 0) + result.get("errors", 0)
+    return result.get("errors", 0) / total * 100.0 if total else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two EZRAD benchmark runs")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--fail-above", type=float, default=None, help="Latency regression threshold in percent")
+    parser.add_argument("--max-error-change", type=float, default=0.0,
+                        help="Allowed difference in error rate between the runs, in percentage points")
+    args = parser.parse_args()
+
+    baseline, candidate = load(args.baseline), load(args.candidate)
+    print(f"baseline:  {baseline['meta'].get('commit')} {baseline['meta'].get('timestamp')} {baseline['meta'].get('label', '')}")
+    print(f"candidate: {candidate['meta'].get('commit')} {candidate['meta'].get('timestamp')} {candidate['meta'].get('label', '')}")
+    print()
+    print(f"{'scenario':36s} {'p50 ms':>18s} {'p99 ms':>18s} {'req/s':>18s} {'errors':>16s}")
+
+    regressions = []
+    error_changes = []
+    for name, new in candidate["results"].items():
+        old = baseline["results"].get(name)
+        if old is None:
+            print(f"{name:36s} (new scenario)")
+            continue
+        p50 = change(old["p50_ms"], new["p50_ms"])
+        p99 = change(old["p99_ms"], new["p99_ms"])
+        rps = change(old["throughput_rps"], new["throughput_rps"])
+        old_errors, new_errors = error_rate(old), error_rate(new)
+        flag = " !" if abs(new_errors - old_errors) > args.max_error_change else ""
+        print(f"{name:36s} {new['p50_ms']:9.2f} {p50:+7.1f}% {new['p99_ms']:9.2f} {p99:+7.1f}% "
+              f"{new['throughput_rps']:9.1f} {rps:+7.1f}% {old_errors:6.1f}%->{new_errors:5.1f}%{flag}")
+        if flag:
+            error_changes.append(name)
+        if args.fail_above is not None and max(p50, p99) > args.fail_above:
+            regressions.append(name)
+
+    if error_changes:
+        print()
+        print(f"Error rates differ (latencies not comparable): {', '.join(error_changes)}")
+    if regressions:
+        print()
+        print(f"Regressions above {args.fail_above}%: {', '.join(regressions)}")
+    if regressions or error_changes:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,452 @@
+"""
+Local stand-in for Supabase used by the benchmark harness
+Implements the subset of PostgREST (/rest/v1) and Storage (/storage/v1) that the
+EZRAD backend uses, over in-memory tables seeded with deterministic data.
+By default the database looks migrated: patients have the generated search
+columns of migrations/003 and the exam_statistics() and search_patients_ranked()
+functions answer RPCs. --unmigrated drops both, so the API's fallbacks run.
+
+Run standalone:
+    python -m benchmarks.fake_supabase --port 54321 --patients 2000 --exams 5000
+"""
+
+import argparse
+import asyncio
+import random
+import re
+import uuid
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+
+SEED_NAMESPACE = uuid.UUID("6f1c1f6e-7d8a-4c8e-9a55-2d0f3f3c1b10")
+
+FIRST_NAMES = ["John", "Maria", "James", "Ana", "Luis", "Emily", "David", "Sofia", "Michael", "Laura",
+               "Carlos", "Grace", "Daniel", "Elena", "Robert", "Isabel", "Thomas", "Lucia", "Kevin", "Nora"]
+LAST_NAMES = ["Smith", "Garcia", "Johnson", "Martinez", "Brown", "Lopez", "Davis", "Gonzalez", "Miller", "Wilson",
+              "Anderson", "Thomas", "Taylor", "Moore", "Jackson", "Martin", "Lee", "Perez", "Thompson", "White"]
+EXAM_TYPES = ["X-Ray", "CT", "MRI", "Ultrasound", "Mammography"]
+BODY_PARTS = ["Chest", "Abdomen", "Head", "Knee", "Spine", "Hand", "Pelvis"]
+STATUSES = ["pending", "in_progress", "completed", "cancelled"]
+
+
+def seeded_id(kind: str, n: int) -> str:
+    """Deterministic UUIDs so benchmark runs hit the same rows."""
+    return str(uuid.uuid5(SEED_NAMESPACE, f"{kind}-{n}"))
+
+
+class FakeDatabase:
+    def __init__(self, migrated: bool = True):
+        self.tables: Dict[str, List[Dict[str, Any]]] = {
+            "patients": [], "exams": [], "technicians": [], "exam_images": [], "users": [], "test_tables": [],
+        }
+        self.objects: Dict[str, int] = {}
+        self.migrated = migrated
+        self.missing_columns = {} if migrated else MISSING_COLUMNS
+
+    def generate_columns(self, table: str, row: Dict[str, Any]):
+        """Fill the generated columns of migrations/003 (search_name, phone_digits) in place."""
+        if table != "patients" or not self.migrated:
+            return
+        name = f"{row.get('first_name') or ''} {row.get('last_name') or ''}"
+        row["search_name"] = name.strip().lower()
+        row["phone_digits"] = re.sub(r"\D", "", row.get("phone") or "")
+
+    def seed(self, patients: int, exams: int, images_per_exam: int, techs: int = 20):
+        rng = random.Random(42)
+        base = datetime(2024, 1, 1)
+        today = date.today()
+
+        for n in range(techs):
+            self.tables["technicians"].append({
+                "id": seeded_id("tech", n),
+                "full_name": f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+                "office_name": f"Room {n % 6 + 1}",
+                "phone": f"915555{n:04d}",
+                "created_at": (base + timedelta(days=n)).isoformat(),
+            })
+
+        for n in range(patients):
+            self.tables["patients"].append({
+                "id": seeded_id("patient", n),
+                "first_name": rng.choice(FIRST_NAMES),
+                "last_name": rng.choice(LAST_NAMES),
+                "date_of_birth": (date(1940, 1, 1) + timedelta(days=rng.randint(0, 30000))).isoformat(),
+                "gender": rng.choice(["Male", "Female"]),
+                "phone": f"({rng.randint(200, 999)}) {rng.randint(200, 999)}-{rng.randint(0, 9999):04d}",
+                "email": f"patient{n}@example.com",
+                "city": "El Paso",
+                "state": "TX",
+                "insurance_provider": rng.choice(["Aetna", "Cigna", "BCBS", None]),
+                "created_at": (base + timedelta(minutes=7 * n)).isoformat(),
+            })
+            self.generate_columns("patients", self.tables["patients"][-1])
+
+        for n in range(exams):
+            # Roughly 2% of exams land on today so /exams/today has a realistic worklist
+            exam_day = today if n % 50 == 0 else today - timedelta(days=rng.randint(1, 720))
+            exam_time = f"{rng.randint(7, 18):02d}:{rng.choice([0, 15, 30, 45]):02d}:00"
+            self.tables["exams"].append({
+                "id": seeded_id("exam", n),
+                "patient_id": seeded_id("patient", rng.randrange(max(patients, 1))),
+                "technician_id": seeded_id("tech", rng.randrange(techs)),
+                "exam_type": rng.choice(EXAM_TYPES),
+                "body_part": rng.choice(BODY_PARTS),
+                "exam_date": exam_day.isoformat(),
+                "exam_time": exam_time,
+                "scheduled_time": f"{exam_day.isoformat()}T{exam_time}",
+                "room": f"Room {rng.randint(1, 6)}",
+                "status": rng.choice(STATUSES),
+                "priority": rng.choice(["routine", "routine", "urgent", "stat"]),
+                "created_by": seeded_id("tech", 0),
+                "created_at": (base + timedelta(minutes=3 * n)).isoformat(),
+                "contrast": False, "pregnancy": False, "implants": False,
+            })
+
+        for n in range(min(exams, 200)):
+            exam_id = seeded_id("exam", n)
+            for i in range(images_per_exam):
+                path = f"{exam_id}/{seeded_id('image', n * 1000 + i)}.jpg"
+                self.objects[path] = 0
+                self.tables["exam_images"].append({
+                    "id": seeded_id("exam_image", n * 1000 + i),
+                    "exam_id": exam_id,
+                    "image_path": path,
+                    "description": "",
+                    "created_at": (base + timedelta(minutes=n)).isoformat(),
+                })
+
+
+# --- PostgREST filter evaluation ---------------------------------------------
+def split_top_level(text: str) -> List[str]:
+    """Split on commas that are not inside parentheses or double quotes."""
+    parts, depth, quoted, current = [], 0, False, ""
+    for ch in text:
+        if ch == '"':
+            quoted = not quoted
+        elif not quoted and ch == "(":
+            depth += 1
+        elif not quoted and ch == ")":
+            depth -= 1
+        if ch == "," and depth == 0 and not quoted:
+            parts.append(current)
+            current = ""
+        else:
+            current += ch
+    if current:
+        parts.append(current)
+    return parts
+
+
+def as_text(value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+def like_to_regex(pattern: str) -> "re.Pattern":
+    escaped = re.escape(pattern).replace("%", ".*").replace(r"\*", ".*")
+    return re.compile(f"^{escaped}$", re.DOTALL)
+
+
+def compare(row_value: Any, op: str, raw: str) -> bool:
+    negate = False
+    if op.startswith("not."):
+        negate, op = True, op[4:]
+    value = raw[1:-1] if len(raw) >= 2 and raw[0] == raw[-1] == '"' else raw
+    text = as_text(row_value)
+
+    if op == "is":
+        result = (row_value is None) if value == "null" else text == value
+    elif op == "in":
+        options = [v.strip().strip('"') for v in value.strip("()").split(",")]
+        result = text in options
+    elif text is None:
+        result = False
+    elif op == "eq":
+        result = text == value
+    elif op == "neq":
+        result = text != value
+    elif op in ("gt", "gte", "lt", "lte"):
+        left, right = text, value
+        try:
+            left, right = float(text), float(value)
+        except ValueError:
+            pass
+        result = {"gt": left > right, "gte": left >= right, "lt": left < right, "lte": left <= right}[op]
+    elif op == "like":
+        result = bool(like_to_regex(value).match(text))
+    elif op == "ilike":
+        result = bool(like_to_regex(value.lower()).match(text.lower()))
+    else:
+        raise ValueError(f"Unsupported operator {op}")
+    return not result if negate else result
+
+
+def parse_condition(expr: str):
+    """'col.op.value' or nested 'and(...)' / 'or(...)' from an or= parameter."""
+    for group in ("and", "or"):
+        if expr.startswith(f"{group}(") and expr.endswith(")"):
+            children = [parse_condition(part) for part in split_top_level(expr[len(group) + 1:-1])]
+            return (group, children)
+    column, rest = expr.split(".", 1)
+    if rest.startswith("not."):
+        op_name, value = rest[4:].split(".", 1)
+        return ("cmp", column, f"not.{op_name}", value)
+    op_name, value = rest.split(".", 1)
+    return ("cmp", column, op_name, value)
+
+
+def evaluate(condition, row: Dict[str, Any]) -> bool:
+    kind = condition[0]
+    if kind == "and":
+        return all(evaluate(child, row) for child in condition[1])
+    if kind == "or":
+        return any(evaluate(child, row) for child in condition[1])
+    _, column, op, value = condition
+    return compare(row.get(column), op, value)
+
+
+RESERVED_PARAMS = {"select", "order", "limit", "offset", "on_conflict", "columns"}
+
+# Columns added by migrations, absent from an --unmigrated database; PostgREST answers 42703 for them
+MISSING_COLUMNS = {"patients": {"search_name", "phone_digits"}}
+
+
+def missing_column(missing: Optional[set], params) -> Optional[str]:
+    """First column named in the select list or a filter that is in `missing` (the table's absent columns)."""
+    if not missing:
+        return None
+    names = set(re.findall(r"[A-Za-z_]\w*", params.get("select") or ""))
+    names.update(key for key in params.keys() if key not in RESERVED_PARAMS)
+    names.update(re.findall(r"([A-Za-z_]\w*)\.(?:not\.)?[a-z]+\.", params.get("or") or ""))
+    return next((name for name in sorted(names) if name in missing), None)
+
+
+def build_filters(params) -> List:
+    conditions = []
+    for key, raw in params.multi_items():
+        if key in RESERVED_PARAMS:
+            continue
+        if key in ("or", "and"):
+            conditions.append(parse_condition(f"{key}{raw}"))
+        else:
+            negate = raw.startswith("not.")
+            op, value = (raw[4:] if negate else raw).split(".", 1)
+            conditions.append(("cmp", key, f"not.{op}" if negate else op, value))
+    return conditions
+
+
+def apply_order(rows: List[Dict[str, Any]], order: Optional[str]) -> List[Dict[str, Any]]:
+    if not order:
+        return rows
+    for part in reversed(order.split(",")):
+        pieces = part.split(".")
+        column = pieces[0]
+        desc = "desc" in pieces[1:]
+        rows = sorted(rows, key=lambda r: (r.get(column) is None, as_text(r.get(column)) or ""), reverse=desc)
+    return rows
+
+
+def project(row: Dict[str, Any], select: Optional[str], db: FakeDatabase) -> Dict[str, Any]:
+    if not select or select.strip() == "*":
+        return dict(row)
+    result: Dict[str, Any] = {}
+    for column in split_top_level(select):
+        column = column.strip()
+        if column == "*":
+            result.update(row)
+            continue
+        match = re.match(r"^(?:(\w+):)?(\w+)(?:!\w+)?\((.*)\)$", column)
+        if match:
+            # Embedded resource (many-to-one through <table>_id / technician_id)
+            alias, table, inner = match.group(1) or match.group(2), match.group(2), match.group(3)
+            foreign_key = {"patients": "patient_id", "technicians": "technician_id", "exams": "exam_id"}.get(table)
+            target = next((r for r in db.tables.get(table, []) if foreign_key and r.get("id") == row.get(foreign_key)), None)
+            result[alias] = project(target, inner, db) if target else None
+            continue
+        alias, _, name = column.rpartition(":")
+        result[alias or name] = row.get(name)
+    return result
+
+
+# --- Database functions (migrations/001 and 003) -------------------------------
+def exam_statistics(db: FakeDatabase, day_start: str, day_end: str, week_start: str, month_start: str):
+    exams = db.tables["exams"]
+
+    def scheduled(row) -> str:
+        return row.get("scheduled_time") or ""
+
+    return [{
+        "total_exams": len(exams),
+        "pending_exams": sum(1 for r in exams if r.get("status") == "pending"),
+        "in_progress_exams": sum(1 for r in exams if r.get("status") == "in_progress"),
+        "completed_exams": sum(1 for r in exams if r.get("status") == "completed"),
+        "cancelled_exams": sum(1 for r in exams if r.get("status") == "cancelled"),
+        "today_exams": sum(1 for r in exams if day_start <= scheduled(r) < day_end),
+        "week_exams": sum(1 for r in exams if scheduled(r) >= week_start),
+        "month_exams": sum(1 for r in exams if scheduled(r) >= month_start),
+    }]
+
+
+def search_patients_ranked(db: FakeDatabase, q: str, max_results: int = 20):
+    """Same matching and order as the SQL function, with substring matching standing in for trigrams."""
+    term = re.sub(r"\s+", " ", q.strip()).lower()
+    digits = re.sub(r"\D", "", q)
+    if not term:
+        return []
+    ranked = []
+    for row in db.tables["patients"]:
+        name, last_name = row.get("search_name") or "", (row.get("last_name") or "").lower()
+        phone = row.get("phone_digits") or ""
+        prefix = name.startswith(term) or last_name.startswith(term)
+        phone_match = len(digits) >= 3 and digits in phone
+        if prefix or term in name or phone_match:
+            rank = (not prefix, not (phone_match and phone.startswith(digits)), last_name, name)
+            ranked.append((rank, row))
+    ranked.sort(key=lambda item: item[0])
+    return [row for _, row in ranked[:max_results]]
+
+
+RPC_FUNCTIONS = {"exam_statistics": exam_statistics, "search_patients_ranked": search_patients_ranked}
+
+
+def create_app(db: FakeDatabase, latency_ms: float = 0.0) -> FastAPI:
+    app = FastAPI(title="Fake Supabase")
+
+    async def simulate_latency():
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000.0)
+
+    def content_range(offset: int, returned: int, total: Optional[int]) -> str:
+        end = offset + returned - 1 if returned else offset
+        return f"{offset}-{end}/{total if total is not None else '*'}"
+
+    @app.post("/rest/v1/rpc/{fn}")
+    async def rpc(fn: str, request: Request):
+        await simulate_latency()
+        function = RPC_FUNCTIONS.get(fn) if db.migrated else None
+        if function is None:
+            return JSONResponse(status_code=404, content={
+                "code": "PGRST202", "details": None, "hint": None,
+                "message": f"Could not find the function public.{fn} in the schema cache",
+            })
+        return JSONResponse(content=function(db, **await request.json()))
+
+    @app.get("/rest/v1/{table}")
+    @app.head("/rest/v1/{table}")
+    async def select_rows(table: str, request: Request):
+        await simulate_latency()
+        params = request.query_params
+        column = missing_column(db.missing_columns.get(table), params)
+        if column is not None:
+            return JSONResponse(status_code=400, content={
+                "code": "42703", "details": None, "hint": None,
+                "message": f"column {table}.{column} does not exist",
+            })
+        rows = db.tables.setdefault(table, [])
+        conditions = build_filters(params)
+        matched = [r for r in rows if all(evaluate(c, r) for c in conditions)]
+        matched = apply_order(matched, params.get("order"))
+        total = len(matched)
+        offset = int(params.get("offset", 0))
+        limit = params.get("limit")
+        page = matched[offset: offset + int(limit)] if limit is not None else matched[offset:]
+        body = [project(r, params.get("select"), db) for r in page]
+        headers = {}
+        if "count=" in request.headers.get("prefer", ""):
+            headers["Content-Range"] = content_range(offset, len(body), total)
+        if request.method == "HEAD":
+            return Response(headers=headers)
+        return JSONResponse(content=body, headers=headers)
+
+    @app.post("/rest/v1/{table}")
+    async def insert_rows(table: str, request: Request):
+        await simulate_latency()
+        payload = await request.json()
+        records = payload if isinstance(payload, list) else [payload]
+        inserted = []
+        for record in records:
+            row = {"id": str(uuid.uuid4()), "created_at": datetime.utcnow().isoformat(), **record}
+            db.generate_columns(table, row)
+            db.tables.setdefault(table, []).append(row)
+            inserted.append(row)
+        select = request.query_params.get("select")
+        return JSONResponse(status_code=201, content=[project(r, select, db) for r in inserted])
+
+    @app.patch("/rest/v1/{table}")
+    async def update_rows(table: str, request: Request):
+        await simulate_latency()
+        changes = await request.json()
+        conditions = build_filters(request.query_params)
+        updated = []
+        for row in db.tables.setdefault(table, []):
+            if all(evaluate(c, row) for c in conditions):
+                row.update(changes)
+                db.generate_columns(table, row)
+                updated.append(dict(row))
+        return JSONResponse(content=updated)
+
+    @app.delete("/rest/v1/{table}")
+    async def delete_rows(table: str, request: Request):
+        await simulate_latency()
+        conditions = build_filters(request.query_params)
+        rows = db.tables.setdefault(table, [])
+        removed = [r for r in rows if all(evaluate(c, r) for c in conditions)]
+        db.tables[table] = [r for r in rows if r not in removed]
+        return JSONResponse(content=removed)
+
+    @app.post("/storage/v1/object/sign/{bucket}")
+    async def sign_urls(bucket: str, request: Request):
+        await simulate_latency()
+        payload = await request.json()
+        # Like Supabase: one entry per path, with an error instead of a URL for missing objects
+        return [
+            {"path": path, "signedURL": f"/object/sign/{bucket}/{path}?token=bench", "error": None}
+            if path in db.objects else
+            {"path": path, "signedURL": None, "error": "Either the object does not exist or you do not have access to it"}
+            for path in payload.get("paths", [])
+        ]
+
+    @app.post("/storage/v1/object/{bucket}/{path:path}")
+    @app.put("/storage/v1/object/{bucket}/{path:path}")
+    async def upload_object(bucket: str, path: str, request: Request):
+        size = 0
+        async for chunk in request.stream():
+            size += len(chunk)
+        await simulate_latency()
+        db.objects[path] = size
+        return {"Key": f"{bucket}/{path}", "Id": str(uuid.uuid4())}
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok", "tables": {name: len(rows) for name, rows in db.tables.items()}}
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Supabase server for EZRAD benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=54321)
+    parser.add_argument("--patients", type=int, default=2000)
+    parser.add_argument("--exams", type=int, default=5000)
+    parser.add_argument("--images-per-exam", type=int, default=30)
+    parser.add_argument("--latency-ms", type=float, default=2.0, help="Simulated round-trip time per request")
+    parser.add_argument("--unmigrated", action="store_true",
+                        help="Leave out the migrations' columns and functions (exercises the API's fallbacks)")
+    args = parser.parse_args()
+
+    import uvicorn
+
+    db = FakeDatabase(migrated=not args.unmigrated)
+    db.seed(args.patients, args.exams, args.images_per_exam)
+    uvicorn.run(create_app(db, args.latency_ms), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
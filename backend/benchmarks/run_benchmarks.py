@@ -0,0 +1,287 @@
+"""
+Benchmark harness for the EZRAD HTTP API and TCP ingest server
+Starts the fake Supabase stand-in, the FastAPI app from main.py (which also starts
+the TCP server from socket_server.start_server), drives the hot paths and writes
+p50/p99 latency and throughput to benchmarks/results/<timestamp>.json.
+
+Run from the backend directory:
+    python -m benchmarks.run_benchmarks
+    python -m benchmarks.run_benchmarks --requests 500 --concurrency 32 --tcp-sizes 65536,1048576
+    python -m benchmarks.compare benchmarks/results/<old>.json benchmarks/results/<new>.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List
+
+import httpx
+
+from routes.ingest_protocol import (
+    HANDSHAKE, ACK_FORMAT, ACK_OK, FRAME_IMAGE, FRAME_BYE,
+    encode_handshake, decode_handshake, encode_frame_header, decode_ack,
+)
+from benchmarks.fake_supabase import seeded_id
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(BACKEND_DIR, "benchmarks", "results")
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(latencies: List[float], errors: int, elapsed: float, payload_bytes: int = 0) -> Dict[str, float]:
+    ms = [latency * 1000.0 for latency in latencies]
+    summary = {
+        "count": len(latencies),
+        "errors": errors,
+        "p50_ms": round(percentile(ms, 50), 3),
+        "p99_ms": round(percentile(ms, 99), 3),
+        "mean_ms": round(statistics.fmean(ms), 3) if ms else 0.0,
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+    }
+    if payload_bytes:
+        summary["throughput_mb_s"] = round(payload_bytes * len(latencies) / elapsed / (1024 * 1024), 2) if elapsed else 0.0
+    return summary
+
+
+async def run_load(operation: Callable[[], Awaitable[bool]], total: int, concurrency: int, payload_bytes: int = 0):
+    """Run `operation` `total` times with at most `concurrency` in flight."""
+    latencies: List[float] = []
+    errors = 0
+    remaining = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            started = time.perf_counter()
+            try:
+                ok = await operation()
+            except Exception:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - started, payload_bytes)
+
+
+# --- HTTP scenarios ----------------------------------------------------------
+def http_scenarios(exam_with_images: str) -> Dict[str, str]:
+    return {
+        "GET /exams/today": "/api/v1/exams/today",
+        "GET /patients/search": "/api/v1/patients/search?full_name=mar&limit=25",
+        "GET /exams/statistics": "/api/v1/exams/statistics",
+        "GET /images/exams/{id}/images": f"/api/v1/images/exams/{exam_with_images}/images",
+    }
+
+
+async def bench_http(base_url: str, requests: int, concurrency: int, warmup: int) -> Dict[str, Dict]:
+    results = {}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        for name, path in http_scenarios(seeded_id("exam", 0)).items():
+            async def call(path=path):
+                response = await client.get(path)
+                return response.status_code == 200
+
+            await run_load(call, warmup, min(concurrency, warmup or 1))
+            results[name] = await run_load(call, requests, concurrency)
+            print(f"{name:36s} p50={results[name]['p50_ms']:8.2f}ms p99={results[name]['p99_ms']:8.2f}ms "
+                  f"{results[name]['throughput_rps']:8.1f} req/s errors={results[name]['errors']}")
+    return results
+
+
+# --- TCP scenarios -----------------------------------------------------------
+async def tcp_upload_legacy(host: str, port: int, exam_id: str, payload: bytes) -> bool:
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(exam_id.encode("utf-8") + b".jpg".ljust(10) + len(payload).to_bytes(8, "big"))
+        writer.write(payload)
+        await writer.drain()
+        return (await reader.read(16)) == b"SUCCESS"
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+async def bench_tcp_framed(host: str, port: int, exam_id: str, payload: bytes, total: int, window: int):
+    """Pipeline `total` frames over one connection, measuring send -> ack latency per frame."""
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(encode_handshake())
+    await writer.drain()
+    decode_handshake(await reader.readexactly(HANDSHAKE.size))
+
+    sent_at: Dict[int, float] = {}
+    latencies: List[float] = []
+    errors = 0
+    credits = asyncio.Semaphore(window)
+
+    async def receive_acks():
+        nonlocal errors
+        for _ in range(total):
+            seq, status = decode_ack(await reader.readexactly(ACK_FORMAT.size))
+            if status == ACK_OK:
+                latencies.append(time.perf_counter() - sent_at.pop(seq))
+            else:
+                errors += 1
+            credits.release()
+
+    started = time.perf_counter()
+    ack_task = asyncio.create_task(receive_acks())
+    for seq in range(1, total + 1):
+        await credits.acquire()
+        sent_at[seq] = time.perf_counter()
+        writer.write(encode_frame_header(FRAME_IMAGE, seq, exam_id, ".jpg", len(payload)))
+        writer.write(payload)
+        await writer.drain()
+    await ack_task
+    elapsed = time.perf_counter() - started
+    writer.write(encode_frame_header(FRAME_BYE, 0))
+    await writer.drain()
+    writer.close()
+    await writer.wait_closed()
+    return summarize(latencies, errors, elapsed, len(payload))
+
+
+async def bench_tcp(host: str, port: int, sizes: List[int], uploads: int, concurrency: int) -> Dict[str, Dict]:
+    results = {}
+    exam_id = seeded_id("exam", 1)
+    for size in sizes:
+        payload = os.urandom(size)
+
+        async def legacy():
+            return await tcp_upload_legacy(host, port, exam_id, payload)
+
+        name = f"TCP legacy {size // 1024}KiB"
+        results[name] = await run_load(legacy, uploads, concurrency, size)
+        print(f"{name:36s} p50={results[name]['p50_ms']:8.2f}ms p99={results[name]['p99_ms']:8.2f}ms "
+              f"{results[name]['throughput_mb_s']:8.1f} MB/s errors={results[name]['errors']}")
+
+        name = f"TCP framed {size // 1024}KiB"
+        results[name] = await bench_tcp_framed(host, port, exam_id, payload, uploads, concurrency)
+        print(f"{name:36s} p50={results[name]['p50_ms']:8.2f}ms p99={results[name]['p99_ms']:8.2f}ms "
+              f"{results[name]['throughput_mb_s']:8.1f} MB/s errors={results[name]['errors']}")
+    return results
+
+
+# --- Process management ------------------------------------------------------
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_http(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Timed out waiting for {url}")
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EZRAD HTTP and TCP ingest benchmarks")
+    parser.add_argument("--requests", type=int, default=300, help="Requests per HTTP scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--tcp-uploads", type=int, default=50, help="Uploads per TCP payload size")
+    parser.add_argument("--tcp-sizes", default="65536,1048576,16777216", help="Comma separated payload sizes in bytes")
+    parser.add_argument("--patients", type=int, default=2000)
+    parser.add_argument("--exams", type=int, default=5000)
+    parser.add_argument("--latency-ms", type=float, default=2.0, help="Simulated Supabase round-trip time")
+    parser.add_argument("--skip-tcp", action="store_true")
+    parser.add_argument("--unmigrated", action="store_true",
+                        help="Fake a database without the migrations (measures the API's fallback paths)")
+    parser.add_argument("--label", default="", help="Free-form label stored with the results")
+    parser.add_argument("--verbose", action="store_true", help="Show server logs")
+    parser.add_argument("--output", help="Result file (defaults to benchmarks/results/<timestamp>.json)")
+    args = parser.parse_args()
+
+    fake_port, api_port, tcp_port = free_port(), free_port(), free_port()
+    env = {
+        **os.environ,
+        "SUPABASE_URL": f"http://127.0.0.1:{fake_port}",
+        "SUPABASE_KEY": "benchmark-key",
+        "TCP_HOST": "127.0.0.1",
+        "TCP_PORT": str(tcp_port),
+        "PYTHONUNBUFFERED": "1",
+    }
+
+    server_output = None if args.verbose else subprocess.DEVNULL
+    processes = []
+    try:
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.fake_supabase", "--port", str(fake_port),
+             "--patients", str(args.patients), "--exams", str(args.exams), "--latency-ms", str(args.latency_ms),
+             *(["--unmigrated"] if args.unmigrated else [])],
+            cwd=BACKEND_DIR, env=env, stdout=server_output, stderr=server_output,
+        ))
+        wait_for_http(f"http://127.0.0.1:{fake_port}/health")
+
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(api_port),
+             "--log-level", "warning", "--no-access-log"],
+            cwd=BACKEND_DIR, env=env, stdout=server_output, stderr=server_output,
+        ))
+        wait_for_http(f"http://127.0.0.1:{api_port}/health")
+
+        results = asyncio.run(bench_http(f"http://127.0.0.1:{api_port}", args.requests, args.concurrency, args.warmup))
+        if not args.skip_tcp:
+            sizes = [int(size) for size in args.tcp_sizes.split(",") if size]
+            results.update(asyncio.run(bench_tcp("127.0.0.1", tcp_port, sizes, args.tcp_uploads, min(args.concurrency, 8))))
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "label": args.label,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": vars(args),
+        },
+        "results": results,
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
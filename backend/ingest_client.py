@@ -0,0 +1,415 @@
+"""
+Asynchronous client library for the EZRAD TCP ingest server
+IngestClient keeps a small pool of framed-protocol connections and pipelines
+frames on each of them, so many files are in flight at once without one
+connection per file. File bodies go from disk to the socket with sendfile
+(chunked reads where sendfile is unavailable), never whole into memory. Files
+of at least `resumable_threshold` bytes are sent as resumable uploads, so a
+dropped connection only costs the bytes that had not arrived yet. Where the
+server accepts it, compressible files (uncompressed DICOM, BMP, ...) are sent
+zstd- or deflate-compressed.
+
+Failed sends are retried with exponential backoff. Re-sending is always safe:
+the server stores images content-addressed and ignores copies it already has.
+
+    async with IngestClient("127.0.0.1", 8001) as client:
+        results = await client.send_directory(exam_id, "/data/study-42")
+
+TCPClient.py is the command line front end.
+"""
+
+import asyncio
+import os
+import random
+import tempfile
+import uuid
+import zlib
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from routes.ingest_protocol import (
+    HANDSHAKE, ACK_FORMAT, OFFSET_FORMAT, ACK_STATUS_NAMES, SUPPORTED_FEATURES,
+    FRAME_IMAGE, FRAME_BYE, FRAME_RESUME, FRAME_CHUNK, FRAME_COMMIT, FEATURE_RESUMABLE,
+    COMPRESSION_DEFLATE, COMPRESSION_ZSTD, COMPRESSION_FEATURES,
+    ACK_OK, ACK_FAILED, ACK_INCOMPLETE, ACK_OFFSET,
+    encode_handshake, decode_handshake, encode_frame_header, encode_upload_header, decode_ack, new_compressor,
+)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8001
+# Matches the server's default TCP_MAX_INFLIGHT_PER_CONNECTION
+DEFAULT_WINDOW = 8
+RESUMABLE_THRESHOLD = 32 * 1024 * 1024
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# Statuses worth another attempt (the server may succeed next time). REJECTED,
+# TOO_LARGE and BAD_FRAME are final.
+RETRYABLE_STATUSES = {ACK_STATUS_NAMES[ACK_FAILED], ACK_STATUS_NAMES[ACK_INCOMPLETE]}
+
+# Codecs to offer, most preferred first
+COMPRESSION_CHOICES = {
+    "auto": (COMPRESSION_ZSTD, COMPRESSION_DEFLATE),
+    "zstd": (COMPRESSION_ZSTD,),
+    "deflate": (COMPRESSION_DEFLATE,),
+    "none": (),
+}
+# Formats that are compressed already; not worth another pass
+INCOMPRESSIBLE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".jp2", ".zip", ".gz", ".zst", ".mp4"}
+# Files are only compressed when a deflate pass over their first SAMPLE_SIZE bytes saves at least 10%
+SAMPLE_SIZE = 256 * 1024
+MIN_COMPRESSED_RATIO = 0.9
+
+
+class IngestResult(NamedTuple):
+    exam_id: str
+    file_path: str
+    status: str
+    attempts: int
+
+    @property
+    def ok(self) -> bool:
+        return self.status == ACK_STATUS_NAMES[ACK_OK]
+
+
+def upload_id_for(exam_id: str, file_path: str) -> bytes:
+    """
+    Stable 16-byte upload id for a file, so sending it again after a crash
+    resumes the same server-side session. Changing the file changes the id.
+    """
+    stat = os.stat(file_path)
+    key = f"{exam_id}|{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return uuid.uuid5(uuid.NAMESPACE_URL, key).bytes
+
+
+def worth_compressing(file_path: str) -> bool:
+    if os.path.splitext(file_path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return False
+    with open(file_path, "rb") as f:
+        sample = f.read(SAMPLE_SIZE)
+    return len(sample) >= 1024 and len(zlib.compress(sample, 1)) <= len(sample) * MIN_COMPRESSED_RATIO
+
+
+def compress_file(file_path: str, compression: int):
+    """Compress a file into an anonymous temporary file; returns (file, compressed size)."""
+    compressor = new_compressor(compression)
+    out = tempfile.TemporaryFile()
+    try:
+        with open(file_path, "rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                out.write(compressor.compress(chunk))
+        out.write(compressor.flush())
+        out.flush()
+        return out, out.tell()
+    except BaseException:
+        out.close()
+        raise
+
+
+def compress_range(file_path: str, offset: int, count: int, compression: int) -> bytes:
+    compressor = new_compressor(compression)
+    with open(file_path, "rb") as f:
+        f.seek(offset)
+        return compressor.compress(f.read(count)) + compressor.flush()
+
+
+def iter_files(directory: str, recursive: bool = True) -> List[str]:
+    """Regular files under `directory` in a stable order, skipping hidden entries."""
+    found = []
+    with os.scandir(directory) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir():
+                if recursive:
+                    found.extend(iter_files(entry.path, recursive))
+            elif entry.is_file():
+                found.append(entry.path)
+    return found
+
+
+class IngestConnection:
+    """
+    One framed-protocol session. Frames from any number of tasks are written
+    one at a time; acks are read by a background task and matched to their
+    frames by sequence number, so senders never wait on each other's acks.
+    `in_flight` counts the files the pool has assigned to this connection.
+    """
+
+    def __init__(self, host: str, port: int, window: int = DEFAULT_WINDOW, compression: str = "auto"):
+        self.host = host
+        self.port = port
+        self.features = 0
+        # Codecs offered (only those installed here), and the one the server agreed to
+        self._offered = [flag for flag in COMPRESSION_CHOICES[compression]
+                         if SUPPORTED_FEATURES & COMPRESSION_FEATURES[flag]]
+        self.compression = 0
+        self.in_flight = 0
+        self._window = asyncio.Semaphore(window)
+        self._write_lock = asyncio.Lock()
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._next_seq = 0
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._ack_task: Optional[asyncio.Task] = None
+        self.closed = False
+
+    async def open(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        requested = FEATURE_RESUMABLE
+        for flag in self._offered:
+            requested |= COMPRESSION_FEATURES[flag]
+        self._writer.write(encode_handshake(features=requested))
+        await self._writer.drain()
+        _version, self.features = decode_handshake(await self._reader.readexactly(HANDSHAKE.size))
+        accepted = [flag for flag in self._offered if self.features & COMPRESSION_FEATURES[flag]]
+        self.compression = accepted[0] if accepted else 0
+        self._ack_task = asyncio.create_task(self._read_acks())
+
+    @property
+    def resumable(self) -> bool:
+        return bool(self.features & FEATURE_RESUMABLE)
+
+    async def _read_acks(self):
+        error: BaseException = ConnectionError("Server closed the connection")
+        try:
+            while True:
+                seq, status = decode_ack(await self._reader.readexactly(ACK_FORMAT.size))
+                offset = None
+                if status == ACK_OFFSET:
+                    offset, = OFFSET_FORMAT.unpack(await self._reader.readexactly(OFFSET_FORMAT.size))
+                future = self._pending.pop(seq, None)
+                if future is not None and not future.done():
+                    future.set_result((status, offset))
+        except (asyncio.IncompleteReadError, ConnectionError, OSError) as e:
+            if not isinstance(e, asyncio.IncompleteReadError):
+                error = e
+        finally:
+            # Nothing more will be acknowledged on this connection
+            self.closed = True
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(str(error)))
+            self._pending.clear()
+
+    async def _send_frame(self, frame_type: int, exam_id: str = "", file_ext: str = "", prefix: bytes = b"",
+                          file=None, offset: int = 0, count: int = 0, compression: int = 0) -> asyncio.Future:
+        """Write one frame (`prefix` then `count` bytes of `file` from `offset`); returns the ack future."""
+        if self.closed:
+            raise ConnectionError("Connection is closed")
+        # Reject a bad exam id or extension here, before anything is written
+        encode_frame_header(frame_type, 0, exam_id, file_ext, compression=compression)
+        future = asyncio.get_running_loop().create_future()
+        # Senders that stop early never await their chunk acks; don't warn about those
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        async with self._write_lock:
+            self._next_seq = self._next_seq % 0xFFFFFFFF + 1
+            seq = self._next_seq
+            self._pending[seq] = future
+            try:
+                self._writer.write(
+                    encode_frame_header(frame_type, seq, exam_id, file_ext, len(prefix) + count, compression) + prefix)
+                if count:
+                    await self._send_body(file, offset, count)
+                else:
+                    await self._writer.drain()
+            except BaseException:
+                # A partly written frame leaves the stream unusable
+                self._pending.pop(seq, None)
+                self._writer.close()
+                self.closed = True
+                raise
+        return future
+
+    async def _send_body(self, file, offset: int, count: int):
+        await self._writer.drain()
+        loop = asyncio.get_running_loop()
+        sent = await loop.sendfile(self._writer.transport, file, offset, count)
+        if sent != count:
+            raise ConnectionError(f"File shrank while sending ({sent} of {count} bytes)")
+
+    async def _should_compress(self, file_path: str) -> bool:
+        if not self.compression:
+            return False
+        return await asyncio.get_running_loop().run_in_executor(None, worth_compressing, file_path)
+
+    async def send_image(self, exam_id: str, file_path: str) -> str:
+        """Send a file as one IMAGE frame (compressed when worthwhile) and wait for its ack status."""
+        file_ext = os.path.splitext(file_path)[1]
+        async with self._window:
+            if await self._should_compress(file_path):
+                # Compressed into a temporary file first: the frame header needs the compressed size
+                f, size = await asyncio.get_running_loop().run_in_executor(
+                    None, compress_file, file_path, self.compression)
+                compression = self.compression
+            else:
+                f = open(file_path, "rb")
+                size = os.fstat(f.fileno()).st_size
+                compression = 0
+            with f:
+                future = await self._send_frame(FRAME_IMAGE, exam_id, file_ext, file=f, count=size,
+                                                compression=compression)
+            status, _ = await future
+            return ACK_STATUS_NAMES.get(status, str(status))
+
+    async def send_resumable(self, exam_id: str, file_path: str, chunk_size: int = CHUNK_SIZE) -> str:
+        """Send a file as RESUME, the CHUNK frames the server is missing, and COMMIT."""
+        upload_id = upload_id_for(exam_id, file_path)
+        file_ext = os.path.splitext(file_path)[1]
+        with open(file_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            status, offset = await (await self._send_frame(
+                FRAME_RESUME, exam_id, file_ext, encode_upload_header(upload_id, 0, size)))
+            if status != ACK_OFFSET:
+                return ACK_STATUS_NAMES.get(status, str(status))
+
+            compress = await self._should_compress(file_path)
+            loop = asyncio.get_running_loop()
+            chunk_acks = []
+            while offset < size:
+                count = min(chunk_size, size - offset)
+                header = encode_upload_header(upload_id, offset, size)
+                if compress:
+                    data = await loop.run_in_executor(None, compress_range, file_path, offset, count, self.compression)
+                    chunk_acks.append(await self._send_frame(
+                        FRAME_CHUNK, prefix=header + data, compression=self.compression))
+                else:
+                    chunk_acks.append(await self._send_frame(
+                        FRAME_CHUNK, prefix=header, file=f, offset=offset, count=count))
+                offset += count
+
+        # Commits are stored like images, so they count against the window
+        async with self._window:
+            commit = await self._send_frame(FRAME_COMMIT, prefix=encode_upload_header(upload_id, 0, size))
+            # A failed chunk shows up as INCOMPLETE on the commit
+            await asyncio.gather(*chunk_acks)
+            status, _ = await commit
+        return ACK_STATUS_NAMES.get(status, str(status))
+
+    async def close(self):
+        """Send BYE once every frame is acknowledged, then close."""
+        if self._writer is None:
+            return
+        try:
+            if not self.closed:
+                if self._pending:
+                    await asyncio.gather(*self._pending.values(), return_exceptions=True)
+                async with self._write_lock:
+                    self._writer.write(encode_frame_header(FRAME_BYE, 0))
+                    await self._writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.closed = True
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+            if self._ack_task is not None:
+                self._ack_task.cancel()
+                await asyncio.gather(self._ack_task, return_exceptions=True)
+
+
+class IngestClient:
+    """
+    Pool of up to `connections` ingest connections. Each send goes to the least
+    busy open connection; broken connections are replaced on the next send.
+    """
+
+    def __init__(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, connections: int = 4,
+                 window: int = DEFAULT_WINDOW, retries: int = 5, backoff: float = 0.5, max_backoff: float = 30.0,
+                 resumable_threshold: int = RESUMABLE_THRESHOLD, chunk_size: int = CHUNK_SIZE,
+                 compression: str = "auto"):
+        if compression not in COMPRESSION_CHOICES:
+            raise ValueError(f"compression must be one of {', '.join(COMPRESSION_CHOICES)}")
+        self.host = host
+        self.port = port
+        self.connections = connections
+        self.window = window
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.resumable_threshold = resumable_threshold
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self._pool: List[IngestConnection] = []
+        self._pool_lock = asyncio.Lock()
+
+    async def __aenter__(self) -> "IngestClient":
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _connection(self) -> IngestConnection:
+        """Reserve a connection for one file; the caller decrements in_flight when done."""
+        async with self._pool_lock:
+            self._pool = [conn for conn in self._pool if not conn.closed]
+            idle = [conn for conn in self._pool if conn.in_flight == 0]
+            if idle:
+                conn = idle[0]
+            elif len(self._pool) < self.connections:
+                conn = IngestConnection(self.host, self.port, self.window, self.compression)
+                await conn.open()
+                self._pool.append(conn)
+            else:
+                conn = min(self._pool, key=lambda conn: conn.in_flight)
+            conn.in_flight += 1
+            return conn
+
+    def _delay(self, attempt: int) -> float:
+        # Full jitter keeps a gateway's retries from arriving in lockstep
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    async def send_file(self, exam_id: str, file_path: str) -> IngestResult:
+        """Send one file, retrying connection errors and retryable statuses with backoff."""
+        if not os.path.isfile(file_path):
+            return IngestResult(exam_id, file_path, "MISSING", 0)
+        status = "ERROR"
+        attempt = 0
+        while attempt <= self.retries:
+            attempt += 1
+            try:
+                conn = await self._connection()
+                try:
+                    if conn.resumable and os.path.getsize(file_path) >= self.resumable_threshold:
+                        status = await conn.send_resumable(exam_id, file_path, self.chunk_size)
+                    else:
+                        status = await conn.send_image(exam_id, file_path)
+                finally:
+                    conn.in_flight -= 1
+                if status not in RETRYABLE_STATUSES:
+                    break
+                print(f"Attempt {attempt} for {file_path}: {status}")
+            except ValueError as e:
+                # Bad exam id or extension: no attempt will do better
+                print(f"Cannot send {file_path}: {e}")
+                return IngestResult(exam_id, file_path, "INVALID", attempt)
+            except (ConnectionError, OSError, asyncio.IncompleteReadError) as e:
+                status = "ERROR"
+                print(f"Attempt {attempt} for {file_path} interrupted: {e}")
+            if attempt <= self.retries:
+                await asyncio.sleep(self._delay(attempt - 1))
+        return IngestResult(exam_id, file_path, status, attempt)
+
+    async def send_files(self, uploads: Iterable[Tuple[str, str]], concurrency: Optional[int] = None) -> List[IngestResult]:
+        """
+        Send (exam_id, file_path) pairs concurrently; results come back in input order.
+        At most `concurrency` files (default: every pooled connection's window) are open at once.
+        """
+        limit = asyncio.Semaphore(concurrency or self.connections * self.window)
+
+        async def send(exam_id: str, file_path: str) -> IngestResult:
+            async with limit:
+                return await self.send_file(exam_id, file_path)
+
+        return await asyncio.gather(*(send(exam_id, path) for exam_id, path in uploads))
+
+    async def send_directory(self, exam_id: str, directory: str, recursive: bool = True,
+                             concurrency: Optional[int] = None) -> List[IngestResult]:
+        """Send every file under `directory` for one exam."""
+        paths = await asyncio.get_running_loop().run_in_executor(None, iter_files, directory, recursive)
+        return await self.send_files([(exam_id, path) for path in paths], concurrency)
+
+    async def close(self):
+        pool, self._pool = self._pool, []
+        await asyncio.gather(*(conn.close() for conn in pool), return_exceptions=True)
@@ -11,7 +11,6 @@ from fastapi.responses import JSONResponse
 from contextlib import asynccontextmanager
 import os
 import logging
-import time
 import asyncio
 from dotenv import load_dotenv
 #load environment variables
@@ -21,6 +20,8 @@ load_dotenv()
 # Assuming your socket server file is at routes/socket_server.py
 
 from routes.socket_server import start_server as start_socket_server
+from routes.supabase_client import shutdown as shutdown_data_access
+from routes.entity_cache import start_invalidation_listener, stop_invalidation_listener
 
 
 
@@ -38,6 +39,8 @@ logger = logging.getLogger(__name__)
 
 # --- Lifespan Management for Concurrent Servers ---
 tcp_server_task = None
+# Off when the TCP server runs in its own process (serve.py), so HTTP workers don't all bind its port
+TCP_SERVER_ENABLED = os.getenv("TCP_SERVER_ENABLED", "true").lower() in ("1", "true", "yes")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -47,26 +50,35 @@ async def lifespan(app: FastAPI):
     global tcp_server_task
     logger.info("EZRAD API starting up...")
     
+    # Cross-worker cache invalidation (no-op unless CACHE_INVALIDATION_REDIS_URL is set)
+    start_invalidation_listener()
+
     # Start the TCP socket server as a background task
-    try:
-        loop = asyncio.get_running_loop()
-        tcp_server_task = loop.create_task(start_socket_server())
-        logger.info("TCP socket server task created and started in the background.")
-    except Exception as e:
-        logger.error(f"Failed to start TCP socket server: {e}")
+    if not TCP_SERVER_ENABLED:
+        logger.info("TCP socket server disabled in this process (TCP_SERVER_ENABLED=false).")
+    else:
+        try:
+            loop = asyncio.get_running_loop()
+            tcp_server_task = loop.create_task(start_socket_server())
+            logger.info("TCP socket server task created and started in the background.")
+        except Exception as e:
+            logger.error(f"Failed to start TCP socket server: {e}")
 
     yield  # The application is now running and handling requests
 
     # --- Shutdown logic ---
     logger.info("EZRAD API shutting down...")
     if tcp_server_task and not tcp_server_task.done():
-        logger.info("Stopping TCP server...")
+        logger.info("Stopping TCP server (draining open connections)...")
         tcp_server_task.cancel()
         try:
             await tcp_server_task
         except asyncio.CancelledError:
             logger.info("TCP server task has been successfully cancelled.")
 
+    stop_invalidation_listener()
+    shutdown_data_access()
+
 
 # --- FastAPI App Initialization ---
 # Create FastAPI app and attach the lifespan manager
@@ -126,19 +138,9 @@ uploads_dir = "uploads"
 if os.path.exists(uploads_dir):
     app.mount("/static", StaticFiles(directory=uploads_dir), name="static")
 
-# Add request logging middleware
-@app.middleware("http")
-async def log_requests(request, call_next):
-    """Log all requests"""
-    start_time = time.time()
-    logger.info(f"Request: {request.method} {request.url}")
-    
-    response = await call_next(request)
-    
-    process_time = time.time() - start_time
-    logger.info(f"Response: {response.status_code} - {process_time:.4f}s")
-    
-    return response
+# Request logging and metrics middleware
+if router_config is not None:
+    router_config.configure_middleware(app)
 
 # Custom Exception Handlers
 @app.exception_handler(404)
@@ -152,7 +154,7 @@ async def internal_error_handler(request, exc):
     logger.error(f"Internal error: {exc}")
     return JSONResponse(status_code=500, content={"error": "Internal server error", "message": "Please try again later"})
 
-# Main execution block
+# Main execution block (development; use serve.py to run several workers in production)
 if __name__ == "__main__":
     import uvicorn
     
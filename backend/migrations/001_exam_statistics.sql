@@ -0,0 +1,38 @@
+-- Exam statistics computed by the database
+-- Apply in the Supabase SQL editor (or psql) before deploying the matching API version.
+-- GET /api/v1/exams/statistics calls exam_statistics() and falls back to
+-- per-bucket count queries when the function is not installed.
+
+create index if not exists exams_status_idx on exams (status);
+create index if not exists exams_scheduled_time_idx on exams (scheduled_time);
+
+create or replace function exam_statistics(
+    day_start timestamp,
+    day_end timestamp,
+    week_start timestamp,
+    month_start timestamp
+)
+returns table (
+    total_exams bigint,
+    pending_exams bigint,
+    in_progress_exams bigint,
+    completed_exams bigint,
+    cancelled_exams bigint,
+    today_exams bigint,
+    week_exams bigint,
+    month_exams bigint
+)
+language sql
+stable
+as $$
+    select
+        count(*),
+        count(*) filter (where status = 'pending'),
+        count(*) filter (where status = 'in_progress'),
+        count(*) filter (where status = 'completed'),
+        count(*) filter (where status = 'cancelled'),
+        count(*) filter (where scheduled_time >= day_start and scheduled_time < day_end),
+        count(*) filter (where scheduled_time >= week_start),
+        count(*) filter (where scheduled_time >= month_start)
+    from exams;
+$$;
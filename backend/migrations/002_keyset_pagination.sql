@@ -0,0 +1,5 @@
+-- Indexes backing keyset (cursor) pagination on (created_at, id)
+-- Used by GET /api/v1/exams, /api/v1/patients and /api/v1/patients/search in cursor mode.
+
+create index if not exists exams_created_at_id_idx on exams (created_at desc, id desc);
+create index if not exists patients_created_at_id_idx on patients (created_at desc, id desc);
@@ -0,0 +1,53 @@
+-- Indexed patient search
+-- Adds normalized search columns with trigram and prefix indexes, plus the ranked
+-- lookup function behind GET /api/v1/patients/lookup. Until this is applied the API
+-- falls back to its in-process index (PATIENT_SEARCH_BACKEND=memory does so explicitly).
+
+create extension if not exists pg_trgm;
+
+alter table patients
+    add column if not exists search_name text
+        generated always as (lower(trim(coalesce(first_name, '') || ' ' || coalesce(last_name, '')))) stored;
+
+alter table patients
+    add column if not exists phone_digits text
+        generated always as (regexp_replace(coalesce(phone, ''), '\D', '', 'g')) stored;
+
+-- Substring / fuzzy matching (ILIKE '%term%' and the % similarity operator)
+create index if not exists patients_search_name_trgm_idx on patients using gin (search_name gin_trgm_ops);
+create index if not exists patients_phone_digits_trgm_idx on patients using gin (phone_digits gin_trgm_ops);
+
+-- Prefix matching for type-ahead (LIKE 'term%')
+create index if not exists patients_search_name_prefix_idx on patients (search_name text_pattern_ops);
+create index if not exists patients_last_name_prefix_idx on patients (lower(last_name) text_pattern_ops);
+create index if not exists patients_phone_digits_prefix_idx on patients (phone_digits text_pattern_ops);
+
+-- Ranked lookup: name/last-name prefix, then phone prefix, then trigram similarity
+create or replace function search_patients_ranked(q text, max_results int default 20)
+returns setof patients
+language sql
+stable
+as $$
+    with params as (
+        select
+            lower(regexp_replace(trim(q), '\s+', ' ', 'g')) as term,
+            regexp_replace(q, '\D', '', 'g') as digits
+    )
+    select p.*
+    from patients p, params
+    where params.term <> ''
+      and (
+            p.search_name like params.term || '%'
+         or lower(p.last_name) like params.term || '%'
+         or p.search_name like '%' || params.term || '%'
+         or p.search_name % params.term
+         or (length(params.digits) >= 3 and p.phone_digits like '%' || params.digits || '%')
+      )
+    order by
+        (p.search_name like params.term || '%' or lower(p.last_name) like params.term || '%') desc,
+        (length(params.digits) >= 3 and p.phone_digits like params.digits || '%') desc,
+        similarity(p.search_name, params.term) desc,
+        lower(p.last_name),
+        p.search_name
+    limit max_results;
+$$;
@@ -0,0 +1,24 @@
+-- DICOM header index for exam images
+-- Key tags are read from each DICOM upload's header at ingest time (pixel data is
+-- never parsed) and stored here, so studies and series can be found without
+-- downloading files. Rows for non-DICOM images leave these columns null. Until this
+-- is applied, uploads are stored without header columns and the DICOM query
+-- endpoints return 503.
+
+alter table exam_images add column if not exists study_instance_uid text;
+alter table exam_images add column if not exists series_instance_uid text;
+alter table exam_images add column if not exists sop_instance_uid text;
+alter table exam_images add column if not exists modality text;
+alter table exam_images add column if not exists body_part_examined text;
+alter table exam_images add column if not exists acquisition_datetime timestamptz;
+
+create index if not exists exam_images_study_instance_uid_idx
+    on exam_images (study_instance_uid) where study_instance_uid is not null;
+create index if not exists exam_images_series_instance_uid_idx
+    on exam_images (series_instance_uid, acquisition_datetime) where series_instance_uid is not null;
+create index if not exists exam_images_modality_acquired_idx
+    on exam_images (modality, acquisition_datetime desc) where modality is not null;
+create index if not exists exam_images_body_part_idx
+    on exam_images (body_part_examined) where body_part_examined is not null;
+create index if not exists exam_images_acquisition_datetime_idx
+    on exam_images (acquisition_datetime desc) where acquisition_datetime is not null;
@@ -0,0 +1,10 @@
+-- Content-addressed exam images
+-- Uploads are stored at <exam_id>/<sha256><ext>, so the same bytes sent twice for an
+-- exam map to one storage object. This index makes the exam_images row idempotent as
+-- well: inserts use ON CONFLICT (exam_id, image_path) DO NOTHING, so two concurrent
+-- re-sends can't both add a row. It also serves the duplicate lookup at upload time.
+-- Until this is applied, inserts fall back to plain INSERTs (a race between two
+-- identical uploads can then still produce two rows).
+
+create unique index if not exists exam_images_exam_id_image_path_key
+    on exam_images (exam_id, image_path);
@@ -3,9 +3,12 @@ FastAPI Router Setup for EZRAD Application
 This file contains the router configuration and setup for organizing API endpoints
 """
 
-from fastapi import APIRouter, HTTPException, status
-from typing import List, Optional
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from starlette.routing import Mount
 import logging
+import os
+import time
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -13,16 +16,21 @@ logger = logging.getLogger(__name__)
 
 # Import your route modules here (with error handling)
 try:
-    from .routes import exams, images, database, techs, patients
+    from .routes import exams, images, database, techs, patients, socket_server, events
     ROUTES_AVAILABLE = True
 except ImportError:
     try:
-        from routes import exams, images, database, techs, patients
+        from routes import exams, images, database, techs, patients, socket_server, events
         ROUTES_AVAILABLE = True
     except ImportError as e:
         logger.warning(f"Route modules not available: {e}")
         ROUTES_AVAILABLE = False
 
+try:
+    from .routes import metrics
+except ImportError:
+    from routes import metrics
+
 # Create main API router
 api_router = APIRouter(prefix="/api/v1")
 
@@ -38,6 +46,26 @@ async def health_check():
         "version": "1.0.0"
     }
 
+@health_router.get("/health/ingest")
+async def ingest_health():
+    """
+    TCP ingest queue depth and in-flight upload counts. "disabled" when this
+    process doesn't run the ingest server (under serve.py, ask the ingest
+    processes on TCP_METRICS_PORT + index instead).
+    """
+    if not ROUTES_AVAILABLE:
+        return {"status": "unavailable"}
+    return socket_server.ingest_health()
+
+@health_router.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """
+    Request, Supabase and TCP ingest metrics in the Prometheus text format.
+    Metrics are kept per process: with several uvicorn workers each scrape
+    reaches one of them, and ingest processes serve their own on TCP_METRICS_PORT + index.
+    """
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
 @health_router.get("/")
 async def root():
     """Root endpoint"""
@@ -90,6 +118,13 @@ def setup_routers():
             responses={404: {"description": "Image not found"}}
         )
         
+        # Real-time exam event stream
+        api_router.include_router(
+            events.router,
+            prefix="/events",
+            tags=["events"]
+        )
+        
         # Database management routes
         api_router.include_router(
             database.router,
@@ -123,13 +158,35 @@ async def get_system_stats():
     }
 
 # Rate limiting and middleware setup (optional)
+def env_flag(name: str, default: bool) -> bool:
+    return os.getenv(name, str(default)).strip().lower() in ("1", "true", "yes", "on")
+
+# Long-lived streams (SSE): counted, but kept out of the latency histogram and in-flight gauge
+STREAMING_PATHS = {"/api/v1/events/exams"}
+
+def route_template(request) -> str:
+    """Matched route as a template (/api/v1/exams/{exam_id}), so metrics labels stay bounded."""
+    route = request.scope.get("route")
+    template = getattr(route, "path", None)
+    if not template:
+        return "unmatched"
+    if isinstance(route, Mount):
+        return template + "/{path}"
+    # Newer FastAPI versions keep included routers' routes as declared (/{exam_id}):
+    # the segments the template doesn't cover are the router prefixes
+    depth = template.count("/")
+    return "/".join(request.url.path.split("/")[:-depth]) + template
+
 class RouterConfig:
     """Configuration class for router settings"""
     
     def __init__(self):
         self.rate_limit_enabled = True
-        self.cors_enabled = True
-        self.logging_enabled = True
+        # main.py installs the application-wide CORS policy
+        self.cors_enabled = False
+        # Per-request INFO logs; disable under load with REQUEST_LOGGING=false
+        self.logging_enabled = env_flag("REQUEST_LOGGING", True)
+        self.metrics_enabled = env_flag("METRICS_ENABLED", True)
     
     def configure_middleware(self, app):
         """Configure middleware for the application"""
@@ -143,14 +200,37 @@ class RouterConfig:
                 allow_headers=["*"],
             )
         
-        if self.logging_enabled:
-            # Add request logging middleware
-            @app.middleware("http")
-            async def log_requests(request, call_next):
-                logger.info(f"{request.method} {request.url}")
+        if not (self.logging_enabled or self.metrics_enabled):
+            return
+
+        logging_enabled = self.logging_enabled
+        metrics_enabled = self.metrics_enabled
+
+        @app.middleware("http")
+        async def observe_requests(request, call_next):
+            """Per-route latency metrics and (optionally) request logging"""
+            start_time = time.perf_counter()
+            if logging_enabled:
+                logger.info(f"Request: {request.method} {request.url}")
+            timed = metrics_enabled and request.url.path not in STREAMING_PATHS
+            if timed:
+                metrics.http_requests_in_flight.inc()
+
+            status_code = 500
+            try:
                 response = await call_next(request)
-                logger.info(f"Response status: {response.status_code}")
+                status_code = response.status_code
                 return response
+            finally:
+                process_time = time.perf_counter() - start_time
+                if metrics_enabled:
+                    route_path = route_template(request)
+                    metrics.http_requests_total.inc(method=request.method, route=route_path, status=status_code)
+                if timed:
+                    metrics.http_requests_in_flight.dec()
+                    metrics.http_request_duration_seconds.observe(process_time, method=request.method, route=route_path)
+                if logging_enabled:
+                    logger.info(f"Response: {status_code} - {process_time:.4f}s")
 
 # Export the main components
 __all__ = [
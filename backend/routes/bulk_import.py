@@ -0,0 +1,148 @@
+"""
+Streaming record readers for bulk import endpoints
+Turns a request body of CSV (with a header row) or NDJSON into dict records
+while it is still arriving, so multi-gigabyte migration files never have to be
+held in memory.
+"""
+
+import codecs
+import csv
+import io
+import json
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from pydantic import ValidationError
+
+CSV_TYPES = ("text/csv", "application/csv")
+NDJSON_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+
+# (row number, record or None, parse error or None)
+ParsedRecord = Tuple[int, Optional[Dict[str, Any]], Optional[str]]
+
+
+def detect_format(request: Request, format: Optional[str]) -> str:
+    """'csv' or 'ndjson', from the explicit format parameter or the Content-Type."""
+    if format:
+        format = format.lower()
+        if format not in ("csv", "ndjson"):
+            raise HTTPException(status_code=400, detail="format must be 'csv' or 'ndjson'")
+        return format
+    content_type = (request.headers.get("content-type") or "").split(";")[0].strip().lower()
+    if content_type in CSV_TYPES:
+        return "csv"
+    if content_type in NDJSON_TYPES:
+        return "ndjson"
+    raise HTTPException(
+        status_code=415,
+        detail="Send text/csv or application/x-ndjson, or pass ?format=csv|ndjson",
+    )
+
+
+async def iter_lines(request: Request) -> AsyncIterator[str]:
+    """Decode the body as UTF-8 and yield complete lines (with their line endings)."""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    pending = ""
+    async for chunk in request.stream():
+        pending += decoder.decode(chunk)
+        lines = pending.split("\n")
+        # The last piece is an unfinished line (or empty)
+        pending = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+async def iter_csv_records(request: Request) -> AsyncIterator[ParsedRecord]:
+    """
+    CSV records keyed by the header row. Quoted fields may contain newlines: lines
+    are buffered until the record's quotes balance. Empty cells become None.
+    """
+    header: Optional[List[str]] = None
+    buffer = ""
+    row_number = 0
+    async for line in iter_lines(request):
+        buffer += line
+        if buffer.count('"') % 2:
+            continue
+        record_text, buffer = buffer, ""
+        if not record_text.strip():
+            continue
+        try:
+            values = next(csv.reader(io.StringIO(record_text)))
+        except csv.Error as e:
+            row_number += 1
+            yield row_number, None, f"Malformed CSV: {e}"
+            continue
+        if header is None:
+            header = [name.strip().lower() for name in values]
+            continue
+        row_number += 1
+        if len(values) > len(header):
+            yield row_number, None, f"Expected {len(header)} columns, found {len(values)}"
+            continue
+        yield row_number, {
+            name: (value.strip() or None) for name, value in zip(header, values)
+        }, None
+    if buffer.strip():
+        yield row_number + 1, None, "Unterminated quoted field at end of input"
+
+
+async def iter_ndjson_records(request: Request) -> AsyncIterator[ParsedRecord]:
+    """One JSON object per non-empty line."""
+    row_number = 0
+    async for line in iter_lines(request):
+        if not line.strip():
+            continue
+        row_number += 1
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield row_number, None, f"Invalid JSON: {e}"
+            continue
+        if not isinstance(record, dict):
+            yield row_number, None, "Each line must be a JSON object"
+            continue
+        yield row_number, record, None
+
+
+def iter_records(request: Request, format: str) -> AsyncIterator[ParsedRecord]:
+    return iter_csv_records(request) if format == "csv" else iter_ndjson_records(request)
+
+
+def validation_messages(error: ValidationError) -> List[str]:
+    """Flatten a pydantic ValidationError into 'field: message' strings."""
+    messages = []
+    for detail in error.errors():
+        field = ".".join(str(part) for part in detail.get("loc", ()))
+        messages.append(f"{field}: {detail.get('msg')}" if field else detail.get("msg"))
+    return messages
+
+
+class ImportReport:
+    """Per-row outcome of a bulk import; the error list is capped at `max_errors` entries."""
+
+    def __init__(self, max_errors: int = 1000):
+        self.max_errors = max_errors
+        self.total_rows = 0
+        self.imported = 0
+        self.failed = 0
+        self.errors: List[Dict[str, Any]] = []
+
+    def add_error(self, row: int, messages: List[str]):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({"row": row, "errors": messages})
+
+    def as_dict(self, dry_run: bool = False) -> Dict[str, Any]:
+        return {
+            "total_rows": self.total_rows,
+            "imported": 0 if dry_run else self.imported,
+            "valid": self.total_rows - self.failed,
+            "failed": self.failed,
+            "dry_run": dry_run,
+            "errors": self.errors,
+            "errors_truncated": self.failed > len(self.errors),
+        }
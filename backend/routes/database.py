@@ -7,20 +7,7 @@ from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 from typing import List, Optional
 from datetime import datetime
-import os
-from supabase import create_client, Client
-from dotenv import load_dotenv
-
-# Load environment variables
-load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), "..", ".env"))
-
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-
-if not SUPABASE_URL or not SUPABASE_KEY:
-    raise ValueError("Missing SUPABASE_URL or SUPABASE_KEY in environment!")
-
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+from .supabase_client import supabase, execute, SUPABASE_URL
 
 # Create router
 router = APIRouter()
@@ -65,7 +52,7 @@ async def create_test_table(table_data: TestTableCreate):
             # instead of actually creating tables dynamically (which can be risky)
             
             # First, ensure we have a test_tables metadata table
-            metadata_result = supabase.table("test_tables").select("*").limit(1).execute()
+            metadata_result = await execute(supabase.table("test_tables").select("*").limit(1))
             
             # If the table doesn't exist, we'll simulate the creation
             test_table_record = {
@@ -77,7 +64,7 @@ async def create_test_table(table_data: TestTableCreate):
             }
             
             # Insert the test table metadata
-            result = supabase.table("test_tables").insert(test_table_record).execute()
+            result = await execute(supabase.table("test_tables").insert(test_table_record))
             
             if result.data:
                 created_record = result.data[0]
@@ -108,7 +95,7 @@ async def create_test_table(table_data: TestTableCreate):
 async def list_test_tables():
     """List all test tables created"""
     try:
-        result = supabase.table("test_tables").select("*").order("created_at", desc=True).execute()
+        result = await execute(supabase.table("test_tables").select("*").order("created_at", desc=True))
         return {
             "test_tables": result.data,
             "count": len(result.data)
@@ -125,7 +112,7 @@ async def list_test_tables():
 async def delete_test_table(table_name: str):
     """Delete a test table (metadata only for safety)"""
     try:
-        result = supabase.table("test_tables").delete().eq("table_name", table_name).execute()
+        result = await execute(supabase.table("test_tables").delete().eq("table_name", table_name))
         
         if result.data:
             return {"message": f"Test table {table_name} deleted successfully"}
@@ -140,7 +127,7 @@ async def test_database_connection():
     """Simple database connection test"""
     try:
         # Try a simple query to test connection
-        result = supabase.table("users").select("id").limit(1).execute()
+        result = await execute(supabase.table("users").select("id").limit(1))
         
         return {
             "status": "connected",
@@ -156,7 +143,7 @@ async def get_schema_info():
     """Get basic schema information (safe queries only)"""
     try:
         # Get count of records from main tables
-        users_result = supabase.table("users").select("id", count="exact").execute()
+        users_result = await execute(supabase.table("users").select("id", count="exact"))
         
         schema_info = {
             "tables": {
@@ -170,7 +157,7 @@ async def get_schema_info():
         
         # Try to get other table counts safely
         try:
-            exams_result = supabase.table("exams").select("id", count="exact").execute()
+            exams_result = await execute(supabase.table("exams").select("id", count="exact"))
             schema_info["tables"]["exams"] = {
                 "count": exams_result.count,
                 "status": "accessible"
@@ -179,7 +166,7 @@ async def get_schema_info():
             schema_info["tables"]["exams"] = {"status": "not_accessible"}
             
         try:
-            images_result = supabase.table("images").select("id", count="exact").execute()
+            images_result = await execute(supabase.table("images").select("id", count="exact"))
             schema_info["tables"]["images"] = {
                 "count": images_result.count,
                 "status": "accessible"
@@ -0,0 +1,142 @@
+"""
+DICOM header indexing for exam images
+At ingest, DICOM uploads have their header read (never the pixel data) and a few
+key tags are stored in indexed exam_images columns from migrations/004, so
+studies and series can be queried without opening files. pydicom is listed in
+requirements.txt; without it (a warning is printed at startup), or before the
+migration is applied, images are stored unindexed.
+"""
+
+import io
+import re
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Union
+
+try:
+    import pydicom
+except ImportError:
+    pydicom = None
+    print("DICOM header indexing is disabled: pydicom is not installed (DICOM images get no thumbnails either)")
+
+DICOM_EXTENSIONS = {".dcm", ".dicom"}
+
+# exam_images column -> DICOM keyword
+HEADER_TAGS = {
+    "study_instance_uid": "StudyInstanceUID",
+    "series_instance_uid": "SeriesInstanceUID",
+    "sop_instance_uid": "SOPInstanceUID",
+    "modality": "Modality",
+    "body_part_examined": "BodyPartExamined",
+}
+HEADER_COLUMNS = (*HEADER_TAGS, "acquisition_datetime")
+# Tags read from the file (AcquisitionDate/Time stand in when AcquisitionDateTime is absent)
+READ_TAGS = [*HEADER_TAGS.values(), "AcquisitionDateTime", "AcquisitionDate", "AcquisitionTime"]
+
+# YYYY[MM[DD[HH[MM[SS[.FFFFFF]]]]]][&ZZXX]
+_DT_PATTERN = re.compile(
+    r"^(\d{4})(\d{2})?(\d{2})?(\d{2})?(\d{2})?(\d{2})?(?:\.(\d{1,6}))?([+-]\d{4})?$"
+)
+
+# Flipped to False when exam_images has no header columns (migration 004 not applied)
+header_columns_available = True
+
+
+def is_dicom(head: bytes) -> bool:
+    """True for Part 10 files (the 'DICM' marker after the 128-byte preamble)."""
+    return head[128:132] == b"DICM"
+
+
+def parse_dicom_datetime(value: Optional[str]) -> Optional[str]:
+    """ISO 8601 string for a DICOM DT value, or None if it is empty or malformed."""
+    match = _DT_PATTERN.match((value or "").strip())
+    if not match:
+        return None
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    try:
+        parsed = datetime(
+            int(year), int(month or 1), int(day or 1),
+            int(hour or 0), int(minute or 0), int(second or 0),
+            int((fraction or "0").ljust(6, "0")),
+        )
+    except ValueError:
+        return None
+    if offset:
+        sign = -1 if offset[0] == "-" else 1
+        parsed = parsed.replace(tzinfo=timezone(sign * timedelta(hours=int(offset[1:3]), minutes=int(offset[3:]))))
+    return parsed.isoformat()
+
+
+def _acquisition_datetime(ds) -> Optional[str]:
+    value = ds.get("AcquisitionDateTime")
+    if not value:
+        # Older objects split it into a DA and a TM (which may use the old HH:MM:SS form)
+        acquired_on = str(ds.get("AcquisitionDate") or "").strip()
+        if not acquired_on:
+            return None
+        value = acquired_on + str(ds.get("AcquisitionTime") or "").strip().replace(":", "")
+    return parse_dicom_datetime(str(value))
+
+
+def header_from_dataset(ds) -> Dict[str, Any]:
+    header = {}
+    for column, keyword in HEADER_TAGS.items():
+        value = str(ds.get(keyword) or "").strip()
+        header[column] = value or None
+    if header["modality"]:
+        header["modality"] = header["modality"].upper()
+    if header["body_part_examined"]:
+        header["body_part_examined"] = header["body_part_examined"].upper()
+    header["acquisition_datetime"] = _acquisition_datetime(ds)
+    return header
+
+
+def read_dicom_header(source: Union[bytes, str], file_ext: str) -> Dict[str, Any]:
+    """
+    Indexed header columns of a DICOM upload (bytes or a spool file path), or {}
+    for other files and when pydicom is not installed. Parsing stops before the
+    pixel data, so a spooled multi-gigabyte study costs only a header read.
+    """
+    if pydicom is None:
+        return {}
+    dicom_ext = file_ext.lower() in DICOM_EXTENSIONS
+    try:
+        if isinstance(source, bytes):
+            if not (dicom_ext or is_dicom(source[:132])):
+                return {}
+            ds = pydicom.dcmread(io.BytesIO(source), stop_before_pixels=True, specific_tags=READ_TAGS, force=True)
+        else:
+            with open(source, "rb") as f:
+                if not (dicom_ext or is_dicom(f.read(132))):
+                    return {}
+                f.seek(0)
+                ds = pydicom.dcmread(f, stop_before_pixels=True, specific_tags=READ_TAGS, force=True)
+    except Exception as e:
+        print(f"Could not read DICOM header: {e}")
+        return {}
+    return header_from_dataset(ds)
+
+
+def image_row(exam_id: str, image_path: str, header: Dict[str, Any]) -> Dict[str, Any]:
+    """exam_images row for a stored upload, with its header columns when the table has them."""
+    row = {"exam_id": exam_id, "image_path": image_path}
+    if header and header_columns_available:
+        row.update(header)
+    return row
+
+
+def header_columns_missing(error: Exception) -> bool:
+    """
+    True when an insert failed because exam_images lacks the header columns
+    (PGRST204: column not in the schema cache). Later rows are sent without them.
+    """
+    global header_columns_available
+    if getattr(error, "code", None) != "PGRST204":
+        return False
+    if header_columns_available:
+        print(f"exam_images has no DICOM header columns (apply migrations/004_dicom_headers.sql): {error}")
+        header_columns_available = False
+    return True
+
+
+def without_headers(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [{k: v for k, v in row.items() if k not in HEADER_COLUMNS} for row in rows]
@@ -0,0 +1,261 @@
+"""
+Read-through cache for technician and patient lookups and exam-existence checks
+Rows are kept in a per-process TTL/LRU cache and invalidated by the routes that
+write them. With several uvicorn workers, set CACHE_INVALIDATION_REDIS_URL (and
+install the optional `redis` package) so an invalidation in one worker is
+broadcast to the others; without it, other workers see changes after the TTL.
+The same Redis connection relays exam events between processes (see events.py).
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+try:
+    from . import metrics
+except ImportError:
+    import metrics
+
+# Technicians change rarely; patients are edited at the front desk
+TECH_CACHE_TTL = float(os.getenv("TECH_CACHE_TTL", "300"))
+PATIENT_CACHE_TTL = float(os.getenv("PATIENT_CACHE_TTL", "60"))
+PATIENT_CACHE_SIZE = int(os.getenv("PATIENT_CACHE_SIZE", "5000"))
+# Exam existence, checked for every ingested image. A miss expires sooner than a hit
+# so an exam that appears after a failed check isn't refused for long.
+EXAM_CACHE_TTL = float(os.getenv("EXAM_CACHE_TTL", "60"))
+EXAM_CACHE_NEGATIVE_TTL = float(os.getenv("EXAM_CACHE_NEGATIVE_TTL", "5"))
+EXAM_CACHE_SIZE = int(os.getenv("EXAM_CACHE_SIZE", "10000"))
+CACHE_INVALIDATION_REDIS_URL = os.getenv("CACHE_INVALIDATION_REDIS_URL")
+CACHE_INVALIDATION_CHANNEL = os.getenv("CACHE_INVALIDATION_CHANNEL", "ezrad:cache-invalidate")
+# Broadcasts waiting for the publisher thread; beyond this other workers fall back to the TTL
+CACHE_INVALIDATION_BACKLOG = 10000
+
+cache_requests_total = metrics.registry.register(metrics.Counter(
+    "ezrad_cache_requests_total", "Entity cache lookups by cache and result", ("cache", "result")))
+
+_MISSING = object()
+
+# Caches by name, for invalidations received from other workers
+_caches: Dict[str, "EntityCache"] = {}
+
+
+class EntityCache:
+    """
+    Thread-safe TTL + LRU cache of rows keyed by id (or a fixed key for lists).
+    A load that started before an invalidation is not stored, so a slow read can
+    never put back a row that a concurrent write just replaced.
+    """
+
+    def __init__(self, name: str, ttl: float, max_entries: int = 1000):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, Tuple[Any, float]]" = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+        _caches[name] = self
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def generation(self) -> int:
+        """Pass to put() to drop a value loaded before a concurrent invalidation."""
+        return self._generation
+
+    def get(self, key: Hashable) -> Any:
+        """Cached value, or _MISSING when absent or expired."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                return _MISSING
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, generation: Optional[int] = None, ttl: Optional[float] = None):
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def lookup(self, keys: List[Hashable]) -> Tuple[Dict[Hashable, Any], List[Hashable]]:
+        """Cached values for `keys` and the keys that missed, counted like get_or_load."""
+        hits, misses = {}, []
+        for key in keys:
+            value = self.get(key)
+            if value is _MISSING:
+                misses.append(key)
+            else:
+                hits[key] = value
+        if hits:
+            cache_requests_total.inc(len(hits), cache=self.name, result="hit")
+        if misses:
+            cache_requests_total.inc(len(misses), cache=self.name, result="miss")
+        return hits, misses
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """Return the cached value or await `loader()` and cache its result (None is not cached)."""
+        value = self.get(key)
+        if value is not _MISSING:
+            cache_requests_total.inc(cache=self.name, result="hit")
+            return value
+        cache_requests_total.inc(cache=self.name, result="miss")
+        generation = self._generation
+        value = await loader()
+        if value is not None:
+            self.put(key, value, generation)
+        return value
+
+    def invalidate(self, *keys: Hashable, broadcast: bool = True):
+        """Drop the given keys (all keys when none are given) here and, optionally, in other workers."""
+        self.invalidate_local(keys)
+        if broadcast:
+            invalidation_bus.publish(self.name, keys)
+
+    def invalidate_local(self, keys=()):
+        with self._lock:
+            self._generation += 1
+            if not keys:
+                self._entries.clear()
+            for key in keys:
+                self._entries.pop(key, None)
+
+
+class InvalidationBus:
+    """
+    Optional Redis pub/sub fan-out of cache invalidations between worker processes.
+    Other modules can add channels of their own (add_channel/send). Messages are
+    published from a background thread, so a slow or unreachable Redis never
+    blocks the request that made the change.
+    """
+
+    def __init__(self, url: Optional[str] = CACHE_INVALIDATION_REDIS_URL, channel: str = CACHE_INVALIDATION_CHANNEL):
+        self.url = url
+        self.channel = channel
+        self.origin = uuid.uuid4().hex
+        self._client = None
+        self._pubsub = None
+        self._thread: Optional[threading.Thread] = None
+        self._outbox: "queue.Queue[Optional[Tuple[str, str]]]" = queue.Queue(maxsize=CACHE_INVALIDATION_BACKLOG)
+        self._publisher: Optional[threading.Thread] = None
+        self._handlers: Dict[str, Callable[[Dict[str, Any]], None]] = {channel: self._on_invalidation}
+
+    @property
+    def enabled(self) -> bool:
+        """True while messages are being sent to other processes."""
+        return self._publisher is not None
+
+    def add_channel(self, channel: str, handler: Callable[[Dict[str, Any]], None]):
+        """Pass messages that other processes send() on `channel` to `handler` (called on a Redis thread)."""
+        self._handlers[channel] = handler
+        if self._pubsub is not None:
+            self._pubsub.subscribe(**{channel: self._listener(handler)})
+
+    def start(self):
+        if not self.url:
+            return
+        if redis is None:
+            print("CACHE_INVALIDATION_REDIS_URL is set but the redis package is not installed; "
+                  "caches will only be invalidated, and exam events only delivered, in this worker")
+            return
+        if self._thread is not None:
+            return
+        self._client = redis.Redis.from_url(self.url)
+        self._pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{channel: self._listener(handler) for channel, handler in self._handlers.items()})
+        self._thread = self._pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+        self._publisher = threading.Thread(target=self._publish_loop, name="ezrad-cache-publish", daemon=True)
+        self._publisher.start()
+
+    def stop(self):
+        if self._publisher is not None:
+            # Sends whatever is already queued, then exits
+            self._outbox.put(None)
+            self._publisher.join(timeout=5)
+            self._publisher = None
+        if self._thread is not None:
+            self._thread.stop()
+            self._thread = None
+        if self._pubsub is not None:
+            self._pubsub.close()
+            self._pubsub = None
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    def publish(self, cache_name: str, keys):
+        """Queue an invalidation for the other workers; returns at once."""
+        self.send(self.channel, {"cache": cache_name, "keys": [str(k) for k in keys]})
+
+    def send(self, channel: str, payload: Dict[str, Any]):
+        """Queue a message for the other processes listening on `channel`; returns at once."""
+        if self._publisher is None:
+            return
+        message = json.dumps({**payload, "origin": self.origin})
+        try:
+            self._outbox.put_nowait((channel, message))
+        except queue.Full:
+            print(f"Redis publish backlog is full; dropping a message for {channel}")
+
+    def _publish_loop(self):
+        while True:
+            item = self._outbox.get()
+            if item is None:
+                return
+            channel, message = item
+            try:
+                self._client.publish(channel, message)
+            except Exception as e:
+                # Other workers fall back to the TTL (or miss the event)
+                print(f"Failed to publish to {channel}: {e}")
+
+    def _listener(self, handler: Callable[[Dict[str, Any]], None]):
+        def on_message(message):
+            try:
+                payload = json.loads(message["data"])
+            except (TypeError, ValueError):
+                return
+            if not isinstance(payload, dict) or payload.get("origin") == self.origin:
+                return
+            handler(payload)
+        return on_message
+
+    def _on_invalidation(self, payload: Dict[str, Any]):
+        cache = _caches.get(payload.get("cache"))
+        if cache is not None:
+            cache.invalidate_local(tuple(payload.get("keys") or ()))
+
+
+invalidation_bus = InvalidationBus()
+
+tech_cache = EntityCache("technicians", TECH_CACHE_TTL)
+patient_cache = EntityCache("patients", PATIENT_CACHE_TTL, PATIENT_CACHE_SIZE)
+# exam id -> whether the exam exists (see image_store.existing_exam_ids)
+exam_cache = EntityCache("exams", EXAM_CACHE_TTL, EXAM_CACHE_SIZE)
+
+# tech_cache key for the full technician list
+ALL_TECHS = "__all__"
+
+
+def start_invalidation_listener():
+    invalidation_bus.start()
+
+
+def stop_invalidation_listener():
+    invalidation_bus.stop()
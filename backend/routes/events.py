@@ -0,0 +1,221 @@
+"""
+Real-time exam events for EZRAD
+Server-Sent Events stream of incremental worklist changes. The exam routes and
+the TCP ingest server publish deltas here, so dashboards can apply changes
+instead of re-polling the full worklist.
+
+    GET /api/v1/events/exams    (text/event-stream)
+
+Event types: exam.created, exam.updated, exam.deleted, exam.image_added, and
+resync, which tells the client that events were missed and it should refetch.
+exam.created rows embed the patient summary, as listings with expand=true do.
+Reconnecting clients send Last-Event-ID (EventSource does this automatically)
+and get the events they missed, as long as they are still in the replay buffer.
+
+With several processes (serve.py), events are relayed between them over the
+Redis bus of entity_cache (CACHE_INVALIDATION_REDIS_URL); without it a client
+only sees changes made by the worker it is connected to, and none from TCP
+ingest. Event ids carry a per-process prefix, so a client that reconnects to
+another worker is told to resync rather than given the wrong replay.
+"""
+
+import asyncio
+import json
+import os
+import threading
+import uuid
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Set, Tuple
+
+from fastapi import APIRouter, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+
+try:
+    from . import metrics
+    from .entity_cache import invalidation_bus
+except ImportError:
+    import metrics
+    from entity_cache import invalidation_bus
+
+# Events kept for Last-Event-ID replay
+EVENT_REPLAY_SIZE = int(os.getenv("EVENT_REPLAY_SIZE", "1000"))
+# Undelivered events per client before it is told to resync
+EVENT_CLIENT_QUEUE_SIZE = int(os.getenv("EVENT_CLIENT_QUEUE_SIZE", "256"))
+# Seconds between keep-alive comments on an idle stream
+EVENT_KEEPALIVE_SECONDS = float(os.getenv("EVENT_KEEPALIVE_SECONDS", "15"))
+# Redis channel relaying events between processes
+EVENT_CHANNEL = os.getenv("EVENT_CHANNEL", "ezrad:exam-events")
+
+router = APIRouter()
+
+
+class ExamEventBroker:
+    """
+    Fan-out of exam events to SSE subscribers.
+    publish() may be called from the event loop or from worker threads (ingest
+    uploads); delivery always happens on the loop the subscribers live on.
+    Events are numbered per process; `epoch` tells this process's ids apart.
+    """
+
+    def __init__(self, replay_size: int = EVENT_REPLAY_SIZE, queue_size: int = EVENT_CLIENT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.epoch = uuid.uuid4().hex[:8]
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+        self._next_id = 1
+        self._history: Deque[Tuple[int, str, str]] = deque(maxlen=replay_size)
+        self._subscribers: Set[asyncio.Queue] = set()
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def event_id(self, number: int) -> str:
+        return f"{self.epoch}.{number}"
+
+    def parse_event_id(self, event_id: Optional[str]) -> Optional[int]:
+        """Number of a Last-Event-ID from this process, -1 for one from elsewhere, None without one."""
+        if not event_id:
+            return None
+        epoch, _, number = event_id.partition(".")
+        if epoch != self.epoch or not number.isdigit():
+            # Another worker, or an earlier run of this one: its numbering means nothing here
+            return -1
+        return int(number)
+
+    def subscribe(self, last_event_id: Optional[int] = None) -> asyncio.Queue:
+        """Register a subscriber on the running loop, queueing any replayed events first."""
+        self._loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        if last_event_id == -1:
+            queue.put_nowait(self._resync_event())
+        elif last_event_id is not None:
+            with self._lock:
+                history = list(self._history)
+                next_id = self._next_id
+            if last_event_id >= next_id or (history and history[0][0] > last_event_id + 1):
+                # The id is from an earlier server run, or part of the gap has left the buffer
+                queue.put_nowait(self._resync_event())
+            else:
+                missed = [event for event in history if event[0] > last_event_id]
+                if self.queue_size > 0 and len(missed) > self.queue_size:
+                    # More than the client's queue holds: a partial replay would silently lose events
+                    queue.put_nowait(self._resync_event())
+                else:
+                    for event in missed:
+                        queue.put_nowait(event)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+
+    def publish(self, event_type: str, data: Dict[str, Any]):
+        """Publish an event from any thread, to this process's subscribers and to other processes."""
+        relay = invalidation_bus.enabled
+        loop = self._loop
+        if not relay and (loop is None or loop.is_closed()):
+            return
+        payload = json.dumps(jsonable_encoder(data))
+        if relay:
+            invalidation_bus.send(EVENT_CHANNEL, {"type": event_type, "data": payload})
+        self.deliver(event_type, payload)
+
+    def deliver(self, event_type: str, payload: str):
+        """Hand an encoded event to this process's subscribers. A no-op until a client has subscribed."""
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        with self._lock:
+            event = (self._next_id, event_type, payload)
+            self._next_id += 1
+            self._history.append(event)
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._dispatch(event)
+        else:
+            loop.call_soon_threadsafe(self._dispatch, event)
+
+    def _dispatch(self, event: Tuple[int, str, str]):
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Slow client: replace its backlog with a single resync marker
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(self._resync_event())
+
+    def _resync_event(self) -> Tuple[int, str, str]:
+        with self._lock:
+            last_id = self._next_id - 1
+        return (last_id, "resync", "{}")
+
+
+broker = ExamEventBroker()
+
+
+def _relayed_event(message: Dict[str, Any]):
+    """An event published by another process (called on the Redis listener thread)."""
+    if isinstance(message.get("type"), str) and isinstance(message.get("data"), str):
+        broker.deliver(message["type"], message["data"])
+
+
+invalidation_bus.add_channel(EVENT_CHANNEL, _relayed_event)
+
+metrics.register_gauge_callback(
+    "ezrad_event_subscribers", "Clients connected to the exam event stream", lambda: len(broker))
+
+
+def format_event(event: Tuple[int, str, str]) -> str:
+    event_id, event_type, payload = event
+    return f"id: {broker.event_id(event_id)}\nevent: {event_type}\ndata: {payload}\n\n"
+
+
+# --- Publishing helpers (safe from any thread) -------------------------------
+def exam_created(exam: Dict[str, Any]):
+    broker.publish("exam.created", exam)
+
+
+def exam_updated(exam: Dict[str, Any]):
+    broker.publish("exam.updated", exam)
+
+
+def exam_deleted(exam_id: str):
+    broker.publish("exam.deleted", {"id": exam_id})
+
+
+def exam_image_added(exam_id: str, image: Dict[str, Any]):
+    broker.publish("exam.image_added", {"exam_id": exam_id, "image": image})
+
+
+# --- Route -------------------------------------------------------------------
+@router.get("/exams")
+async def stream_exam_events(request: Request):
+    """Stream exam changes as Server-Sent Events"""
+    last_event_id = broker.parse_event_id(request.headers.get("last-event-id"))
+    queue = broker.subscribe(last_event_id)
+
+    async def event_stream():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=EVENT_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_event(event)
+        finally:
+            broker.unsubscribe(queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,85 @@
+"""
+Expanded exam listings for EZRAD
+Embeds the patient and technician of each exam through PostgREST resource
+embedding, so a listing is one joined query instead of one query plus a lookup
+per patient and technician. Also implements the optional `fields=` projection.
+"""
+
+import re
+from typing import Any, Dict, List, Optional
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+# Many-to-one embeds through exams.patient_id and exams.technician_id
+PATIENT_EMBED = "patient:patients(id,first_name,last_name,date_of_birth,gender)"
+TECHNICIAN_EMBED = "technician:technicians(id,full_name)"
+
+# Response fields computed from the embeds rather than read from the exams table
+EMBEDDED_FIELDS = {"patient", "patient_name", "technician_name"}
+
+_FIELD_NAME = re.compile(r"^[a-z_][a-z0-9_]*$")
+
+
+def parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    """Split and validate a comma separated `fields=` value; None means every column."""
+    if fields is None:
+        return None
+    names = []
+    for name in fields.split(","):
+        name = name.strip().lower()
+        if not name:
+            continue
+        if not _FIELD_NAME.match(name):
+            raise HTTPException(status_code=400, detail=f"Invalid field name: {name}")
+        if name not in names:
+            names.append(name)
+    if not names:
+        raise HTTPException(status_code=400, detail="fields must name at least one column")
+    return names
+
+
+def exam_select(expand: bool, fields: Optional[List[str]] = None, required: tuple = ("id",)) -> str:
+    """
+    PostgREST select clause for an exam listing. `required` columns are always
+    fetched (ids, cursor keys) even when the projection leaves them out.
+    Asking for an embedded field in `fields` implies its embed.
+    """
+    if fields is None:
+        columns = ["*"]
+    else:
+        columns = [c for c in required if c not in fields]
+        columns += [f for f in fields if f not in EMBEDDED_FIELDS]
+
+    wants_patient = expand if fields is None else bool({"patient", "patient_name"} & set(fields))
+    wants_technician = expand if fields is None else "technician_name" in fields
+    if wants_patient:
+        columns.append(PATIENT_EMBED)
+    if wants_technician:
+        columns.append(TECHNICIAN_EMBED)
+    return ",".join(columns)
+
+
+def flatten_embeds(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Replace the raw embeds with patient_name / technician_name, keeping the patient summary."""
+    if "patient" in row:
+        patient = row["patient"]
+        row["patient_name"] = (
+            f"{patient.get('first_name') or ''} {patient.get('last_name') or ''}".strip() if patient else None
+        )
+    if "technician" in row:
+        technician = row.pop("technician")
+        row["technician_name"] = technician.get("full_name") if technician else None
+    return row
+
+
+def project(rows: List[Dict[str, Any]], fields: Optional[List[str]]) -> List[Dict[str, Any]]:
+    if fields is None:
+        return rows
+    return [{name: row.get(name) for name in fields} for row in rows]
+
+
+def projected_response(content: Any) -> JSONResponse:
+    """Projected rows do not fit ExamResponse, so they bypass the route's response model."""
+    return JSONResponse(content=jsonable_encoder(content))
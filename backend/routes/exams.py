@@ -3,28 +3,29 @@ Exam management routes for EZRAD application
 Enhanced with comprehensive search functionality
 """
 
-from fastapi import APIRouter, HTTPException, Query, UploadFile, File
+from fastapi import APIRouter, HTTPException, Query
 from pydantic import BaseModel, Field
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Union
 from datetime import datetime, date, time, timedelta
+import asyncio
 import os
-from supabase import create_client, Client
-from dotenv import load_dotenv
-
-# Load environment variables
-load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), "..", ".env"))
-
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-
-if not SUPABASE_URL or not SUPABASE_KEY:
-    raise ValueError("Missing SUPABASE_URL or SUPABASE_KEY in environment!")
-
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+import uuid
+from .supabase_client import supabase, execute
+from .pagination import use_cursor_mode, apply_keyset, split_page
+from .exam_listing import parse_fields, exam_select, flatten_embeds, project, projected_response
+from . import events
+from .scheduling import BookingIndex
+from .entity_cache import exam_cache
+from .image_store import existing_exam_ids
 
 # Create router
 router = APIRouter()
 
+# Length of the slot each exam occupies when checking room/technician conflicts
+EXAM_SLOT_MINUTES = int(os.getenv("EXAM_SLOT_MINUTES", "30"))
+# Rows per insert request when scheduling a batch
+EXAM_BATCH_INSERT_SIZE = int(os.getenv("EXAM_BATCH_INSERT_SIZE", "500"))
+
 # Pydantic models
 # --- models ---
 class ExamCreate(BaseModel):
@@ -59,6 +60,10 @@ class ExamResponse(BaseModel):
     contrast: Optional[bool] = None
     pregnancy: Optional[bool] = None
     implants: Optional[bool] = None
+    # Present when the listing is requested with expand=true
+    patient: Optional[Dict[str, Any]] = None
+    patient_name: Optional[str] = None
+    technician_name: Optional[str] = None
 
 # class ExamCreate(BaseModel):
 #     patient_name: str
@@ -103,6 +108,33 @@ class ExamUpdate(BaseModel):
 #     exam_date: Optional[str] = None
 #     exam_time: Optional[str] = None
 
+class ExamBatchCreate(BaseModel):
+    """Many exams scheduled in one request"""
+    exams: List[ExamCreate] = Field(..., min_length=1, max_length=10000)
+    slot_minutes: int = Field(EXAM_SLOT_MINUTES, ge=1, le=24 * 60)
+    # Reject the whole batch when any exam conflicts
+    all_or_nothing: bool = False
+
+class ExamBatchResult(BaseModel):
+    """Outcome of a batch scheduling request"""
+    created: List[ExamResponse]
+    conflicts: List[Dict[str, Any]]
+    # Conflict-free exams that were not inserted because an insert request failed
+    failed: List[Dict[str, Any]] = []
+
+class ExamExistsRequest(BaseModel):
+    """Exam ids to validate in one round trip"""
+    exam_ids: List[str] = Field(..., min_length=1, max_length=10000)
+
+class ExamExistsResult(BaseModel):
+    existing: List[str]
+    missing: List[str]
+
+class ExamPage(BaseModel):
+    """One page of exams in cursor pagination mode"""
+    items: List[ExamResponse]
+    next_cursor: Optional[str] = None
+
 class ExamSearchParams(BaseModel):
     """Parameters for searching exams"""
     exam_id: Optional[str] = None
@@ -130,53 +162,59 @@ class ExamStatistics(BaseModel):
     week_exams: int
     month_exams: int
 
+def normalize_exam(e: Dict[str, Any]) -> Dict[str, Any]:
+    """Fill in the optional fields the worklist expects from the stored columns"""
+    return {
+        **e,
+        "patient_name": e.get("patient_name"),
+        "description": e.get("description") or e.get("clinical_history"),
+        "status": e.get("status") or "pending",
+        "technician_id": e.get("technician_id"),
+        "doctor_id": e.get("doctor_id"),
+        "scheduled_time": e.get("scheduled_time")
+            or (f"{e['exam_date']}T{e['exam_time']}" if e.get("exam_date") and e.get("exam_time") else None),
+        "notes": e.get("notes"),
+    }
+
 # Get today's exams
 @router.get("/today", response_model=List[ExamResponse])
-async def get_todays_exams():
+async def get_todays_exams(
+    expand: bool = Query(False, description="Embed patient and technician names"),
+    fields: Optional[str] = Query(None, description="Comma separated fields to return")
+):
     """Get all exams scheduled for today"""
+    field_list = parse_fields(fields)
+    select = exam_select(expand, field_list)
     try:
         today = datetime.now().date().isoformat()
         # Prefer exam_date/exam_time columns if available
         try:
-            result = (
+            result = await execute(
                 supabase
                 .table("exams")
-                .select("*")
+                .select(select)
                 .eq("exam_date", today)
                 .order("exam_time", desc=False)
-                .execute()
             )
             data = result.data
         except Exception:
             # Fallback to scheduled_time range if exam_date isn't available
             start_of_day = f"{today} 00:00:00"
             end_of_day = f"{today} 23:59:59"
-            result = (
+            result = await execute(
                 supabase
                 .table("exams")
-                .select("*")
+                .select(select)
                 .gte("scheduled_time", start_of_day)
                 .lte("scheduled_time", end_of_day)
                 .order("scheduled_time", desc=False)
-                .execute()
             )
             data = result.data
         
         # Normalize records to include expected optional fields
-        normalized = []
-        for e in data:
-            item = {
-                **e,
-                "patient_name": e.get("patient_name"),
-                "description": e.get("description") or e.get("clinical_history"),
-                "status": e.get("status") or "pending",
-                "technician_id": e.get("technician_id"),
-                "doctor_id": e.get("doctor_id"),
-                "scheduled_time": e.get("scheduled_time")
-                    or (f"{e['exam_date']}T{e['exam_time']}" if e.get("exam_date") and e.get("exam_time") else None),
-                "notes": e.get("notes"),
-            }
-            normalized.append(item)
+        normalized = [normalize_exam(flatten_embeds(e)) for e in data]
+        if field_list is not None:
+            return projected_response(project(normalized, field_list))
         return normalized
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
@@ -189,55 +227,77 @@ async def get_upcoming_exams(hours: int = 24):
         now = datetime.now()
         future_time = now + timedelta(hours=hours)
         
-        result = supabase.table("exams").select("*").gte("scheduled_time", now.isoformat()).lte("scheduled_time", future_time.isoformat()).eq("status", "pending").order("scheduled_time", desc=False).execute()
+        result = await execute(supabase.table("exams").select("*").gte("scheduled_time", now.isoformat()).lte("scheduled_time", future_time.isoformat()).eq("status", "pending").order("scheduled_time", desc=False))
         
         return result.data
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
 # Get exam statistics
+def exam_statistics_windows() -> Dict[str, str]:
+    """Time bucket boundaries used by the statistics counters"""
+    today = datetime.now().date()
+    return {
+        "day_start": today.isoformat(),
+        "day_end": (today + timedelta(days=1)).isoformat(),
+        "week_start": (today - timedelta(days=7)).isoformat(),
+        "month_start": (today - timedelta(days=30)).isoformat(),
+    }
+
+async def count_exams(build=None) -> int:
+    """Count matching exams in the database without transferring the rows"""
+    query = supabase.table("exams").select("id", count="exact")
+    if build is not None:
+        query = build(query)
+    result = await execute(query.limit(1))
+    return result.count or 0
+
+async def count_exam_statistics(windows: Dict[str, str]) -> ExamStatistics:
+    """Fallback when the exam_statistics() function is not installed: one count query per bucket, run concurrently"""
+    counts = await asyncio.gather(
+        count_exams(),
+        count_exams(lambda q: q.eq("status", "pending")),
+        count_exams(lambda q: q.eq("status", "in_progress")),
+        count_exams(lambda q: q.eq("status", "completed")),
+        count_exams(lambda q: q.eq("status", "cancelled")),
+        count_exams(lambda q: q.gte("scheduled_time", windows["day_start"]).lt("scheduled_time", windows["day_end"])),
+        count_exams(lambda q: q.gte("scheduled_time", windows["week_start"])),
+        count_exams(lambda q: q.gte("scheduled_time", windows["month_start"])),
+    )
+    total, pending, in_progress, completed, cancelled, today_count, week_count, month_count = counts
+    return ExamStatistics(
+        total_exams=total,
+        pending_exams=pending,
+        in_progress_exams=in_progress,
+        completed_exams=completed,
+        cancelled_exams=cancelled,
+        today_exams=today_count,
+        week_exams=week_count,
+        month_exams=month_count
+    )
+
+# Set to False once the RPC is known to be missing so later polls go straight to the fallback
+statistics_rpc_available = True
+
 @router.get("/statistics", response_model=ExamStatistics)
 async def get_exam_statistics():
-    """Get statistics about exams"""
+    """Get statistics about exams (aggregated by the database)"""
+    global statistics_rpc_available
     try:
-        # Get all exams for counting
-        all_exams = supabase.table("exams").select("*").execute()
-        
-        # Count by status
-        total = len(all_exams.data)
-        pending = sum(1 for e in all_exams.data if e.get("status") == "pending")
-        in_progress = sum(1 for e in all_exams.data if e.get("status") == "in_progress")
-        completed = sum(1 for e in all_exams.data if e.get("status") == "completed")
-        cancelled = sum(1 for e in all_exams.data if e.get("status") == "cancelled")
-        
-        # Count by time period
-        now = datetime.now()
-        today = now.date()
-        week_ago = today - timedelta(days=7)
-        month_ago = today - timedelta(days=30)
-        
-        today_count = sum(1 for e in all_exams.data 
-                         if e.get("scheduled_time") and 
-                         datetime.fromisoformat(e["scheduled_time"]).date() == today)
-        
-        week_count = sum(1 for e in all_exams.data 
-                        if e.get("scheduled_time") and 
-                        datetime.fromisoformat(e["scheduled_time"]).date() >= week_ago)
-        
-        month_count = sum(1 for e in all_exams.data 
-                         if e.get("scheduled_time") and 
-                         datetime.fromisoformat(e["scheduled_time"]).date() >= month_ago)
-        
-        return ExamStatistics(
-            total_exams=total,
-            pending_exams=pending,
-            in_progress_exams=in_progress,
-            completed_exams=completed,
-            cancelled_exams=cancelled,
-            today_exams=today_count,
-            week_exams=week_count,
-            month_exams=month_count
-        )
+        windows = exam_statistics_windows()
+
+        if statistics_rpc_available:
+            try:
+                result = await execute(supabase.rpc("exam_statistics", windows))
+                if result.data:
+                    return ExamStatistics(**result.data[0])
+            except Exception as e:
+                print(f"exam_statistics() failed, using count queries: {e}")
+                # PGRST202: the function is not installed in this database
+                if getattr(e, "code", None) == "PGRST202":
+                    statistics_rpc_available = False
+
+        return await count_exam_statistics(windows)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Statistics error: {str(e)}")
 
@@ -246,75 +306,166 @@ async def get_exam_statistics():
 async def create_exam(exam: ExamCreate):
     """Create a new exam"""
     try:
-        # Build payload matching the new ExamCreate schema
-        exam_data = {
-            "patient_id": exam.patient_id,
-            "exam_type": exam.exam_type,
-            "body_part": exam.body_part,
-            "ordering_physician": exam.ordering_physician,
-            "clinical_history": exam.clinical_history,
-            "exam_date": exam.exam_date.isoformat(),
-            "exam_time": exam.exam_time.isoformat(),
-            "room": exam.room,
-            "created_by": exam.created_by,
-            "technician_id": exam.technician_id,
-            "priority": exam.priority or "routine",
-            "contrast": exam.contrast,
-            "pregnancy": exam.pregnancy,
-            "implants": exam.implants,
-            "status": "pending",
-            "created_at": datetime.utcnow().isoformat(),
-        }
-
-        # Derive a combined scheduled_time for convenience/queries
-        try:
-            scheduled_dt = datetime.combine(exam.exam_date, exam.exam_time)
-            exam_data["scheduled_time"] = scheduled_dt.isoformat()
-        except Exception:
-            pass
-
-        result = supabase.table("exams").insert(exam_data).execute()
+        # Returned with the patient embedded, so the created event carries the name too
+        result = await execute(supabase.table("exams").insert(exam_record(exam)).select(exam_select(True)))
 
         if result.data:
-            return result.data[0]
+            created = flatten_embeds(result.data[0])
+            events.exam_created(normalize_exam(created))
+            return created
         else:
             raise HTTPException(status_code=400, detail="Failed to create exam")
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
-@router.get("/", response_model=List[ExamResponse])
+@router.post("/exists", response_model=ExamExistsResult)
+async def check_exams_exist(request: ExamExistsRequest):
+    """
+    Split exam ids into those that exist and those that don't, e.g. before a
+    modality sends a worklist's images. Answers come from the exam-existence
+    cache shared with image ingest; the rest take one query per 100 ids.
+    """
+    try:
+        found = await existing_exam_ids(request.exam_ids)
+        existing, missing = [], []
+        for exam_id in dict.fromkeys(request.exam_ids):
+            try:
+                canonical = str(uuid.UUID(exam_id))
+            except ValueError:
+                canonical = None
+            (existing if canonical in found else missing).append(exam_id)
+        return {"existing": existing, "missing": missing}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+@router.post("/batch", response_model=ExamBatchResult)
+async def schedule_exams(batch: ExamBatchCreate):
+    """
+    Schedule many exams at once. Each exam is checked against existing exams and
+    earlier exams in the batch for room and technician double-bookings; exams
+    without conflicts are inserted in bulk and conflicting ones are reported.
+    If an insert request fails part-way, the exams already created are still
+    returned and the rest are listed in `failed` with the error.
+    """
+    try:
+        starts = [datetime.combine(exam.exam_date, exam.exam_time.replace(tzinfo=None)) for exam in batch.exams]
+        bookings = BookingIndex(batch.slot_minutes)
+
+        # One query for every exam that could collide with the batch
+        first_day = min(starts).date() - timedelta(days=1)
+        last_day = max(starts).date() + timedelta(days=1)
+        existing = await execute(
+            supabase.table("exams")
+            .select("id, room, technician_id, exam_date, exam_time, status")
+            .gte("exam_date", first_day.isoformat())
+            .lte("exam_date", last_day.isoformat())
+        )
+        bookings.add_existing(existing.data)
+
+        accepted = []
+        conflicts = []
+        for index, (exam, start) in enumerate(zip(batch.exams, starts)):
+            found = bookings.book(index, exam.room, exam.technician_id, start)
+            if found:
+                conflicts.append({"index": index, "conflicts": found})
+            else:
+                accepted.append(index)
+
+        if conflicts and batch.all_or_nothing:
+            return {"created": [], "conflicts": conflicts}
+
+        created = []
+        failed = []
+        records = [exam_record(batch.exams[index]) for index in accepted]
+        for i in range(0, len(records), EXAM_BATCH_INSERT_SIZE):
+            try:
+                result = await execute(
+                    supabase.table("exams").insert(records[i:i + EXAM_BATCH_INSERT_SIZE]).select(exam_select(True))
+                )
+            except Exception as e:
+                print(f"Batch insert failed after {len(created)} exam(s): {e}")
+                failed = [{"index": index, "error": str(e)} for index in accepted[i:]]
+                break
+            created.extend(flatten_embeds(row) for row in result.data or [])
+
+        for row in created:
+            events.exam_created(normalize_exam(row))
+        return {"created": created, "conflicts": conflicts, "failed": failed}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+def exam_record(exam: ExamCreate) -> Dict[str, Any]:
+    """Row to insert for a validated ExamCreate"""
+    # Build payload matching the new ExamCreate schema
+    exam_data = {
+        "patient_id": exam.patient_id,
+        "exam_type": exam.exam_type,
+        "body_part": exam.body_part,
+        "ordering_physician": exam.ordering_physician,
+        "clinical_history": exam.clinical_history,
+        "exam_date": exam.exam_date.isoformat(),
+        "exam_time": exam.exam_time.isoformat(),
+        "room": exam.room,
+        "created_by": exam.created_by,
+        "technician_id": exam.technician_id,
+        "priority": exam.priority or "routine",
+        "contrast": exam.contrast,
+        "pregnancy": exam.pregnancy,
+        "implants": exam.implants,
+        "status": "pending",
+        "created_at": datetime.utcnow().isoformat(),
+    }
+
+    # Derive a combined scheduled_time for convenience/queries
+    try:
+        scheduled_dt = datetime.combine(exam.exam_date, exam.exam_time)
+        exam_data["scheduled_time"] = scheduled_dt.isoformat()
+    except Exception:
+        pass
+
+    return exam_data
+
+@router.get("/", response_model=Union[List[ExamResponse], ExamPage])
 async def get_all_exams(
     limit: int = Query(100, description="Limit number of results"),
-    offset: int = Query(0, description="Offset for pagination")
+    offset: int = Query(0, description="Offset for pagination"),
+    paginate: Optional[str] = Query(None, description="Pagination mode: offset (default) or cursor"),
+    cursor: Optional[str] = Query(None, description="Opaque next_cursor from the previous page (implies cursor mode)"),
+    expand: bool = Query(False, description="Embed patient and technician names"),
+    fields: Optional[str] = Query(None, description="Comma separated fields to return")
 ):
-    """Get all exams with pagination"""
+    """Get all exams with pagination (offset, or keyset on created_at/id in cursor mode)"""
+    field_list = parse_fields(fields)
     try:
-        result = (
-            supabase
-            .table("exams")
-            .select("*")
-            .order("created_at", desc=True)
-            .limit(limit)
-            .offset(offset)
-            .execute()
-        )
+        cursor_mode = use_cursor_mode(paginate, cursor)
+        query = supabase.table("exams").select(exam_select(expand, field_list, required=("id", "created_at")))
+        if cursor_mode:
+            query = apply_keyset(query, cursor, limit)
+        else:
+            query = query.order("created_at", desc=True).limit(limit).offset(offset)
+        result = await execute(query)
+
+        rows = result.data
+        next_cursor = None
+        if cursor_mode:
+            rows, next_cursor = split_page(rows, limit)
+
         # Normalize as above to ensure optional fields present
-        normalized = []
-        for e in result.data:
-            item = {
-                **e,
-                "patient_name": e.get("patient_name"),
-                "description": e.get("description") or e.get("clinical_history"),
-                "status": e.get("status") or "pending",
-                "technician_id": e.get("technician_id"),
-                "doctor_id": e.get("doctor_id"),
-                "scheduled_time": e.get("scheduled_time")
-                    or (f"{e['exam_date']}T{e['exam_time']}" if e.get("exam_date") and e.get("exam_time") else None),
-                "notes": e.get("notes"),
-            }
-            normalized.append(item)
+        normalized = [normalize_exam(flatten_embeds(e)) for e in rows]
+
+        if field_list is not None:
+            normalized = project(normalized, field_list)
+            if cursor_mode:
+                return projected_response({"items": normalized, "next_cursor": next_cursor})
+            return projected_response(normalized)
+        if cursor_mode:
+            return {"items": normalized, "next_cursor": next_cursor}
         return normalized
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
@@ -322,7 +473,7 @@ async def get_all_exams(
 async def get_exam(exam_id: str):
     """Get a specific exam by ID"""
     try:
-        result = supabase.table("exams").select("*").eq("id", exam_id).execute()
+        result = await execute(supabase.table("exams").select("*").eq("id", exam_id))
         if not result.data:
             raise HTTPException(status_code=404, detail="Exam not found")
         e = result.data[0]
@@ -369,11 +520,12 @@ async def update_exam(exam_id: str, exam_update: ExamUpdate):
         
         update_data["updated_at"] = datetime.utcnow().isoformat()
             
-        result = supabase.table("exams").update(update_data).eq("id", exam_id).execute()
+        result = await execute(supabase.table("exams").update(update_data).eq("id", exam_id))
         
         if not result.data:
             raise HTTPException(status_code=404, detail="Exam not found")
             
+        events.exam_updated(normalize_exam(result.data[0]))
         return result.data[0]
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
@@ -382,11 +534,13 @@ async def update_exam(exam_id: str, exam_update: ExamUpdate):
 async def delete_exam(exam_id: str):
     """Delete an exam"""
     try:
-        result = supabase.table("exams").delete().eq("id", exam_id).execute()
+        result = await execute(supabase.table("exams").delete().eq("id", exam_id))
         
         if not result.data:
             raise HTTPException(status_code=404, detail="Exam not found")
             
+        exam_cache.invalidate(str(result.data[0]["id"]).lower())
+        events.exam_deleted(exam_id)
         return {"message": "Exam deleted successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
@@ -395,17 +549,25 @@ async def delete_exam(exam_id: str):
 async def get_exams_by_patient(patient_id: str):
     """Get all exams for a specific patient ID"""
     try:
-        result = supabase.table("exams").select("*").eq("patient_id", patient_id).order("created_at", desc=True).execute()
+        result = await execute(supabase.table("exams").select("*").eq("patient_id", patient_id).order("created_at", desc=True))
         return result.data
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
 @router.get("/technician/{technician_id}", response_model=List[ExamResponse])
-async def get_exams_by_technician(technician_id: str):
+async def get_exams_by_technician(
+    technician_id: str,
+    expand: bool = Query(False, description="Embed patient and technician names"),
+    fields: Optional[str] = Query(None, description="Comma separated fields to return")
+):
     """Get all exams by a specific technician"""
+    field_list = parse_fields(fields)
     try:
-        result = supabase.table("exams").select("*").eq("technician_id", technician_id).order("created_at", desc=True).execute()
-        return result.data
+        result = await execute(supabase.table("exams").select(exam_select(expand, field_list)).eq("technician_id", technician_id).order("created_at", desc=True))
+        rows = [flatten_embeds(row) for row in result.data]
+        if field_list is not None:
+            return projected_response(project(rows, field_list))
+        return rows
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
@@ -423,11 +585,12 @@ async def update_exam_status(exam_id: str, status: str):
         if status.lower() == "completed":
             update_data["completed_time"] = datetime.utcnow().isoformat()
         
-        result = supabase.table("exams").update(update_data).eq("id", exam_id).execute()
+        result = await execute(supabase.table("exams").update(update_data).eq("id", exam_id))
         
         if not result.data:
             raise HTTPException(status_code=404, detail="Exam not found")
             
+        events.exam_updated(normalize_exam(result.data[0]))
         return {"message": f"Exam status updated to {status}"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
@@ -439,7 +602,7 @@ async def get_exams_by_time_range(
 ):
     """Get exams within a specific time range"""
     try:
-        result = supabase.table("exams").select("*").gte("scheduled_time", start_datetime).lte("scheduled_time", end_datetime).order("scheduled_time", desc=False).execute()
+        result = await execute(supabase.table("exams").select("*").gte("scheduled_time", start_datetime).lte("scheduled_time", end_datetime).order("scheduled_time", desc=False))
         
         return result.data
     except Exception as e:
@@ -0,0 +1,329 @@
+"""
+Store-and-forward queue for the TCP ingest server
+With TCP_STORE_AND_FORWARD on, a received image is acknowledged as soon as it is
+durable in TCP_FORWARD_DIR rather than after the Supabase upload, so modalities
+neither wait on nor fail because of cloud latency. Each entry is a data file
+plus a JSON manifest written after it: the manifest is the write-ahead record,
+and an image is only acknowledged once both are on disk. A drainer uploads
+entries with bounded concurrency, retries failures with exponential backoff and
+removes an entry once it is stored (and its derivatives made: an image already
+stored is remembered in the manifest, so a retry only redoes the derivatives).
+An entry whose data file is gone or unreadable is moved aside like one Supabase
+refuses. Entries found on disk at startup are queued
+again, so an acknowledged image survives restarts and crashes; uploading one
+twice is harmless because images are stored content-addressed.
+"""
+
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    from .image_store import SpooledPayload, UploadRejected
+    from . import metrics
+except ImportError:
+    from image_store import SpooledPayload, UploadRejected
+    import metrics
+
+STORE_AND_FORWARD = os.getenv("TCP_STORE_AND_FORWARD", "false").lower() in ("1", "true", "yes")
+# Should survive reboots in production; the temp directory default suits development only
+FORWARD_DIR = os.getenv("TCP_FORWARD_DIR") or os.path.join(tempfile.gettempdir(), "ezrad-forward")
+# Uploads to Supabase running at once
+FORWARD_WORKERS = int(os.getenv("TCP_FORWARD_WORKERS", "4"))
+# Backoff after a failed upload: TCP_FORWARD_RETRY_DELAY * 2^(attempts - 1), capped
+FORWARD_RETRY_DELAY = float(os.getenv("TCP_FORWARD_RETRY_DELAY", "2"))
+FORWARD_RETRY_MAX_DELAY = float(os.getenv("TCP_FORWARD_RETRY_MAX_DELAY", "300"))
+
+# Entries that can never be stored are moved here for inspection
+REJECTED_SUBDIR = "rejected"
+
+forward_uploads_total = metrics.registry.register(metrics.Counter(
+    "ezrad_tcp_forward_uploads_total", "Store-and-forward upload attempts by outcome", ("outcome",)))
+
+
+def _fsync_dir(directory: str):
+    """Make renames and new files in `directory` durable (not possible on Windows)."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class ForwardEntry:
+    """Manifest of one queued image."""
+
+    def __init__(self, entry_id: str, exam_id: str, file_ext: str, size: int, sha256: str,
+                 received_at: Optional[float] = None, attempts: int = 0, last_error: Optional[str] = None,
+                 image_path: Optional[str] = None):
+        self.id = entry_id
+        self.exam_id = exam_id
+        self.file_ext = file_ext
+        self.size = size
+        self.sha256 = sha256
+        self.received_at = received_at or time.time()
+        self.attempts = attempts
+        self.last_error = last_error
+        # Set once the image is stored but after_store still has to succeed
+        self.image_path = image_path
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "id": self.id, "exam_id": self.exam_id, "file_ext": self.file_ext, "size": self.size,
+            "sha256": self.sha256, "received_at": self.received_at,
+            "attempts": self.attempts, "last_error": self.last_error, "image_path": self.image_path,
+        }
+
+
+class ForwardQueue:
+    """
+    Durable queue drained into Supabase. `store(exam_id, file_ext, payload)`
+    uploads one image and returns an object with `image_path` and `created`,
+    raising UploadRejected when retrying can't help; `after_store(image_path,
+    payload)` runs for newly created images (derivatives).
+    """
+
+    def __init__(self, store: Callable, after_store: Optional[Callable] = None, directory: str = FORWARD_DIR,
+                 workers: int = FORWARD_WORKERS):
+        self.store = store
+        self.after_store = after_store
+        self.directory = directory
+        self.workers = workers
+        self.in_flight = 0
+        self.forwarded = 0
+        self.rejected = 0
+        self.retries = 0
+        self._entries: Dict[str, ForwardEntry] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        self._retry_handles: Dict[str, asyncio.TimerHandle] = {}
+
+    def _path(self, entry_id: str, suffix: str) -> str:
+        return os.path.join(self.directory, entry_id + suffix)
+
+    async def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ezrad-forward")
+        recovered = await asyncio.get_running_loop().run_in_executor(self._executor, self._recover)
+        for entry in recovered:
+            self._entries[entry.id] = entry
+            self._queue.put_nowait(entry)
+        if recovered:
+            print(f"Store-and-forward: recovered {len(recovered)} queued image(s) from {self.directory}")
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Stop draining. Anything not yet stored stays on disk for the next start."""
+        for handle in self._retry_handles.values():
+            handle.cancel()
+        self._retry_handles.clear()
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def adopt(self, directory: str) -> int:
+        """
+        Move the entries of another queue's directory (one no process drains any
+        more) into this one, before start(). Returns the number of manifests moved.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        moved = 0
+        for subdir in (REJECTED_SUBDIR, ""):
+            source = os.path.join(directory, subdir)
+            if not os.path.isdir(source):
+                continue
+            target = os.path.join(self.directory, subdir)
+            os.makedirs(target, exist_ok=True)
+            # Data files before manifests, so every manifest that arrives has its data
+            names = sorted(os.listdir(source), key=lambda name: name.endswith(".json"))
+            for name in names:
+                if not name.endswith((".data", ".json")):
+                    continue
+                os.replace(os.path.join(source, name), os.path.join(target, name))
+                if not subdir and name.endswith(".json"):
+                    moved += 1
+            _fsync_dir(target)
+        shutil.rmtree(directory, ignore_errors=True)
+        return moved
+
+    def _recover(self) -> List[ForwardEntry]:
+        """Entries whose manifest made it to disk, oldest first. Data without a manifest was never acked."""
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tmp"):
+                os.remove(path)
+                continue
+            if name.endswith(".data") and not os.path.exists(path[:-len(".data")] + ".json"):
+                os.remove(path)
+                continue
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(path) as f:
+                    entry = ForwardEntry(**{("entry_id" if k == "id" else k): v for k, v in json.load(f).items()})
+            except (OSError, ValueError, TypeError) as e:
+                print(f"Store-and-forward: skipping unreadable manifest {name}: {e}")
+                continue
+            if not os.path.exists(self._path(entry.id, ".data")):
+                print(f"Store-and-forward: manifest {name} has no data file; dropping it")
+                os.remove(path)
+                continue
+            entries.append(entry)
+        entries.sort(key=lambda entry: entry.received_at)
+        return entries
+
+    def _write_manifest(self, entry: ForwardEntry):
+        manifest_path = self._path(entry.id, ".json")
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(entry.to_json(), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(manifest_path + ".tmp", manifest_path)
+        _fsync_dir(self.directory)
+
+    def _write_entry(self, exam_id: str, file_ext: str, payload: SpooledPayload) -> ForwardEntry:
+        entry = ForwardEntry(uuid.uuid4().hex, exam_id, file_ext, payload.size, payload.digest)
+        # Data first, then the manifest: a manifest on disk always has its complete data file
+        payload.save_to(self._path(entry.id, ".data"))
+        self._write_manifest(entry)
+        return entry
+
+    async def put(self, exam_id: str, file_ext: str, payload: SpooledPayload) -> bool:
+        """
+        Make an image durable and queue it; True once it may be acknowledged. The
+        caller closes the payload. Raises UploadRejected for a malformed exam id.
+        """
+        try:
+            uuid.UUID(exam_id)
+        except ValueError:
+            # Checked before the ack; whether the exam exists needs Supabase, so that waits for the drainer
+            raise UploadRejected(f"Invalid UUID format for exam_id: {exam_id}")
+        try:
+            entry = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._write_entry, exam_id, file_ext, payload)
+        except OSError as e:
+            print(f"Store-and-forward: could not queue image for exam {exam_id}: {e}")
+            return False
+        self._entries[entry.id] = entry
+        self._queue.put_nowait(entry)
+        return True
+
+    def _forward(self, entry: ForwardEntry) -> str:
+        """Upload one entry (on a drainer thread); returns the outcome."""
+        try:
+            payload = SpooledPayload.from_file(self._path(entry.id, ".data"))
+        except OSError as e:
+            # Retrying can't bring the bytes back
+            raise UploadRejected(f"Data file missing or unreadable: {e}")
+        outcome = "stored"
+        if entry.image_path is None:
+            stored = self.store(entry.exam_id, entry.file_ext, payload)
+            if not stored.created:
+                outcome = "duplicate"
+            elif self.after_store is not None:
+                # Recorded before after_store runs, so a retry makes the derivatives without storing again
+                entry.image_path = stored.image_path
+                self._write_manifest(entry)
+        if entry.image_path is not None:
+            self.after_store(entry.image_path, payload)
+        # Manifest first: a crash in between leaves a data file that recovery discards
+        os.remove(self._path(entry.id, ".json"))
+        payload.close()
+        return outcome
+
+    def _reject(self, entry: ForwardEntry, reason: str):
+        entry.last_error = reason
+        rejected_dir = os.path.join(self.directory, REJECTED_SUBDIR)
+        os.makedirs(rejected_dir, exist_ok=True)
+        if os.path.exists(self._path(entry.id, ".data")):
+            shutil.move(self._path(entry.id, ".data"), os.path.join(rejected_dir, entry.id + ".data"))
+        self._write_manifest(entry)
+        shutil.move(self._path(entry.id, ".json"), os.path.join(rejected_dir, entry.id + ".json"))
+
+    def _retry_later(self, entry: ForwardEntry):
+        delay = min(FORWARD_RETRY_MAX_DELAY, FORWARD_RETRY_DELAY * 2 ** (entry.attempts - 1))
+        print(f"Store-and-forward: upload of {entry.id} failed ({entry.last_error}); "
+              f"attempt {entry.attempts}, retrying in {delay:.0f}s")
+
+        def requeue():
+            self._retry_handles.pop(entry.id, None)
+            self._queue.put_nowait(entry)
+
+        self._retry_handles[entry.id] = asyncio.get_running_loop().call_later(delay, requeue)
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            entry = await self._queue.get()
+            self.in_flight += 1
+            try:
+                outcome = await loop.run_in_executor(self._executor, self._forward, entry)
+                self.forwarded += 1
+                self._entries.pop(entry.id, None)
+            except UploadRejected as e:
+                print(f"Store-and-forward: rejecting {entry.id}: {e}")
+                outcome = "rejected"
+                self.rejected += 1
+                self._entries.pop(entry.id, None)
+                try:
+                    await loop.run_in_executor(self._executor, self._reject, entry, str(e))
+                except OSError as move_error:
+                    print(f"Store-and-forward: could not move {entry.id} aside: {move_error}")
+            except Exception as e:
+                outcome = "retry"
+                self.retries += 1
+                entry.attempts += 1
+                entry.last_error = str(e)
+                try:
+                    # Keeps the attempt count across restarts
+                    await loop.run_in_executor(self._executor, self._write_manifest, entry)
+                except OSError:
+                    pass
+                self._retry_later(entry)
+            finally:
+                self.in_flight -= 1
+                self._queue.task_done()
+            forward_uploads_total.inc(outcome=outcome)
+
+    @property
+    def depth(self) -> int:
+        """Acknowledged images not yet stored (queued, uploading or waiting to retry)."""
+        return len(self._entries)
+
+    def oldest_age(self) -> float:
+        """Seconds the oldest image not yet stored has been waiting."""
+        if not self._entries:
+            return 0.0
+        return time.time() - min(entry.received_at for entry in self._entries.values())
+
+    def stats(self) -> dict:
+        return {
+            "enabled": True,
+            "directory": self.directory,
+            "workers": self.workers,
+            "pending": self.depth,
+            "waiting_to_retry": len(self._retry_handles),
+            "in_flight": self.in_flight,
+            "forwarded": self.forwarded,
+            "rejected": self.rejected,
+            "retries": self.retries,
+            "oldest_age_seconds": round(self.oldest_age(), 1),
+        }
@@ -0,0 +1,248 @@
+"""
+Thumbnail and preview derivatives for exam images
+Each uploaded JPEG, PNG, BMP, GIF or DICOM image gets two downscaled JPEGs
+stored next to the original in the exam-images bucket:
+
+    <exam_id>/<sha256>.dcm             original (content-addressed, see image_store)
+    <exam_id>/<sha256>.thumb.jpg       THUMBNAIL_SIZE px on the long edge
+    <exam_id>/<sha256>.preview.jpg     PREVIEW_SIZE px on the long edge
+
+Derivative paths follow from the original's path, so the listing needs no
+extra columns. Uncompressed DICOM is decoded with pydicom and Pillow alone;
+compressed transfer syntaxes also need numpy (and pydicom's pixel handlers).
+Generation is best effort: an image that can't be decoded simply has none.
+"""
+
+import io
+import os
+from typing import Dict, Optional, Union
+
+from PIL import Image, ImageOps
+
+try:
+    import pydicom
+except ImportError:
+    pydicom = None
+
+try:
+    from .supabase_client import exam_images_bucket, observe_call
+    from .image_store import SpooledPayload
+    from .dicom_headers import is_dicom
+    from .signed_urls import forget_missing
+    from . import metrics
+except ImportError:
+    from supabase_client import exam_images_bucket, observe_call
+    from image_store import SpooledPayload
+    from dicom_headers import is_dicom
+    from signed_urls import forget_missing
+    import metrics
+
+# Long edge of each derivative, in pixels
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "256"))
+PREVIEW_SIZE = int(os.getenv("PREVIEW_SIZE", "1024"))
+DERIVATIVE_JPEG_QUALITY = int(os.getenv("DERIVATIVE_JPEG_QUALITY", "80"))
+# Originals larger than this are not decoded (multi-frame studies can be huge)
+DERIVATIVE_MAX_SOURCE_SIZE = int(os.getenv("DERIVATIVE_MAX_SOURCE_SIZE", str(512 * 1024 * 1024)))
+# Derivatives never change once written, so browsers may keep them for a day
+DERIVATIVE_CACHE_CONTROL = os.getenv("DERIVATIVE_CACHE_CONTROL", "86400")
+
+# Largest first, so the smaller one can be made from it
+DERIVATIVES = (("preview", PREVIEW_SIZE), ("thumbnail", THUMBNAIL_SIZE))
+SUFFIXES = {"preview": ".preview.jpg", "thumbnail": ".thumb.jpg"}
+
+RASTER_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".gif"}
+# Modalities often send DICOM files without an extension
+DICOM_EXTENSIONS = {".dcm", ".dicom", ""}
+
+derivatives_total = metrics.registry.register(metrics.Counter(
+    "ezrad_image_derivatives_total", "Thumbnail/preview generation by outcome", ("outcome",)))
+
+
+class UnsupportedImageError(Exception):
+    """Raised when an original can't be decoded into a derivative."""
+
+
+def derivative_paths(image_path: str) -> Dict[str, str]:
+    """Derivative storage paths for an original, or {} for file types without derivatives."""
+    base, ext = os.path.splitext(image_path)
+    if ext.lower() not in RASTER_EXTENSIONS | DICOM_EXTENSIONS:
+        return {}
+    return {kind: base + suffix for kind, suffix in SUFFIXES.items()}
+
+
+def _to_8bit(image: Image.Image, low: Optional[float] = None, high: Optional[float] = None) -> Image.Image:
+    """Linearly map a 16/32-bit or float greyscale image onto 0-255 (the extrema unless a window is given)."""
+    if image.mode != "I":
+        image = image.convert("I")
+    if low is None or high is None:
+        low, high = image.getextrema()
+    if high <= low:
+        high = low + 1
+    scale = 255.0 / (high - low)
+    offset = -low * scale
+    return image.point(lambda v: v * scale + offset).convert("L")
+
+
+def _dicom_window(ds) -> tuple:
+    """VOI window in stored pixel values, or (None, None) to use the frame's extrema."""
+    center, width = ds.get("WindowCenter"), ds.get("WindowWidth")
+    if center is None or width is None:
+        return None, None
+    if isinstance(center, pydicom.multival.MultiValue):
+        center = center[0]
+    if isinstance(width, pydicom.multival.MultiValue):
+        width = width[0]
+    slope = float(ds.get("RescaleSlope", 1) or 1)
+    intercept = float(ds.get("RescaleIntercept", 0) or 0)
+    low = (float(center) - float(width) / 2 - intercept) / slope
+    high = (float(center) + float(width) / 2 - intercept) / slope
+    return min(low, high), max(low, high)
+
+
+def _open_dicom(source) -> Image.Image:
+    """First frame of a DICOM image as an 8-bit L or RGB image."""
+    if pydicom is None:
+        raise UnsupportedImageError("pydicom is not installed")
+    ds = pydicom.dcmread(source, force=True)
+    if "PixelData" not in ds:
+        raise UnsupportedImageError("DICOM object has no pixel data")
+
+    rows, columns = int(ds.Rows), int(ds.Columns)
+    samples = int(ds.get("SamplesPerPixel", 1))
+    bits = int(ds.BitsAllocated)
+    signed = int(ds.get("PixelRepresentation", 0)) == 1
+    photometric = str(ds.get("PhotometricInterpretation", "MONOCHROME2")).upper()
+    transfer_syntax = getattr(getattr(ds, "file_meta", None), "TransferSyntaxUID", None)
+
+    if transfer_syntax is not None and transfer_syntax.is_compressed:
+        # Encapsulated pixel data needs pydicom's decoders, which need numpy
+        try:
+            array = ds.pixel_array
+        except Exception as e:
+            raise UnsupportedImageError(f"Cannot decode {transfer_syntax.name}: {e}")
+        if int(ds.get("NumberOfFrames", 1) or 1) > 1:
+            array = array[0]
+        image = Image.fromarray(array)
+    else:
+        big_endian = transfer_syntax is not None and not transfer_syntax.is_little_endian
+        frame_size = rows * columns * samples * (bits // 8)
+        data = ds.PixelData[:frame_size]
+        if len(data) < frame_size:
+            raise UnsupportedImageError("Truncated DICOM pixel data")
+        if samples == 3 and bits == 8:
+            mode = "YCbCr" if photometric.startswith("YBR") else "RGB"
+            if int(ds.get("PlanarConfiguration", 0)) == 1:
+                plane = rows * columns
+                image = Image.merge(mode, [
+                    Image.frombytes("L", (columns, rows), data[i * plane:(i + 1) * plane]) for i in range(3)
+                ])
+            else:
+                image = Image.frombytes(mode, (columns, rows), data)
+        elif samples == 1 and bits == 8:
+            image = Image.frombytes("L", (columns, rows), data)
+        elif samples == 1 and bits in (16, 32):
+            raw_mode = f"I;{bits}{'B' if big_endian else ''}{'S' if signed else ''}"
+            image = Image.frombytes("I", (columns, rows), data, "raw", raw_mode)
+        else:
+            raise UnsupportedImageError(f"Unsupported DICOM pixel format ({samples} x {bits}-bit)")
+
+    if image.mode not in ("L", "RGB", "YCbCr"):
+        image = _to_8bit(image, *_dicom_window(ds))
+    if photometric == "MONOCHROME1":
+        image = ImageOps.invert(image.convert("L"))
+    return image
+
+
+def _open_raster(source, size_hint: int) -> Image.Image:
+    image = Image.open(source)
+    # JPEG can decode straight to a reduced scale, which is far cheaper than a full decode
+    image.draft("RGB" if image.mode not in ("L", "1") else "L", (size_hint, size_hint))
+    if getattr(image, "is_animated", False):
+        image.seek(0)
+    if image.mode in ("I", "I;16", "I;16B", "F"):
+        return _to_8bit(image)
+    if image.mode in ("RGBA", "LA", "P") and ("A" in image.mode or "transparency" in image.info):
+        # Flatten transparency onto white rather than JPEG's implicit black
+        rgba = image.convert("RGBA")
+        background = Image.new("RGB", rgba.size, "white")
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        return background
+    return image
+
+
+def open_image(source: Union[bytes, str], file_ext: str) -> Image.Image:
+    """Decode an original (bytes or a file path) into an L or RGB image."""
+    if isinstance(source, bytes):
+        head = source[:132]
+        source = io.BytesIO(source)
+    else:
+        with open(source, "rb") as f:
+            head = f.read(132)
+
+    ext = file_ext.lower()
+    if is_dicom(head) or (ext in DICOM_EXTENSIONS and ext):
+        image = _open_dicom(source)
+    elif ext in RASTER_EXTENSIONS or not ext:
+        image = _open_raster(source, PREVIEW_SIZE)
+    else:
+        raise UnsupportedImageError(f"No derivatives for {ext} files")
+    if image.mode not in ("L", "RGB"):
+        image = image.convert("RGB")
+    return image
+
+
+def render_derivatives(image: Image.Image) -> Dict[str, bytes]:
+    """JPEG bytes of each derivative, by kind."""
+    rendered = {}
+    for kind, size in DERIVATIVES:
+        # In place: each smaller derivative is made from the previous one
+        image.thumbnail((size, size), Image.Resampling.LANCZOS, reducing_gap=3.0)
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=DERIVATIVE_JPEG_QUALITY, optimize=True)
+        rendered[kind] = buffer.getvalue()
+    return rendered
+
+
+def create_derivatives(image_path: str, image_data: Union[bytes, SpooledPayload]) -> Dict[str, str]:
+    """
+    Render and upload the thumbnail and preview of an uploaded original (blocking).
+    Returns the stored derivative paths by kind; {} when the image has none.
+    Never raises: a missing derivative must not fail the upload it belongs to.
+    """
+    paths = derivative_paths(image_path)
+    if not paths:
+        derivatives_total.inc(outcome="unsupported")
+        return {}
+    source = image_data.upload_source() if isinstance(image_data, SpooledPayload) else image_data
+    size = image_data.size if isinstance(image_data, SpooledPayload) else len(image_data)
+    if size > DERIVATIVE_MAX_SOURCE_SIZE:
+        derivatives_total.inc(outcome="unsupported")
+        return {}
+
+    try:
+        rendered = render_derivatives(open_image(source, os.path.splitext(image_path)[1]))
+    except (UnsupportedImageError, OSError, ValueError, Image.DecompressionBombError) as e:
+        print(f"No derivatives for {image_path}: {e}")
+        derivatives_total.inc(outcome="unsupported")
+        return {}
+    except Exception as e:
+        print(f"Failed to render derivatives for {image_path}: {e}")
+        derivatives_total.inc(outcome="failed")
+        return {}
+
+    stored = {}
+    bucket = exam_images_bucket()
+    for kind, data in rendered.items():
+        try:
+            with observe_call("storage:upload"):
+                bucket.upload(paths[kind], data, {
+                    "content-type": "image/jpeg", "cache-control": DERIVATIVE_CACHE_CONTROL, "upsert": "true",
+                })
+            stored[kind] = paths[kind]
+        except Exception as e:
+            print(f"Failed to upload {kind} for {image_path}: {e}")
+    if stored:
+        # A listing may have found them missing in the meantime
+        forget_missing(stored.values())
+    derivatives_total.inc(outcome="created" if len(stored) == len(rendered) else "failed")
+    return stored
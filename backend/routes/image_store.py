@@ -0,0 +1,301 @@
+"""
+Exam image storage shared by the HTTP upload routes and the TCP ingest server
+Bodies are received into a SpooledPayload (memory for small images, a temporary
+file for large ones) and uploaded to the exam-images bucket from there, so no
+upload path needs to hold a whole study in memory.
+
+Images are content-addressed: a body is hashed as it arrives and stored at
+<exam_id>/<sha256><ext>, so re-sending the same bytes for an exam reuses the
+existing object and exam_images row instead of storing a copy.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import uuid
+from typing import Any, Dict, Iterable, List, Optional, Set, Union
+
+from fastapi import UploadFile
+
+try:
+    from .supabase_client import supabase, execute, execute_sync, exam_images_bucket, observe_call, storage_upload_succeeded
+    from . import dicom_headers
+    from .entity_cache import exam_cache, EXAM_CACHE_NEGATIVE_TTL
+except ImportError:
+    from supabase_client import supabase, execute, execute_sync, exam_images_bucket, observe_call, storage_upload_succeeded
+    import dicom_headers
+    from entity_cache import exam_cache, EXAM_CACHE_NEGATIVE_TTL
+
+# Bodies up to this size stay in memory; anything larger is spooled to a temporary file.
+# (The TCP_ names date from when only the ingest server spooled uploads.)
+SPOOL_MEMORY_LIMIT = int(os.getenv("TCP_SPOOL_MEMORY_LIMIT", str(8 * 1024 * 1024)))
+# Directory for spooled bodies (defaults to the system temp directory).
+SPOOL_DIR = os.getenv("TCP_SPOOL_DIR") or None
+# Size of each read while copying an HTTP upload into a spool.
+UPLOAD_READ_CHUNK_SIZE = 1024 * 1024
+
+# Exam ids per existence query (the in.() filter goes in the URL)
+EXAM_LOOKUP_BATCH_SIZE = 100
+
+# Flipped to False when exam_images has no (exam_id, image_path) unique index (migration 005 not applied)
+dedupe_index_available = True
+
+
+class StorageUploadError(Exception):
+    """Raised when the storage bucket rejects an upload."""
+
+
+class UploadRejected(Exception):
+    """Raised for uploads that can never be stored (malformed exam id, unknown exam); retrying won't help."""
+
+
+class SpooledPayload:
+    """
+    Image body received in bounded chunks and hashed as it arrives.
+    Small bodies are kept in memory, large ones are written to a temporary file
+    so that the storage upload can stream them from disk.
+    """
+
+    def __init__(self, memory_limit: int = SPOOL_MEMORY_LIMIT):
+        self.memory_limit = memory_limit
+        self.size = 0
+        self.path: Optional[str] = None
+        self._buffer = bytearray()
+        self._file = None
+        self._sha256 = hashlib.sha256()
+
+    def write(self, chunk: bytes):
+        """Append a chunk, spilling to disk once the memory limit is exceeded."""
+        if self._file is None and self.size + len(chunk) > self.memory_limit:
+            self._file = tempfile.NamedTemporaryFile(prefix="ezrad-ingest-", dir=SPOOL_DIR, delete=False)
+            self.path = self._file.name
+            self._file.write(self._buffer)
+            self._buffer = bytearray()
+        if self._file is not None:
+            self._file.write(chunk)
+        else:
+            self._buffer += chunk
+        self._sha256.update(chunk)
+        self.size += len(chunk)
+
+    @classmethod
+    def from_file(cls, path: str) -> "SpooledPayload":
+        """
+        Adopt a complete file (such as a committed resumable upload) as a spooled
+        payload, hashing it once. The file is removed on close().
+        """
+        payload = cls()
+        payload._file = open(path, "rb")
+        try:
+            while True:
+                chunk = payload._file.read(UPLOAD_READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                payload._sha256.update(chunk)
+                payload.size += len(chunk)
+        finally:
+            payload._file.close()
+        payload.path = path
+        return payload
+
+    def save_to(self, dest: str):
+        """
+        Durably copy the body to `dest` (flushed to disk before returning). A spool
+        file is hard-linked where possible, so large bodies aren't copied twice.
+        """
+        self.finish()
+        if self.path is not None:
+            try:
+                os.link(self.path, dest)
+            except OSError:
+                shutil.copyfile(self.path, dest)
+            with open(dest, "rb+") as f:
+                os.fsync(f.fileno())
+            return
+        with open(dest, "wb") as f:
+            f.write(self._buffer)
+            f.flush()
+            os.fsync(f.fileno())
+
+    @property
+    def digest(self) -> str:
+        """Hex SHA-256 of everything written so far."""
+        return self._sha256.hexdigest()
+
+    def finish(self):
+        """Flush and close the spool file so it can be reopened for upload."""
+        if self._file is not None and not self._file.closed:
+            self._file.close()
+
+    def upload_source(self) -> Union[bytes, str]:
+        """Return what the storage client should upload: raw bytes, or a file path it streams from."""
+        self.finish()
+        if self.path is not None:
+            return self.path
+        return bytes(self._buffer)
+
+    def close(self):
+        """Release the in-memory buffer and remove any spool file."""
+        self.finish()
+        self._buffer = bytearray()
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+
+# --- Exam existence (shared by both ingest paths) ---
+def _normalized_exam_ids(exam_ids: Iterable[str]) -> List[str]:
+    """Distinct, canonical (lowercase) ids; malformed ones can't exist and are dropped."""
+    normalized = {}
+    for exam_id in exam_ids:
+        try:
+            normalized[str(uuid.UUID(exam_id))] = None
+        except (TypeError, ValueError, AttributeError):
+            continue
+    return list(normalized)
+
+
+def _exam_ids_query(exam_ids: List[str]):
+    return supabase.table("exams").select("id").in_("id", exam_ids)
+
+
+def _remember_exams(exam_ids: List[str], found: Set[str], generation: int):
+    for exam_id in exam_ids:
+        exists = exam_id in found
+        exam_cache.put(exam_id, exists, generation, ttl=None if exists else EXAM_CACHE_NEGATIVE_TTL)
+
+
+async def existing_exam_ids(exam_ids: Iterable[str]) -> Set[str]:
+    """
+    The (canonical) ids in `exam_ids` that belong to an exam. Answers come from
+    exam_cache where possible; the rest are checked with one query per
+    EXAM_LOOKUP_BATCH_SIZE ids.
+    """
+    cached, misses = exam_cache.lookup(_normalized_exam_ids(exam_ids))
+    found = {exam_id for exam_id, exists in cached.items() if exists}
+    generation = exam_cache.generation
+    for i in range(0, len(misses), EXAM_LOOKUP_BATCH_SIZE):
+        batch = misses[i:i + EXAM_LOOKUP_BATCH_SIZE]
+        result = await execute(_exam_ids_query(batch))
+        batch_found = {row["id"] for row in result.data or []}
+        _remember_exams(batch, batch_found, generation)
+        found |= batch_found
+    return found
+
+
+def existing_exam_ids_sync(exam_ids: Iterable[str]) -> Set[str]:
+    """existing_exam_ids for worker threads (TCP ingest)."""
+    cached, misses = exam_cache.lookup(_normalized_exam_ids(exam_ids))
+    found = {exam_id for exam_id, exists in cached.items() if exists}
+    generation = exam_cache.generation
+    for i in range(0, len(misses), EXAM_LOOKUP_BATCH_SIZE):
+        batch = misses[i:i + EXAM_LOOKUP_BATCH_SIZE]
+        result = execute_sync(_exam_ids_query(batch))
+        batch_found = {row["id"] for row in result.data or []}
+        _remember_exams(batch, batch_found, generation)
+        found |= batch_found
+    return found
+
+
+async def exam_exists(exam_id: str) -> bool:
+    return bool(await existing_exam_ids([exam_id]))
+
+
+def exam_exists_sync(exam_id: str) -> bool:
+    return bool(existing_exam_ids_sync([exam_id]))
+
+
+async def spool_upload_file(file: UploadFile, memory_limit: int = SPOOL_MEMORY_LIMIT) -> SpooledPayload:
+    """Copy a multipart UploadFile into a SpooledPayload in bounded chunks, hashing it on the way."""
+    payload = SpooledPayload(memory_limit)
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            payload.write(chunk)
+        payload.finish()
+    except BaseException:
+        payload.close()
+        raise
+    return payload
+
+
+def content_image_path(exam_id: str, digest: str, file_ext: str) -> str:
+    """Storage path of an image of `exam_id` whose content hashes to `digest`."""
+    return f"{exam_id}/{digest}{file_ext.lower()}"
+
+
+def upload_image(storage_path: str, image_data: Union[bytes, SpooledPayload]):
+    """Upload bytes or a spooled payload to the exam-images bucket (blocking)."""
+    source = image_data.upload_source() if isinstance(image_data, SpooledPayload) else image_data
+    # The path is the content hash, so overwriting an object left by an earlier failed attempt is harmless
+    with observe_call("storage:upload"):
+        storage_response = exam_images_bucket().upload(storage_path, source, {"upsert": "true"})
+    if not storage_upload_succeeded(storage_response):
+        raise StorageUploadError(getattr(storage_response, "text", "Error uploading file to storage."))
+
+
+# --- exam_images rows ---------------------------------------------------------
+# Rows come from dicom_headers.image_row(). With the unique index from migration 005
+# an insert skips rows another request stored first; without it (or without the
+# header columns from 004) the insert is retried in the older form.
+def _image_rows_query(rows: List[Dict[str, Any]]):
+    if not dicom_headers.header_columns_available:
+        rows = dicom_headers.without_headers(rows)
+    table = supabase.table("exam_images")
+    if dedupe_index_available:
+        return table.upsert(rows, on_conflict="exam_id,image_path", ignore_duplicates=True)
+    return table.insert(rows)
+
+
+def _retry_insert_after(error: Exception) -> bool:
+    """True when `error` came from a missing migration and the insert should be retried without it."""
+    global dedupe_index_available
+    if dicom_headers.header_columns_missing(error):
+        return True
+    # 42P10: no unique index matches the ON CONFLICT columns
+    if getattr(error, "code", None) == "42P10" and dedupe_index_available:
+        print(f"exam_images has no (exam_id, image_path) unique index (apply migrations/005_image_dedupe.sql): {error}")
+        dedupe_index_available = False
+        return True
+    return False
+
+
+async def insert_image_rows(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Insert exam_images rows in one request; returns the rows stored (duplicates are skipped)."""
+    while True:
+        try:
+            return (await execute(_image_rows_query(rows))).data or []
+        except Exception as e:
+            if not _retry_insert_after(e):
+                raise
+
+
+def insert_image_rows_sync(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """insert_image_rows() for ingest worker threads."""
+    while True:
+        try:
+            return execute_sync(_image_rows_query(rows)).data or []
+        except Exception as e:
+            if not _retry_insert_after(e):
+                raise
+
+
+async def existing_image_rows(exam_id: str, image_paths: List[str]) -> Dict[str, Dict[str, Any]]:
+    """exam_images rows of `exam_id` already stored at any of `image_paths`, by path."""
+    result = await execute(
+        supabase.table("exam_images").select("*").eq("exam_id", exam_id).in_("image_path", image_paths)
+    )
+    return {row["image_path"]: row for row in result.data or []}
+
+
+def existing_image_row_sync(exam_id: str, image_path: str) -> Optional[Dict[str, Any]]:
+    result = execute_sync(
+        supabase.table("exam_images").select("*").eq("exam_id", exam_id).eq("image_path", image_path).limit(1)
+    )
+    return result.data[0] if result.data else None
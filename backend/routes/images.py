@@ -3,30 +3,32 @@ Exam Images Routes
 Uploads and manages exam-related images linked to an exam (and indirectly to a patient)
 """
 
-from fastapi import APIRouter, HTTPException, File, Form, UploadFile
+from fastapi import APIRouter, BackgroundTasks, HTTPException, File, Form, Query, Request, UploadFile
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Optional, List, Dict, Any, Tuple
 from datetime import datetime
+import asyncio
 import os
 import uuid
-from supabase import create_client, Client
-from dotenv import load_dotenv
-import json # Import the json library for safe parsing
-
-# Load environment variables
-load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), "..", ".env"))
-
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-
-if not SUPABASE_URL or not SUPABASE_KEY:
-    raise ValueError("Missing SUPABASE_URL or SUPABASE_KEY in environment!")
-
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+from .supabase_client import supabase, execute, run_blocking
+from .signed_urls import get_signed_urls
+from .image_store import (
+    SpooledPayload, StorageUploadError, UPLOAD_READ_CHUNK_SIZE, spool_upload_file, content_image_path,
+    upload_image, insert_image_rows, existing_image_rows, exam_exists,
+)
+from .image_derivatives import create_derivatives, derivative_paths
+from .dicom_headers import HEADER_COLUMNS, read_dicom_header, image_row
+from .upload_sessions import (
+    UploadSessionError, UploadSessionComplete, UploadSessionIncomplete, UploadSessionNotFound, upload_sessions,
+)
+from . import events
 
 # Create router
 router = APIRouter()
 
+# Files of one bulk request uploaded to storage at the same time
+IMAGE_UPLOAD_CONCURRENCY = int(os.getenv("IMAGE_UPLOAD_CONCURRENCY", "4"))
+
 # Pydantic models
 class ExamImageResponse(BaseModel):
     id: str
@@ -38,17 +40,43 @@ class ExamImageResponse(BaseModel):
     class Config:
         json_encoders = {datetime: lambda v: v.isoformat()}
 
+class DicomImageResponse(ExamImageResponse):
+    study_instance_uid: Optional[str] = None
+    series_instance_uid: Optional[str] = None
+    sop_instance_uid: Optional[str] = None
+    modality: Optional[str] = None
+    body_part_examined: Optional[str] = None
+    acquisition_datetime: Optional[datetime] = None
+
+class ExamImageBatchResponse(BaseModel):
+    exam_id: str
+    images: List[DicomImageResponse]
+    failed: List[Dict[str, Any]]
+    duplicates: List[Dict[str, Any]] = []
+
+class UploadSessionCreate(BaseModel):
+    exam_id: str
+    filename: str
+    size: int
+    # Optional hex SHA-256 of the whole file, checked when the upload completes
+    sha256: Optional[str] = None
+
 class ImageDescriptionUpdate(BaseModel):
     image_path: str
     description: str
 
 
-@router.post("/", response_model=ExamImageResponse)
+@router.post("/", response_model=DicomImageResponse)
 async def upload_exam_image(
+    background_tasks: BackgroundTasks,
     exam_id: str = Form(...),
     file: UploadFile = File(...)
 ):
-    """Upload an image linked to a specific exam"""
+    """
+    Upload an image linked to a specific exam. Images are stored under their
+    content hash, so uploading the same bytes again returns the existing record.
+    Thumbnail and preview are made after the response.
+    """
     try:
         # Validate UUID format
         try:
@@ -57,59 +85,345 @@ async def upload_exam_image(
             raise HTTPException(status_code=400, detail="Invalid UUID format for exam_id")
 
         # Verify exam exists
-        exam_check = supabase.table("exams").select("id").eq("id", exam_id).execute()
-        if not exam_check.data:
+        if not await exam_exists(exam_id):
             raise HTTPException(status_code=404, detail="Exam not found")
 
-        # Generate unique filename and path
-        file_ext = os.path.splitext(file.filename)[1]
-        unique_filename = f"{uuid.uuid4()}{file_ext}"
-        # This variable holds the path for the storage bucket
-        storage_file_path = f"{exam_id}/{unique_filename}"
+        # Spool the file, hashing it on the way
+        file_ext = os.path.splitext(file.filename or "")[1]
+        payload = await spool_upload_file(file)
+        return await store_exam_image(exam_id, file_ext, payload, background_tasks)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"UNEXPECTED ERROR: {e}")
+        raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
 
-        # Read file content
-        file_bytes = await file.read()
+
+async def store_exam_image(
+    exam_id: str, file_ext: str, payload: SpooledPayload, background_tasks: BackgroundTasks
+) -> Dict[str, Any]:
+    """
+    Store a received image of an existing exam and return its exam_images row.
+    Takes ownership of `payload`. Content-addressed: if these bytes are already
+    stored for the exam, the existing row is returned and nothing is written.
+    """
+    handed_off = False
+    try:
+        storage_file_path = content_image_path(exam_id, payload.digest, file_ext)
+        existing = await existing_image_rows(exam_id, [storage_file_path])
+        if storage_file_path in existing:
+            return existing[storage_file_path]
 
         # Upload to Supabase Storage bucket (private)
-        storage_response = supabase.storage.from_("exam-images").upload(
-            storage_file_path, file_bytes
+        try:
+            await run_blocking(upload_image, storage_file_path, payload)
+        except StorageUploadError as e:
+            raise HTTPException(status_code=500, detail=str(e) or "Error uploading file to storage.")
+
+        # Save record in DB, with the indexed DICOM header columns for DICOM files
+        header = await run_blocking(read_dicom_header, payload.upload_source(), file_ext)
+        inserted = await insert_image_rows([image_row(exam_id, storage_file_path, header)])
+
+        if not inserted:
+            # A concurrent upload of the same bytes stored the row first
+            existing = await existing_image_rows(exam_id, [storage_file_path])
+            if storage_file_path in existing:
+                return existing[storage_file_path]
+            raise HTTPException(status_code=500, detail="Failed to save image record in database and received no data.")
+
+        background_tasks.add_task(derive_and_close, storage_file_path, payload)
+        handed_off = True
+        events.exam_image_added(exam_id, inserted[0])
+        return inserted[0]
+    finally:
+        if not handed_off:
+            payload.close()
+
+
+async def derive_and_close(storage_file_path: str, payload: SpooledPayload):
+    """Background task: make an upload's derivatives, then release its spool."""
+    try:
+        await run_blocking(create_derivatives, storage_file_path, payload)
+    finally:
+        payload.close()
+
+
+@router.post("/bulk", response_model=ExamImageBatchResponse)
+async def upload_exam_images(
+    exam_id: str = Form(...),
+    files: List[UploadFile] = File(...)
+):
+    """
+    Upload several images for one exam. The exam is checked once, files are sent
+    to storage concurrently (IMAGE_UPLOAD_CONCURRENCY at a time) and all rows are
+    inserted in one request. Files that fail to upload are listed in `failed`.
+    Files whose bytes are already stored for the exam (or repeated in the request)
+    are not stored again; they are listed in `duplicates` and their existing row
+    is returned in `images`.
+    Derivatives are made in the same upload slot, while each file is still spooled.
+    """
+    try:
+        try:
+            uuid.UUID(exam_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid UUID format for exam_id")
+
+        if not await exam_exists(exam_id):
+            raise HTTPException(status_code=404, detail="Exam not found")
+
+        slots = asyncio.Semaphore(IMAGE_UPLOAD_CONCURRENCY)
+
+        async def spool(file: UploadFile) -> SpooledPayload:
+            async with slots:
+                # Kept small in memory: every file of the request is spooled at once
+                return await spool_upload_file(file, memory_limit=UPLOAD_READ_CHUNK_SIZE)
+
+        # Spool every file, hashing it on the way; the digests give the content paths
+        spooled = await asyncio.gather(*(spool(file) for file in files), return_exceptions=True)
+        payloads = [p for p in spooled if isinstance(p, SpooledPayload)]
+        try:
+            failure = next((p for p in spooled if isinstance(p, BaseException)), None)
+            if failure is not None:
+                raise failure
+            return await store_exam_images(exam_id, files, payloads, slots)
+        finally:
+            for payload in payloads:
+                payload.close()
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"UNEXPECTED ERROR: {e}")
+        raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
+
+
+async def store_exam_images(
+    exam_id: str, files: List[UploadFile], payloads: List[SpooledPayload], slots: asyncio.Semaphore
+) -> Dict[str, Any]:
+    """Store the spooled files of a bulk upload (the caller closes the payloads)."""
+    paths = [
+        content_image_path(exam_id, payload.digest, os.path.splitext(file.filename or "")[1])
+        for file, payload in zip(files, payloads)
+    ]
+    existing = await existing_image_rows(exam_id, sorted(set(paths)))
+    # Each new path is stored from the first file that has it
+    first_index: Dict[str, int] = {}
+    for index, path in enumerate(paths):
+        if path not in existing:
+            first_index.setdefault(path, index)
+
+    async def store(payload: SpooledPayload, file_ext: str, storage_file_path: str) -> Dict[str, Any]:
+        async with slots:
+            await run_blocking(upload_image, storage_file_path, payload)
+            header = await run_blocking(read_dicom_header, payload.upload_source(), file_ext)
+            await run_blocking(create_derivatives, storage_file_path, payload)
+            return header
+
+    new_paths = list(first_index)
+    results = await asyncio.gather(
+        *(store(payloads[first_index[path]], os.path.splitext(files[first_index[path]].filename or "")[1], path)
+          for path in new_paths),
+        return_exceptions=True
+    )
+
+    stored = []
+    failed_paths = set()
+    failed = []
+    for path, result in zip(new_paths, results):
+        if isinstance(result, BaseException):
+            failed_paths.add(path)
+            index = first_index[path]
+            failed.append({"index": index, "filename": files[index].filename, "error": str(result)})
+        else:
+            stored.append((path, result))
+
+    # Objects stored for rows that then fail to insert are left in place: a concurrent upload
+    # of the same bytes may already reference them, and a retry reuses them
+    rows = []
+    if stored:
+        rows = await insert_image_rows([image_row(exam_id, path, header) for path, header in stored])
+        if len(rows) != len(stored):
+            # Rows skipped as duplicates were stored by a concurrent upload of the same bytes
+            inserted = {row["image_path"] for row in rows}
+            missing = [path for path, _ in stored if path not in inserted]
+            existing.update(await existing_image_rows(exam_id, missing))
+            if any(path not in existing for path in missing):
+                raise HTTPException(status_code=500, detail="Failed to save image records in database.")
+
+    for row in rows:
+        events.exam_image_added(exam_id, row)
+
+    # One row per distinct image, in request order; later copies are duplicates
+    rows_by_path = {**existing, **{row["image_path"]: row for row in rows}}
+    images = []
+    duplicates = []
+    seen = set()
+    for index, path in enumerate(paths):
+        if path in failed_paths or path not in rows_by_path:
+            continue
+        if path in seen or path in existing:
+            duplicates.append({"index": index, "filename": files[index].filename, "image_path": path})
+        if path not in seen:
+            seen.add(path)
+            images.append(rows_by_path[path])
+    return {"exam_id": exam_id, "images": images, "failed": failed, "duplicates": duplicates}
+
+
+# --- Resumable uploads -------------------------------------------------------
+# POST /uploads opens a session for one file of known size; PATCH /uploads/{id}
+# writes the request body at ?offset= (or the Upload-Offset header); GET shows the
+# received ranges so an interrupted client resumes at `next_offset`; POST
+# /uploads/{id}/complete stores the image exactly like a single upload.
+def upload_session_error(e: UploadSessionError) -> HTTPException:
+    if isinstance(e, UploadSessionNotFound):
+        return HTTPException(status_code=404, detail=str(e))
+    if isinstance(e, (UploadSessionIncomplete, UploadSessionComplete)):
+        return HTTPException(status_code=409, detail=str(e))
+    return HTTPException(status_code=400, detail=str(e))
+
+
+@router.post("/uploads", status_code=201, response_model=dict)
+async def create_upload_session(upload: UploadSessionCreate):
+    """Open a resumable upload session for one image"""
+    try:
+        try:
+            uuid.UUID(upload.exam_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid UUID format for exam_id")
+
+        if not await exam_exists(upload.exam_id):
+            raise HTTPException(status_code=404, detail="Exam not found")
+
+        session = await run_blocking(
+            upload_sessions.create, upload.exam_id, os.path.splitext(upload.filename)[1], upload.size, upload.sha256
         )
+        return session.as_dict()
+    except UploadSessionError as e:
+        raise upload_session_error(e)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
+
+
+@router.get("/uploads/{upload_id}", response_model=dict)
+async def get_upload_session(upload_id: str):
+    """Byte ranges received so far and the offset to resume from"""
+    try:
+        return (await run_blocking(upload_sessions.get, upload_id)).as_dict()
+    except UploadSessionError as e:
+        raise upload_session_error(e)
 
-        # Check the HTTP status code
-        if storage_response.status_code != 200:
-            error_detail = "Error uploading file to storage."
-            try:
-                error_detail = storage_response.json().get("message", error_detail)
-            except (json.JSONDecodeError, AttributeError):
-                pass
-            raise HTTPException(status_code=500, detail=error_detail)
 
-        # Save record in DB
-        db_insert = supabase.table("exam_images").insert({
-            "exam_id": exam_id,
-            "image_path": storage_file_path # Use image_path to match your table
-        }).execute()
+@router.patch("/uploads/{upload_id}", response_model=dict)
+async def upload_chunk(
+    upload_id: str,
+    request: Request,
+    offset: Optional[int] = Query(None, description="Byte offset of the body (or send an Upload-Offset header)"),
+):
+    """
+    Write the raw request body into the session at `offset`. Bytes are recorded
+    as they arrive, so a chunk cut off by a dropped connection still counts up to
+    the last byte received.
+    """
+    if offset is None:
+        try:
+            offset = int(request.headers["upload-offset"])
+        except (KeyError, ValueError):
+            raise HTTPException(status_code=400, detail="Provide ?offset= or an Upload-Offset header")
+    try:
+        session = await run_blocking(upload_sessions.get, upload_id)
+        session = await upload_sessions.receive(session, offset, request.stream(), run_blocking)
+        return session.as_dict()
+    except UploadSessionError as e:
+        raise upload_session_error(e)
 
-        # If the insert operation fails, the 'data' list will be empty.
-        if not db_insert.data:
-            error_message = "Failed to save image record in database and received no data."
-            # On failure, the object *will* have an .error attribute we can safely check.
-            if hasattr(db_insert, 'error') and db_insert.error:
-                error_message = db_insert.error.message
-            raise HTTPException(status_code=500, detail=error_message)
 
-        return db_insert.data[0]
+@router.post("/uploads/{upload_id}/complete", response_model=DicomImageResponse)
+async def complete_upload_session(upload_id: str, background_tasks: BackgroundTasks):
+    """
+    Store a fully received upload as an exam image (idempotent like a single
+    upload). If storing fails the session is kept, so the commit can be retried.
+    """
+    try:
+        session, snapshot_path = await run_blocking(upload_sessions.snapshot, upload_id)
+    except UploadSessionError as e:
+        raise upload_session_error(e)
 
+    payload = None
+    handed_off = False
+    try:
+        payload = await run_blocking(SpooledPayload.from_file, snapshot_path)
+        if session.sha256 and payload.digest != session.sha256.lower():
+            await run_blocking(upload_sessions.finish, upload_id)
+            raise HTTPException(status_code=422, detail="Checksum mismatch: the received bytes differ from sha256; upload again")
+
+        if not await exam_exists(session.exam_id):
+            raise HTTPException(status_code=404, detail="Exam not found")
+
+        # store_exam_image owns (and closes) the payload from here on
+        handed_off = True
+        row = await store_exam_image(session.exam_id, session.file_ext, payload, background_tasks)
+        await run_blocking(upload_sessions.finish, upload_id)
+        return row
     except HTTPException:
         raise
     except Exception as e:
         print(f"UNEXPECTED ERROR: {e}")
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
+    finally:
+        if payload is not None and not handed_off:
+            payload.close()
+        elif payload is None:
+            # from_file failed, so nothing adopted the snapshot
+            try:
+                os.remove(snapshot_path)
+            except FileNotFoundError:
+                pass
+
+
+@router.delete("/uploads/{upload_id}")
+async def abort_upload_session(upload_id: str):
+    """Discard a resumable upload and the bytes received for it"""
+    try:
+        await run_blocking(upload_sessions.delete, upload_id)
+        return {"message": "Upload session deleted"}
+    except UploadSessionError as e:
+        raise upload_session_error(e)
+
+
+async def signed_image_urls(rows: List[Dict[str, Any]]) -> List[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    """
+    (row, urls) for each exam_images row whose original could be signed; urls has
+    `url`, `thumbnail_url` and `preview_url` (None until/unless derivatives exist).
+    Originals and derivatives are signed together (cached until shortly before they expire).
+    """
+    image_paths = [row["image_path"] for row in rows]
+    derivatives = {path: derivative_paths(path) for path in image_paths}
+    derived_paths = [p for paths in derivatives.values() for p in paths.values()]
+    # Only derivatives are remembered as missing; an original that failed to sign is retried
+    url_map = await get_signed_urls(image_paths + derived_paths, derived_paths)
+
+    signed = []
+    for row in rows:
+        signed_url = url_map.get(row["image_path"])
+        if signed_url:
+            derived = derivatives[row["image_path"]]
+            signed.append((row, {
+                "url": signed_url,
+                "thumbnail_url": url_map.get(derived.get("thumbnail")),
+                "preview_url": url_map.get(derived.get("preview")),
+            }))
+    return signed
 
 
 @router.get("/exams/{exam_id}/images", response_model=dict)
-def get_exam_images(exam_id: str):
-    """Retrieves signed URLs and descriptions for all images associated with an exam"""
+async def get_exam_images(exam_id: str):
+    """
+    Retrieves signed URLs and descriptions for all images associated with an exam,
+    with `thumbnail_url` and `preview_url` (None until/unless derivatives exist).
+    """
     try:
         try:
             uuid.UUID(exam_id)
@@ -117,39 +431,149 @@ def get_exam_images(exam_id: str):
             raise HTTPException(status_code=400, detail="Invalid UUID format for exam_id")
 
         # Fetch both image_path and description
-        query = supabase.table("exam_images").select("image_path, description").eq("exam_id", exam_id).execute()
+        query = await execute(supabase.table("exam_images").select("image_path, description").eq("exam_id", exam_id))
 
         images_data = []
         if query.data:
-            image_paths = [item["image_path"] for item in query.data]
-            
-            # Get signed URLs for the image paths
-            signed_urls_response = supabase.storage.from_("exam-images").create_signed_urls(image_paths, 3600)
-
-            # Create a map of image_path -> signed_url
-            url_map = {path: next((url.get('signedURL') for url in signed_urls_response if url.get('path') == path), None) for path in image_paths}
-
             # Combine the descriptions with the signed URLs
-            for item in query.data:
-                signed_url = url_map.get(item["image_path"])
-                if signed_url:
-                    images_data.append({
-                        "url": signed_url,
-                        "description": item.get("description", "")
-                    })
+            for item, urls in await signed_image_urls(query.data):
+                images_data.append({**urls, "description": item.get("description", "")})
 
         return {"exam_id": exam_id, "images": images_data}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred while fetching images: {str(e)}")
 
 
+# --- DICOM header queries (columns from migrations/004_dicom_headers.sql) ---
+DICOM_SELECT = "id, exam_id, image_path, description, created_at, " + ", ".join(HEADER_COLUMNS)
+
+
+def dicom_query_error(e: Exception) -> HTTPException:
+    # 42703 / PGRST204: the header columns don't exist yet
+    if getattr(e, "code", None) in ("42703", "PGRST204"):
+        return HTTPException(
+            status_code=503,
+            detail="DICOM header columns are missing; apply migrations/004_dicom_headers.sql",
+        )
+    return HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+
+@router.get("/dicom/search", response_model=List[DicomImageResponse])
+async def search_dicom_images(
+    study_uid: Optional[str] = None,
+    series_uid: Optional[str] = None,
+    modality: Optional[str] = None,
+    body_part: Optional[str] = None,
+    acquired_from: Optional[datetime] = None,
+    acquired_to: Optional[datetime] = None,
+    exam_id: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+):
+    """Find DICOM images by their indexed header tags, most recently acquired first"""
+    if not any((study_uid, series_uid, modality, body_part, acquired_from, acquired_to, exam_id)):
+        raise HTTPException(status_code=400, detail="Provide at least one filter")
+    try:
+        query = supabase.table("exam_images").select(DICOM_SELECT)
+        if study_uid:
+            query = query.eq("study_instance_uid", study_uid)
+        if series_uid:
+            query = query.eq("series_instance_uid", series_uid)
+        if modality:
+            query = query.eq("modality", modality.strip().upper())
+        if body_part:
+            query = query.eq("body_part_examined", body_part.strip().upper())
+        if acquired_from:
+            query = query.gte("acquisition_datetime", acquired_from.isoformat())
+        if acquired_to:
+            query = query.lt("acquisition_datetime", acquired_to.isoformat())
+        if exam_id:
+            query = query.eq("exam_id", exam_id)
+        result = await execute(
+            query.order("acquisition_datetime", desc=True, nullsfirst=False)
+            .order("id")
+            .range(offset, offset + limit - 1)
+        )
+        return result.data
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise dicom_query_error(e)
+
+
+@router.get("/dicom/studies/{study_uid}", response_model=dict)
+async def get_dicom_study(study_uid: str):
+    """Series of a DICOM study with their modality, body part, image count and acquisition range"""
+    try:
+        result = await execute(
+            supabase.table("exam_images")
+            .select("exam_id, " + ", ".join(HEADER_COLUMNS))
+            .eq("study_instance_uid", study_uid)
+        )
+        if not result.data:
+            raise HTTPException(status_code=404, detail="Study not found")
+
+        series: Dict[str, Dict[str, Any]] = {}
+        for row in result.data:
+            entry = series.setdefault(row["series_instance_uid"], {
+                "series_instance_uid": row["series_instance_uid"],
+                "modality": row.get("modality"),
+                "body_part_examined": row.get("body_part_examined"),
+                "image_count": 0,
+                "first_acquired": None,
+                "last_acquired": None,
+            })
+            entry["image_count"] += 1
+            acquired = row.get("acquisition_datetime")
+            if acquired:
+                # ISO timestamps from one column compare correctly as strings
+                if entry["first_acquired"] is None or acquired < entry["first_acquired"]:
+                    entry["first_acquired"] = acquired
+                if entry["last_acquired"] is None or acquired > entry["last_acquired"]:
+                    entry["last_acquired"] = acquired
+
+        return {
+            "study_instance_uid": study_uid,
+            "exam_ids": sorted({row["exam_id"] for row in result.data}),
+            "series": sorted(series.values(), key=lambda s: (s["first_acquired"] or "", s["series_instance_uid"] or "")),
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise dicom_query_error(e)
+
+
+@router.get("/dicom/series/{series_uid}/images", response_model=dict)
+async def get_dicom_series_images(series_uid: str):
+    """Signed URLs (original, thumbnail, preview) and header tags for every image of a series, in acquisition order"""
+    try:
+        result = await execute(
+            supabase.table("exam_images")
+            .select(DICOM_SELECT)
+            .eq("series_instance_uid", series_uid)
+            .order("acquisition_datetime", nullsfirst=False)
+            .order("sop_instance_uid")
+        )
+        if not result.data:
+            raise HTTPException(status_code=404, detail="Series not found")
+
+        images = []
+        for row, urls in await signed_image_urls(result.data):
+            images.append({**urls, **{column: row.get(column) for column in HEADER_COLUMNS}, "exam_id": row["exam_id"]})
+        return {"series_instance_uid": series_uid, "images": images}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise dicom_query_error(e)
+
+
 @router.patch("/description", response_model=ExamImageResponse)
 async def update_image_description(update_data: ImageDescriptionUpdate):
     """Update the description for a specific exam image."""
     try:
-        result = supabase.table("exam_images").update({
+        result = await execute(supabase.table("exam_images").update({
             "description": update_data.description
-        }).eq("image_path", update_data.image_path).execute()
+        }).eq("image_path", update_data.image_path))
 
         if not result.data:
             raise HTTPException(status_code=404, detail="Image not found with the given path.")
@@ -0,0 +1,259 @@
+"""
+Wire format for the TCP image ingest protocol.
+Shared by routes/socket_server.py and TCPClient.py so both sides agree on framing.
+
+Legacy mode (one image per connection):
+    exam_id (36 bytes) | extension (10 bytes, space padded) | size (8 bytes) | body
+    The server answers SUCCESS or FAILURE and closes the connection.
+
+Framed mode (many images, many exams, one connection):
+    Handshake   client -> MAGIC | version (1 byte) | features (2 bytes)
+                server -> MAGIC | accepted version | accepted features
+    Frames      client -> frame header (FRAME_HEADER) followed by `size` body bytes
+    Acks        server -> ACK (ACK_FORMAT) carrying the frame's sequence number
+
+Clients may pipeline frames without waiting for acks; acks can arrive out of
+order and are matched to frames by sequence number. A BYE frame ends the
+session once every outstanding frame has been acknowledged.
+
+Resumable uploads (feature FEATURE_RESUMABLE): an image is sent as RESUME,
+any number of CHUNK frames and a COMMIT. Each of these bodies starts with
+UPLOAD_HEADER (a client-chosen 16-byte upload id, a byte offset and the total
+size); CHUNK bodies continue with the bytes at that offset. RESUME opens the
+upload, or finds it again after a dropped connection, and is answered with
+ACK_OFFSET followed by the offset to continue from (OFFSET_FORMAT). COMMIT is
+acked OK once the image is stored, or ACK_INCOMPLETE if bytes are missing.
+
+ACK_FAILED means the server could not store the image this time (storage or
+database trouble) and the client may send it again. ACK_REJECTED means it never
+will: the exam id is malformed or unknown, or the upload doesn't fit its session.
+
+Compression (FEATURE_DEFLATE, FEATURE_ZSTD): once a codec is negotiated, IMAGE
+and CHUNK frames may set a COMPRESSION_* flag in the high bits of the frame
+type. `size` then counts the compressed bytes. For CHUNK frames only the data
+after UPLOAD_HEADER is compressed, and offsets still refer to the original file.
+All integers are big endian.
+"""
+
+import struct
+import zlib
+from typing import Iterator, NamedTuple, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# "EZRD" can never start a legacy upload: legacy mode begins with a UUID string,
+# which only contains hex digits and dashes.
+MAGIC = b"EZRD"
+PROTOCOL_VERSION = 1
+
+# Feature bits negotiated during the handshake
+FEATURE_RESUMABLE = 0x0001
+FEATURE_DEFLATE = 0x0002
+FEATURE_ZSTD = 0x0004
+# zstd is only offered where the zstandard package is installed
+SUPPORTED_FEATURES = FEATURE_RESUMABLE | FEATURE_DEFLATE | (FEATURE_ZSTD if zstandard is not None else 0)
+
+HANDSHAKE = struct.Struct("!4sBH")
+
+# Legacy field sizes
+EXAM_ID_SIZE = 36
+EXTENSION_SIZE = 10
+SIZE_FIELD_SIZE = 8
+
+# Frame types
+FRAME_IMAGE = 0x01
+FRAME_BYE = 0x02
+# Resumable uploads (FEATURE_RESUMABLE)
+FRAME_RESUME = 0x03
+FRAME_CHUNK = 0x04
+FRAME_COMMIT = 0x05
+RESUMABLE_FRAMES = (FRAME_RESUME, FRAME_CHUNK, FRAME_COMMIT)
+
+# Compression flags, OR'ed into the frame type byte of IMAGE and CHUNK frames
+FRAME_TYPE_MASK = 0x3F
+COMPRESSION_DEFLATE = 0x40
+COMPRESSION_ZSTD = 0x80
+COMPRESSION_FEATURES = {COMPRESSION_DEFLATE: FEATURE_DEFLATE, COMPRESSION_ZSTD: FEATURE_ZSTD}
+COMPRESSION_NAMES = {0: "none", COMPRESSION_DEFLATE: "deflate", COMPRESSION_ZSTD: "zstd"}
+COMPRESSIBLE_FRAMES = (FRAME_IMAGE, FRAME_CHUNK)
+
+# zstd input handed to the decoder per step. A zstd block decodes to at most 128 KiB
+# and takes at least 4 bytes, so one step can expand to no more than ~8 MiB.
+ZSTD_FEED_SIZE = 256
+
+# type | sequence id | exam id | extension | body size
+FRAME_HEADER = struct.Struct(f"!BI{EXAM_ID_SIZE}s{EXTENSION_SIZE}sQ")
+
+# Ack statuses
+ACK_OK = 0
+ACK_FAILED = 1
+ACK_TOO_LARGE = 2
+ACK_BAD_FRAME = 3
+ACK_INCOMPLETE = 4
+# Reply to RESUME; the ack is followed by OFFSET_FORMAT
+ACK_OFFSET = 5
+# Permanent failure: sending the same image again can't succeed
+ACK_REJECTED = 6
+
+# sequence id | status
+ACK_FORMAT = struct.Struct("!IB")
+OFFSET_FORMAT = struct.Struct("!Q")
+
+# upload id | offset | total size (start of every resumable frame body)
+UPLOAD_ID_SIZE = 16
+UPLOAD_HEADER = struct.Struct(f"!{UPLOAD_ID_SIZE}sQQ")
+
+ACK_STATUS_NAMES = {
+    ACK_OK: "OK",
+    ACK_FAILED: "FAILED",
+    ACK_TOO_LARGE: "TOO_LARGE",
+    ACK_BAD_FRAME: "BAD_FRAME",
+    ACK_INCOMPLETE: "INCOMPLETE",
+    ACK_OFFSET: "OFFSET",
+    ACK_REJECTED: "REJECTED",
+}
+
+
+class Frame(NamedTuple):
+    frame_type: int
+    seq: int
+    exam_id: str
+    file_ext: str
+    size: int
+    compression: int = 0
+
+
+class CompressionError(ValueError):
+    """Raised for a compressed body that is corrupt, truncated or uses an unknown codec."""
+
+
+class FrameError(ValueError):
+    """Raised for a frame header whose fields cannot be decoded; `seq` is still known so it can be acked."""
+
+    def __init__(self, seq: int, message: str):
+        super().__init__(message)
+        self.seq = seq
+
+
+def encode_handshake(version: int = PROTOCOL_VERSION, features: int = 0) -> bytes:
+    return HANDSHAKE.pack(MAGIC, version, features)
+
+
+def decode_handshake(data: bytes):
+    """Return (version, features) from a handshake, or raise ValueError if the magic is wrong."""
+    magic, version, features = HANDSHAKE.unpack(data)
+    if magic != MAGIC:
+        raise ValueError("Invalid handshake magic")
+    return version, features
+
+
+def encode_extension(file_ext: str) -> bytes:
+    """Pad a file extension to the fixed 10-byte field."""
+    ext_bytes = file_ext.encode("utf-8")
+    if len(ext_bytes) > EXTENSION_SIZE:
+        raise ValueError(f"File extension must be at most {EXTENSION_SIZE} bytes")
+    return ext_bytes.ljust(EXTENSION_SIZE)
+
+
+def encode_frame_header(frame_type: int, seq: int, exam_id: str = "", file_ext: str = "", size: int = 0,
+                        compression: int = 0) -> bytes:
+    exam_id_bytes = exam_id.encode("utf-8")
+    if frame_type in (FRAME_IMAGE, FRAME_RESUME) and len(exam_id_bytes) != EXAM_ID_SIZE:
+        raise ValueError("Exam ID must be a valid UUID string of 36 characters.")
+    if compression and (compression not in COMPRESSION_FEATURES or frame_type not in COMPRESSIBLE_FRAMES):
+        raise ValueError(f"Frame type {frame_type} cannot use compression {compression:#x}")
+    return FRAME_HEADER.pack(frame_type | compression, seq, exam_id_bytes, encode_extension(file_ext), size)
+
+
+def decode_frame_header(data: bytes) -> Frame:
+    type_byte, seq, exam_id_bytes, ext_bytes, size = FRAME_HEADER.unpack(data)
+    try:
+        exam_id = exam_id_bytes.rstrip(b"\x00").decode("utf-8")
+        file_ext = ext_bytes.rstrip(b"\x00").decode("utf-8").strip()
+    except UnicodeDecodeError as e:
+        raise FrameError(seq, f"exam id or extension is not UTF-8: {e}") from None
+    return Frame(
+        frame_type=type_byte & FRAME_TYPE_MASK,
+        seq=seq,
+        exam_id=exam_id,
+        file_ext=file_ext,
+        size=size,
+        compression=type_byte & ~FRAME_TYPE_MASK,
+    )
+
+
+def encode_ack(seq: int, status: int) -> bytes:
+    return ACK_FORMAT.pack(seq, status)
+
+
+def decode_ack(data: bytes):
+    """Return (seq, status) from an ack."""
+    return ACK_FORMAT.unpack(data)
+
+
+def encode_upload_header(upload_id: bytes, offset: int, total_size: int) -> bytes:
+    if len(upload_id) != UPLOAD_ID_SIZE:
+        raise ValueError(f"Upload id must be {UPLOAD_ID_SIZE} bytes")
+    return UPLOAD_HEADER.pack(upload_id, offset, total_size)
+
+
+def decode_upload_header(data: bytes):
+    """Return (upload id, offset, total size) from the start of a resumable frame body."""
+    return UPLOAD_HEADER.unpack(data)
+
+
+def new_compressor(compression: int, level: Optional[int] = None):
+    """Streaming compressor (compress()/flush()) for a COMPRESSION_* flag."""
+    if compression == COMPRESSION_DEFLATE:
+        return zlib.compressobj(6 if level is None else level)
+    if compression == COMPRESSION_ZSTD and zstandard is not None:
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+    raise CompressionError(f"Unsupported compression {compression:#x}")
+
+
+class Decompressor:
+    """
+    Streaming decompression of one frame body. feed() yields the output lazily
+    in bounded pieces (at most `max_piece` bytes for deflate; for zstd, which has
+    no output limit, input is fed ZSTD_FEED_SIZE bytes at a time), so a small,
+    highly compressed input can't expand into one huge buffer and a caller that
+    stops iterating stops the decompression.
+    """
+
+    def __init__(self, compression: int, max_piece: int = 1024 * 1024):
+        self.max_piece = max_piece
+        if compression == COMPRESSION_DEFLATE:
+            self._zlib = zlib.decompressobj()
+            self._zstd = None
+        elif compression == COMPRESSION_ZSTD and zstandard is not None:
+            self._zlib = None
+            self._zstd = zstandard.ZstdDecompressor().decompressobj()
+        else:
+            raise CompressionError(f"Unsupported compression {compression:#x}")
+
+    def feed(self, data: bytes) -> Iterator[bytes]:
+        try:
+            if self._zstd is not None:
+                view = memoryview(data)
+                for start in range(0, len(view), ZSTD_FEED_SIZE):
+                    piece = self._zstd.decompress(view[start:start + ZSTD_FEED_SIZE])
+                    if piece:
+                        yield piece
+                return
+            piece = self._zlib.decompress(data, self.max_piece)
+            while piece:
+                yield piece
+                if not self._zlib.unconsumed_tail:
+                    break
+                piece = self._zlib.decompress(self._zlib.unconsumed_tail, self.max_piece)
+        except (zlib.error, getattr(zstandard, "ZstdError", zlib.error)) as e:
+            raise CompressionError(f"Corrupt compressed body: {e}")
+
+    def finish(self):
+        """Raise CompressionError unless the compressed stream ended cleanly."""
+        decoder = self._zstd if self._zstd is not None else self._zlib
+        if not getattr(decoder, "eof", True):
+            raise CompressionError("Compressed body is truncated")
@@ -0,0 +1,69 @@
+"""
+Keyset (cursor) pagination helpers
+Pages are ordered by (created_at, id) and continue strictly after the last row
+of the previous page, so deep pages cost the same as the first one and rows
+inserted while paging are neither skipped nor repeated.
+"""
+
+import base64
+import json
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+PAGINATION_MODES = ("offset", "cursor")
+
+
+def encode_cursor(row: Dict[str, Any]) -> str:
+    """Build the opaque cursor pointing just after `row`."""
+    payload = json.dumps({"created_at": row["created_at"], "id": row["id"]}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    """
+    Return (created_at, id) from a cursor, raising HTTP 400 if it is malformed.
+    Both values end up inside a PostgREST filter, so created_at must be an ISO
+    timestamp and id a UUID.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        created_at, row_id = payload["created_at"], payload["id"]
+        datetime.fromisoformat(created_at)
+        return created_at, str(uuid.UUID(row_id))
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise HTTPException(status_code=400, detail="Invalid pagination cursor")
+
+
+def use_cursor_mode(paginate: Optional[str], cursor: Optional[str]) -> bool:
+    """Cursor mode is selected explicitly with paginate=cursor or implicitly by passing a cursor."""
+    if paginate and paginate not in PAGINATION_MODES:
+        raise HTTPException(status_code=400, detail="paginate must be 'offset' or 'cursor'")
+    return paginate == "cursor" or bool(cursor)
+
+
+def apply_keyset(query, cursor: Optional[str], limit: int, desc: bool = True):
+    """
+    Order a PostgREST query by (created_at, id), continue after `cursor` and
+    fetch one extra row so the caller can tell whether another page exists.
+    """
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        op = "lt" if desc else "gt"
+        # Values are quoted because timestamps contain characters PostgREST treats as delimiters
+        query = query.or_(
+            f'created_at.{op}."{created_at}",'
+            f'and(created_at.eq."{created_at}",id.{op}."{row_id}")'
+        )
+    return query.order("created_at", desc=desc).order("id", desc=desc).limit(limit + 1)
+
+
+def split_page(rows: List[Dict[str, Any]], limit: int) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Trim the look-ahead row and return (items, next_cursor)."""
+    if len(rows) > limit:
+        items = rows[:limit]
+        return items, encode_cursor(items[-1])
+    return rows, None
@@ -1,2 +1,294 @@
-#search for patient with information given
-#will replace equipment check in landing page
\ No newline at end of file
+"""
+Patient search engine for EZRAD
+Ranked type-ahead lookup over normalized patient names and phone numbers.
+
+Two interchangeable backends:
+- postgres: the search_patients_ranked() function from migrations/003_patient_search.sql,
+  backed by trigram and prefix indexes on the normalized search_name / phone_digits columns.
+- memory:   an in-process trigram + prefix index built from the patients table and kept
+  current by the patient routes (of every process, over the invalidation bus).
+  Used for local/test databases without the migration, and automatically when the
+  database function is missing.
+
+Ranking (both backends): name or last-name prefix matches first, then phone prefix
+matches, then trigram similarity, then alphabetical.
+"""
+
+import bisect
+import os
+import re
+import threading
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+try:
+    from .supabase_client import supabase, execute, run_blocking
+    from .entity_cache import invalidation_bus
+except ImportError:
+    from supabase_client import supabase, execute, run_blocking
+    from entity_cache import invalidation_bus
+
+# "postgres" (default) or "memory"
+PATIENT_SEARCH_BACKEND = os.getenv("PATIENT_SEARCH_BACKEND", "postgres").lower()
+# Minimum trigram similarity for fuzzy matches (pg_trgm's default threshold)
+SIMILARITY_THRESHOLD = float(os.getenv("PATIENT_SEARCH_SIMILARITY", "0.3"))
+# Phone fragments shorter than this are not matched against phone numbers
+MIN_PHONE_DIGITS = 3
+# Rows fetched per request while building the in-memory index
+INDEX_LOAD_BATCH = 1000
+# Redis channel relaying patient changes to the in-memory indexes of other processes
+PATIENT_SEARCH_CHANNEL = os.getenv("PATIENT_SEARCH_CHANNEL", "ezrad:patient-search")
+
+
+# --- Normalization ---------------------------------------------------------
+def normalize_name(first_name: Optional[str], last_name: Optional[str]) -> str:
+    """Lower-cased 'first last', matching the search_name column."""
+    return f"{first_name or ''} {last_name or ''}".strip().lower()
+
+
+def normalize_term(term: str) -> str:
+    return " ".join((term or "").lower().split())
+
+
+def digits_only(value: Optional[str]) -> str:
+    """Digits of a phone number, matching the phone_digits column."""
+    return re.sub(r"\D", "", value or "")
+
+
+def trigrams(text: str) -> Set[str]:
+    """pg_trgm-compatible trigrams: each word padded with two leading and one trailing space."""
+    grams = set()
+    for word in re.findall(r"[a-z0-9]+", text.lower()):
+        padded = f"  {word} "
+        for i in range(len(padded) - 2):
+            grams.add(padded[i:i + 3])
+    return grams
+
+
+# --- In-process index --------------------------------------------------------
+class PatientSearchIndex:
+    """
+    Trigram inverted index plus sorted prefix lists over patient names and phones.
+    Safe to update from route handlers while searches run.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self._lock = threading.RLock()
+        self._rows: Dict[str, Dict[str, Any]] = {}
+        self._names: Dict[str, str] = {}
+        self._last_names: Dict[str, str] = {}
+        self._phones: Dict[str, str] = {}
+        self._grams: Dict[str, Set[str]] = {}
+        self._postings: Dict[str, Set[str]] = defaultdict(set)
+        self._name_keys: List[Tuple[str, str]] = []
+        self._last_name_keys: List[Tuple[str, str]] = []
+        self._phone_keys: List[Tuple[str, str]] = []
+
+    def __len__(self):
+        return len(self._rows)
+
+    def load(self, rows: Iterable[Dict[str, Any]]):
+        with self._lock:
+            for row in rows:
+                self.upsert(row)
+            self.loaded = True
+
+    def upsert(self, row: Dict[str, Any]):
+        patient_id = str(row["id"])
+        with self._lock:
+            self.remove(patient_id)
+            name = normalize_name(row.get("first_name"), row.get("last_name"))
+            last_name = (row.get("last_name") or "").lower()
+            phone = digits_only(row.get("phone"))
+            grams = trigrams(name)
+
+            self._rows[patient_id] = row
+            self._names[patient_id] = name
+            self._last_names[patient_id] = last_name
+            self._phones[patient_id] = phone
+            self._grams[patient_id] = grams
+            for gram in grams:
+                self._postings[gram].add(patient_id)
+            bisect.insort(self._name_keys, (name, patient_id))
+            bisect.insort(self._last_name_keys, (last_name, patient_id))
+            if phone:
+                bisect.insort(self._phone_keys, (phone, patient_id))
+
+    def remove(self, patient_id: str):
+        patient_id = str(patient_id)
+        with self._lock:
+            if patient_id not in self._rows:
+                return
+            for gram in self._grams.pop(patient_id):
+                postings = self._postings.get(gram)
+                if postings is not None:
+                    postings.discard(patient_id)
+                    if not postings:
+                        del self._postings[gram]
+            self._discard_key(self._name_keys, (self._names.pop(patient_id), patient_id))
+            self._discard_key(self._last_name_keys, (self._last_names.pop(patient_id), patient_id))
+            phone = self._phones.pop(patient_id)
+            if phone:
+                self._discard_key(self._phone_keys, (phone, patient_id))
+            del self._rows[patient_id]
+
+    @staticmethod
+    def _discard_key(keys: List[Tuple[str, str]], key: Tuple[str, str]):
+        i = bisect.bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            del keys[i]
+
+    @staticmethod
+    def _prefix_ids(keys: List[Tuple[str, str]], prefix: str) -> Set[str]:
+        ids = set()
+        i = bisect.bisect_left(keys, (prefix, ""))
+        while i < len(keys) and keys[i][0].startswith(prefix):
+            ids.add(keys[i][1])
+            i += 1
+        return ids
+
+    def search(self, query: str, limit: int = 20) -> List[Dict[str, Any]]:
+        term = normalize_term(query)
+        digits = digits_only(query)
+        if not term:
+            return []
+
+        with self._lock:
+            name_prefix = self._prefix_ids(self._name_keys, term) | self._prefix_ids(self._last_name_keys, term)
+            phone_prefix: Set[str] = set()
+            phone_contains: Set[str] = set()
+            if len(digits) >= MIN_PHONE_DIGITS:
+                phone_prefix = self._prefix_ids(self._phone_keys, digits)
+                phone_contains = {pid for pid, phone in self._phones.items() if digits in phone}
+
+            # Trigram similarity (Jaccard over trigram sets, as pg_trgm's similarity())
+            query_grams = trigrams(term)
+            shared: Dict[str, int] = defaultdict(int)
+            for gram in query_grams:
+                for pid in self._postings.get(gram, ()):
+                    shared[pid] += 1
+            similarity = {}
+            for pid, count in shared.items():
+                union = len(query_grams) + len(self._grams[pid]) - count
+                similarity[pid] = count / union if union else 0.0
+
+            candidates = set(name_prefix) | phone_contains
+            candidates.update(pid for pid, score in similarity.items() if score >= SIMILARITY_THRESHOLD)
+            candidates.update(pid for pid in shared if term in self._names[pid])
+
+            ranked = sorted(
+                candidates,
+                key=lambda pid: (
+                    pid not in name_prefix,
+                    pid not in phone_prefix,
+                    -similarity.get(pid, 0.0),
+                    self._last_names[pid],
+                    self._names[pid],
+                ),
+            )
+            return [self._rows[pid] for pid in ranked[:limit]]
+
+
+search_index = PatientSearchIndex()
+_load_lock = threading.Lock()
+
+
+def load_search_index_rows() -> List[Dict[str, Any]]:
+    """Read every patient in keyset order for the in-memory index (blocking)."""
+    rows: List[Dict[str, Any]] = []
+    last_id = None
+    while True:
+        query = supabase.table("patients").select("*").order("id").limit(INDEX_LOAD_BATCH)
+        if last_id is not None:
+            query = query.gt("id", last_id)
+        batch = query.execute().data
+        rows.extend(batch)
+        if len(batch) < INDEX_LOAD_BATCH:
+            return rows
+        last_id = batch[-1]["id"]
+
+
+def ensure_search_index():
+    """Build the in-memory index on first use (blocking; call through run_blocking)."""
+    if search_index.loaded:
+        return
+    with _load_lock:
+        if not search_index.loaded:
+            search_index.load(load_search_index_rows())
+
+
+# --- Public API ------------------------------------------------------------
+# Flipped to False when the database function is missing so later calls use the memory index
+ranked_rpc_available = PATIENT_SEARCH_BACKEND == "postgres"
+
+
+async def lookup_patients(query: str, limit: int = 20) -> List[Dict[str, Any]]:
+    """Ranked type-ahead search by name or phone fragment."""
+    global ranked_rpc_available
+    if ranked_rpc_available:
+        try:
+            result = await execute(supabase.rpc("search_patients_ranked", {"q": query, "max_results": limit}))
+            return result.data
+        except Exception as e:
+            # PGRST202: the function is not installed in this database
+            if getattr(e, "code", None) != "PGRST202":
+                raise
+            print(f"search_patients_ranked() unavailable, using in-memory index: {e}")
+            ranked_rpc_available = False
+
+    await run_blocking(ensure_search_index)
+    return search_index.search(query, limit)
+
+
+# None until probed; the columns are only used once the database has confirmed them
+normalized_columns_available: Optional[bool] = None
+
+
+async def uses_normalized_columns() -> bool:
+    """True when the search_name / phone_digits columns from the migration can be queried."""
+    global normalized_columns_available
+    if PATIENT_SEARCH_BACKEND != "postgres":
+        return False
+    if normalized_columns_available is None:
+        try:
+            await execute(supabase.table("patients").select("id, search_name, phone_digits").limit(1))
+            normalized_columns_available = True
+        except Exception as e:
+            # 42703 / PGRST204: the migration isn't applied. Anything else may be transient, so probe again later
+            if getattr(e, "code", None) not in ("42703", "PGRST204"):
+                print(f"Could not check for the patient search columns, using name/phone filters: {e}")
+                return False
+            print("search_name / phone_digits columns missing, using name/phone filters")
+            normalized_columns_available = False
+    return normalized_columns_available
+
+
+def patient_changed(row: Dict[str, Any]):
+    """Keep the in-memory index current after a create or update, here and in other processes."""
+    if not row or not row.get("id"):
+        return
+    if search_index.loaded:
+        search_index.upsert(row)
+    if invalidation_bus.enabled:
+        invalidation_bus.send(PATIENT_SEARCH_CHANNEL, {"upsert": row})
+
+
+def patient_removed(patient_id: str):
+    if search_index.loaded:
+        search_index.remove(patient_id)
+    if invalidation_bus.enabled:
+        invalidation_bus.send(PATIENT_SEARCH_CHANNEL, {"remove": patient_id})
+
+
+def _changed_elsewhere(payload: Dict[str, Any]):
+    """A patient change relayed from another process (called on the Redis listener thread)."""
+    if not search_index.loaded:
+        return
+    if isinstance(payload.get("upsert"), dict) and payload["upsert"].get("id"):
+        search_index.upsert(payload["upsert"])
+    elif isinstance(payload.get("remove"), str):
+        search_index.remove(payload["remove"])
+
+
+invalidation_bus.add_channel(PATIENT_SEARCH_CHANNEL, _changed_elsewhere)
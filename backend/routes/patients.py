@@ -3,29 +3,28 @@ Patient management routes for EZRAD application
 Comprehensive patient data handling with search and filtering
 """
 
-from fastapi import APIRouter, HTTPException, Query, UploadFile, File
-from pydantic import BaseModel, Field, validator
-from typing import Optional, List, Dict, Any
+from fastapi import APIRouter, HTTPException, Query, Request
+from pydantic import BaseModel, ValidationError, validator
+from typing import Optional, List, Dict, Any, Union
 from datetime import datetime, date, timedelta
+import asyncio
 import os
-from supabase import create_client, Client
-from dotenv import load_dotenv
+import uuid
+from postgrest.exceptions import APIError
+from .supabase_client import supabase, execute
+from .pagination import use_cursor_mode, apply_keyset, split_page
+from .patient_search import lookup_patients, uses_normalized_columns, patient_changed, patient_removed
+from .exam_listing import parse_fields, exam_select, flatten_embeds, project
+from .entity_cache import patient_cache
+from .bulk_import import detect_format, iter_records, validation_messages, ImportReport
 import re
 
-# Load environment variables
-load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), "..", ".env"))
-
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-
-if not SUPABASE_URL or not SUPABASE_KEY:
-    raise ValueError("Missing SUPABASE_URL or SUPABASE_KEY in environment!")
-
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-
 # Create router
 router = APIRouter()
 
+# Rows per insert request in bulk imports (overridable per request)
+IMPORT_BATCH_SIZE = int(os.getenv("PATIENT_IMPORT_BATCH_SIZE", "500"))
+
 # --- Helpers ---------------------------------------------------------------
 def normalize_gender_for_db(value: str) -> str:
     """Normalize incoming gender values to the canonical DB values."""
@@ -109,6 +108,11 @@ class PatientResponse(BaseModel):
     created_by: Optional[str] = None
     created_at: Optional[str] = None
 
+class PatientPage(BaseModel):
+    """One page of patients in cursor pagination mode"""
+    items: List[PatientResponse]
+    next_cursor: Optional[str] = None
+
 class PatientSearchParams(BaseModel):
     """Parameters for searching patients"""
     patient_id: Optional[str] = None
@@ -137,7 +141,7 @@ class PatientStatistics(BaseModel):
     age_groups: Dict[str, int]
 
 # Main search endpoint with multiple parameters
-@router.get("/search", response_model=List[PatientResponse])
+@router.get("/search", response_model=Union[List[PatientResponse], PatientPage])
 async def search_patients(
     patient_id: Optional[str] = Query(None, description="Search by patient ID"),
     first_name: Optional[str] = Query(None, description="Search by first name (partial match)"),
@@ -153,7 +157,9 @@ async def search_patients(
     sort_by: Optional[str] = Query("created_at", description="Sort by field"),
     sort_order: Optional[str] = Query("desc", description="Sort order (asc or desc)"),
     limit: Optional[int] = Query(100, description="Limit number of results"),
-    offset: Optional[int] = Query(0, description="Offset for pagination")
+    offset: Optional[int] = Query(0, description="Offset for pagination"),
+    paginate: Optional[str] = Query(None, description="Pagination mode: offset (default) or cursor (requires sort_by=created_at)"),
+    cursor: Optional[str] = Query(None, description="Opaque next_cursor from the previous page (implies cursor mode)")
 ):
     """
     Advanced search endpoint for patients with multiple filter options
@@ -173,13 +179,20 @@ async def search_patients(
             query = query.ilike("last_name", f"%{last_name}%")
         
         if full_name:
-            # Search in both first and last name
-            query = query.or_(f"first_name.ilike.%{full_name}%,last_name.ilike.%{full_name}%")
+            if await uses_normalized_columns():
+                # Trigram-indexed "first last" column, so "john smi" matches across both names
+                query = query.ilike("search_name", f"%{' '.join(full_name.lower().split())}%")
+            else:
+                # Search in both first and last name
+                query = query.or_(f"first_name.ilike.%{full_name}%,last_name.ilike.%{full_name}%")
         
         if phone:
             # Remove non-digits for search
             phone_digits = re.sub(r'\D', '', phone)
-            query = query.ilike("phone", f"%{phone_digits}%")
+            if await uses_normalized_columns():
+                query = query.ilike("phone_digits", f"%{phone_digits}%")
+            else:
+                query = query.ilike("phone", f"%{phone_digits}%")
         
         if email:
             query = query.ilike("email", f"%{email}%")
@@ -199,6 +212,15 @@ async def search_patients(
         if state:
             query = query.ilike("state", f"%{state}%")
         
+        # Keyset pagination on (created_at, id)
+        if use_cursor_mode(paginate, cursor):
+            if sort_by != "created_at":
+                raise HTTPException(status_code=400, detail="Cursor pagination requires sort_by=created_at")
+            query = apply_keyset(query, cursor, limit, desc=sort_order.lower() == "desc")
+            result = await execute(query)
+            items, next_cursor = split_page(result.data, limit)
+            return {"items": items, "next_cursor": next_cursor}
+
         # Apply sorting
         if sort_order.lower() == "desc":
             query = query.order(sort_by, desc=True)
@@ -209,43 +231,99 @@ async def search_patients(
         query = query.limit(limit).offset(offset)
         
         # Execute query
-        result = query.execute()
+        result = await execute(query)
         
         return result.data
         
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Search error: {str(e)}")
+
+
+# Ranked type-ahead search
+@router.get("/lookup", response_model=List[PatientResponse])
+async def lookup(
+    q: str = Query(..., min_length=1, description="Name or phone fragment"),
+    limit: int = Query(20, ge=1, le=100, description="Maximum number of results")
+):
+    """
+    Type-ahead patient lookup ranked by prefix match, phone match and trigram similarity
+    """
+    try:
+        return await lookup_patients(q, limit)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Search error: {str(e)}")
 
 
+# --- Insert helpers --------------------------------------------------------
+def patient_record(patient: PatientCreate) -> Dict[str, Any]:
+    """Row to insert for a validated PatientCreate (None values omitted)"""
+    patient_data = {
+        "first_name": patient.first_name,
+        "last_name": patient.last_name,
+        "date_of_birth": patient.date_of_birth.isoformat(),
+        "gender": normalize_gender_for_db(patient.gender),
+        "phone": patient.phone,
+        "email": patient.email,
+        "address": patient.address,
+        "city": patient.city,
+        "state": patient.state,
+        "zip_code": patient.zip_code,
+        "insurance_provider": patient.insurance_provider,
+        "policy_number": patient.policy_number,
+        "group_number": patient.group_number,
+        "created_by": patient.created_by,
+        "created_at": datetime.utcnow().isoformat()
+    }
+
+    # Remove None values
+    return {k: v for k, v in patient_data.items() if v is not None}
+
+def is_row_error(error: Exception) -> bool:
+    """True when PostgREST rejected the data itself (22xxx data exceptions, 23xxx constraint violations)."""
+    return isinstance(error, APIError) and str(error.code or "")[:2] in ("22", "23")
+
+async def insert_patient_batch(rows: List[tuple], report: ImportReport):
+    """
+    Insert (row_number, record) pairs in one request. If the batch's data is
+    rejected, retry its rows one by one so the failing rows can be reported
+    individually. Any other failure (connection, timeout) may have left the batch
+    committed, so it is not retried: its rows are reported as not imported and
+    the error is re-raised to abort the import.
+    """
+    try:
+        result = await execute(supabase.table("patients").insert([record for _, record in rows]))
+        inserted = result.data or []
+    except Exception as e:
+        if not is_row_error(e):
+            for row_number, _ in rows:
+                report.add_error(row_number, [f"Not imported: {e}"])
+            raise
+        if len(rows) == 1:
+            report.add_error(rows[0][0], [str(e)])
+            return
+        for index, row in enumerate(rows):
+            try:
+                await insert_patient_batch([row], report)
+            except Exception:
+                for row_number, _ in rows[index + 1:]:
+                    report.add_error(row_number, ["Not imported: import aborted"])
+                raise
+        return
+    report.imported += len(inserted)
+    for row in inserted:
+        patient_changed(row)
+
 # Original CRUD operations
 @router.post("/", response_model=PatientResponse)
 async def create_patient(patient: PatientCreate):
     """Create a new patient"""
     try:
-        patient_data = {
-            "first_name": patient.first_name,
-            "last_name": patient.last_name,
-            "date_of_birth": patient.date_of_birth.isoformat(),
-            "gender": normalize_gender_for_db(patient.gender),
-            "phone": patient.phone,
-            "email": patient.email,
-            "address": patient.address,
-            "city": patient.city,
-            "state": patient.state,
-            "zip_code": patient.zip_code,
-            "insurance_provider": patient.insurance_provider,
-            "policy_number": patient.policy_number,
-            "group_number": patient.group_number,
-            "created_by": patient.created_by,
-            "created_at": datetime.utcnow().isoformat()
-        }
-        
-        # Remove None values
-        patient_data = {k: v for k, v in patient_data.items() if v is not None}
-        
-        result = supabase.table("patients").insert(patient_data).execute()
+        result = await execute(supabase.table("patients").insert(patient_record(patient)))
         
         if result.data:
+            patient_changed(result.data[0])
             return result.data[0]
         else:
             raise HTTPException(status_code=400, detail="Failed to create patient")
@@ -253,28 +331,107 @@ async def create_patient(patient: PatientCreate):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
-@router.get("/", response_model=List[PatientResponse])
+@router.post("/import")
+async def import_patients(
+    request: Request,
+    format: Optional[str] = Query(None, description="csv or ndjson (defaults to the Content-Type)"),
+    batch_size: int = Query(IMPORT_BATCH_SIZE, ge=1, le=5000, description="Rows per insert"),
+    dry_run: bool = Query(False, description="Validate only, insert nothing"),
+    max_errors: int = Query(1000, ge=0, description="Maximum row errors listed in the report")
+):
+    """
+    Bulk-create patients from a streamed CSV (header row required) or NDJSON body.
+    Every row is validated like POST /patients; valid rows are inserted in batches
+    while the rest of the body is still being read. Returns a per-row error report.
+    If the database can't be reached the import stops with a 500 carrying the
+    report so far.
+    """
+    file_format = detect_format(request, format)
+    report = ImportReport(max_errors)
+    batch: List[tuple] = []
+    pending_insert: Optional[asyncio.Task] = None
+
+    async def flush(rows):
+        nonlocal pending_insert
+        # Keep one insert in flight while the next batch is parsed and validated
+        if pending_insert is not None:
+            await pending_insert
+        pending_insert = asyncio.create_task(insert_patient_batch(rows, report))
+
+    try:
+        async for row_number, record, parse_error in iter_records(request, file_format):
+            report.total_rows += 1
+            if parse_error:
+                report.add_error(row_number, [parse_error])
+                continue
+            try:
+                patient = PatientCreate(**record)
+            except ValidationError as e:
+                report.add_error(row_number, validation_messages(e))
+                continue
+            if dry_run:
+                continue
+            batch.append((row_number, patient_record(patient)))
+            if len(batch) >= batch_size:
+                await flush(batch)
+                batch = []
+        if batch:
+            await flush(batch)
+        if pending_insert is not None:
+            await pending_insert
+    except Exception as e:
+        if pending_insert is not None and not pending_insert.done():
+            pending_insert.cancel()
+        raise HTTPException(status_code=500, detail={
+            "message": f"Import aborted after {report.imported} rows: {str(e)}",
+            "report": report.as_dict(dry_run),
+        })
+
+    return report.as_dict(dry_run)
+
+@router.get("/", response_model=Union[List[PatientResponse], PatientPage])
 async def get_all_patients(
     limit: int = Query(100, description="Limit number of results"),
-    offset: int = Query(0, description="Offset for pagination")
+    offset: int = Query(0, description="Offset for pagination"),
+    paginate: Optional[str] = Query(None, description="Pagination mode: offset (default) or cursor"),
+    cursor: Optional[str] = Query(None, description="Opaque next_cursor from the previous page (implies cursor mode)")
 ):
-    """Get all patients with pagination"""
+    """Get all patients with pagination (offset, or keyset on created_at/id in cursor mode)"""
     try:
-        result = supabase.table("patients").select("*").order("created_at", desc=True).limit(limit).offset(offset).execute()
+        if use_cursor_mode(paginate, cursor):
+            result = await execute(apply_keyset(supabase.table("patients").select("*"), cursor, limit))
+            items, next_cursor = split_page(result.data, limit)
+            return {"items": items, "next_cursor": next_cursor}
+
+        result = await execute(supabase.table("patients").select("*").order("created_at", desc=True).limit(limit).offset(offset))
         return result.data
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
+def patient_cache_key(patient_id: str) -> str:
+    """Canonical (lowercase) form of a patient id, so every spelling of it shares one patient_cache entry"""
+    try:
+        return str(uuid.UUID(patient_id))
+    except (TypeError, ValueError, AttributeError):
+        return str(patient_id).lower()
+
 @router.get("/{patient_id}", response_model=PatientResponse)
 async def get_patient(patient_id: str):
     """Get a specific patient by ID"""
     try:
-        result = supabase.table("patients").select("*").eq("id", patient_id).execute()
-        
-        if not result.data:
+        async def load():
+            result = await execute(supabase.table("patients").select("*").eq("id", patient_id))
+            return result.data[0] if result.data else None
+
+        patient = await patient_cache.get_or_load(patient_cache_key(patient_id), load)
+        if patient is None:
             raise HTTPException(status_code=404, detail="Patient not found")
             
-        return result.data[0]
+        return patient
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
@@ -315,11 +472,13 @@ async def update_patient(patient_id: str, patient_update: PatientUpdate):
         if not update_data:
             raise HTTPException(status_code=400, detail="No fields to update")
             
-        result = supabase.table("patients").update(update_data).eq("id", patient_id).execute()
+        result = await execute(supabase.table("patients").update(update_data).eq("id", patient_id))
         
         if not result.data:
             raise HTTPException(status_code=404, detail="Patient not found")
             
+        patient_changed(result.data[0])
+        patient_cache.invalidate(patient_cache_key(result.data[0]["id"]))
         return result.data[0]
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
@@ -329,7 +488,7 @@ async def delete_patient(patient_id: str):
     """Delete a patient"""
     try:
         # Check if patient has associated exams
-        exams_result = supabase.table("exams").select("id").eq("patient_id", patient_id).limit(1).execute()
+        exams_result = await execute(supabase.table("exams").select("id").eq("patient_id", patient_id).limit(1))
         
         if exams_result.data:
             raise HTTPException(
@@ -337,11 +496,13 @@ async def delete_patient(patient_id: str):
                 detail="Cannot delete patient with existing exams. Archive patient instead."
             )
         
-        result = supabase.table("patients").delete().eq("id", patient_id).execute()
+        result = await execute(supabase.table("patients").delete().eq("id", patient_id))
         
         if not result.data:
             raise HTTPException(status_code=404, detail="Patient not found")
             
+        patient_removed(str(result.data[0]["id"]))
+        patient_cache.invalidate(patient_cache_key(result.data[0]["id"]))
         return {"message": "Patient deleted successfully"}
     except HTTPException:
         raise
@@ -362,7 +523,7 @@ async def get_patients_by_age_range(
         max_dob = today - timedelta(days=min_age * 365)
         min_dob = today - timedelta(days=(max_age + 1) * 365)
         
-        result = supabase.table("patients").select("*").gte("date_of_birth", min_dob.isoformat()).lte("date_of_birth", max_dob.isoformat()).order("date_of_birth", desc=True).execute()
+        result = await execute(supabase.table("patients").select("*").gte("date_of_birth", min_dob.isoformat()).lte("date_of_birth", max_dob.isoformat()).order("date_of_birth", desc=True))
         
         return result.data
     except Exception as e:
@@ -370,27 +531,33 @@ async def get_patients_by_age_range(
 
 # Get patient's exam history
 @router.get("/{patient_id}/exams")
-async def get_patient_exam_history(patient_id: str):
+async def get_patient_exam_history(
+    patient_id: str,
+    expand: bool = Query(False, description="Embed patient and technician names in each exam"),
+    fields: Optional[str] = Query(None, description="Comma separated exam fields to return")
+):
     """Get all exams for a specific patient"""
+    field_list = parse_fields(fields)
     try:
-        # First verify patient exists
-        patient_result = supabase.table("patients").select("id, first_name, last_name").eq("id", patient_id).execute()
+        # Patient check and exam list are independent, so fetch them together
+        patient_result, exams_result = await asyncio.gather(
+            execute(supabase.table("patients").select("id, first_name, last_name").eq("id", patient_id)),
+            execute(supabase.table("exams").select(exam_select(expand, field_list)).eq("patient_id", patient_id).order("exam_date", desc=True)),
+        )
         
         if not patient_result.data:
             raise HTTPException(status_code=404, detail="Patient not found")
         
         patient = patient_result.data[0]
-        
-        # Get all exams for this patient
-        exams_result = supabase.table("exams").select("*").eq("patient_id", patient_id).order("exam_date", desc=True).execute()
+        exams = project([flatten_embeds(row) for row in exams_result.data], field_list)
         
         return {
             "patient": {
                 "id": patient["id"],
                 "name": f"{patient['first_name']} {patient['last_name']}"
             },
-            "total_exams": len(exams_result.data),
-            "exams": exams_result.data
+            "total_exams": len(exams),
+            "exams": exams
         }
     except HTTPException:
         raise
@@ -0,0 +1,121 @@
+"""
+Room and technician conflict detection for exam scheduling
+Exams have a start (exam_date + exam_time) but no stored duration, so every
+exam is treated as occupying one slot of `slot_minutes`. Bookings are kept in
+an interval index per (resource, day), under every day their slot touches; a
+new booking conflicts with any existing booking on the same room or technician
+whose slot overlaps it, also across midnight.
+"""
+
+import bisect
+from datetime import date, datetime, time, timedelta
+from typing import Any, Dict, Hashable, List, Optional, Tuple, Union
+
+# Exams in these states do not occupy their slot
+INACTIVE_STATUSES = {"cancelled"}
+
+
+class IntervalIndex:
+    """
+    Sorted start times per key with bisect lookups. Because every interval is at
+    most `max_length` long, an overlap search only has to look back from the
+    insertion point until starts fall more than `max_length` before the query.
+    """
+
+    def __init__(self):
+        self._starts: Dict[Hashable, List[datetime]] = {}
+        self._intervals: Dict[Hashable, List[Tuple[datetime, datetime, Any]]] = {}
+        self.max_length = timedelta(0)
+
+    def add(self, key: Hashable, start: datetime, end: datetime, ref: Any):
+        starts = self._starts.setdefault(key, [])
+        intervals = self._intervals.setdefault(key, [])
+        i = bisect.bisect_right(starts, start)
+        starts.insert(i, start)
+        intervals.insert(i, (start, end, ref))
+        self.max_length = max(self.max_length, end - start)
+
+    def overlapping(self, key: Hashable, start: datetime, end: datetime) -> Optional[Any]:
+        """Reference of an interval under `key` that overlaps [start, end), if any."""
+        starts = self._starts.get(key)
+        if not starts:
+            return None
+        intervals = self._intervals[key]
+        j = bisect.bisect_left(starts, end) - 1
+        while j >= 0 and intervals[j][0] > start - self.max_length:
+            if intervals[j][1] > start:
+                return intervals[j][2]
+            j -= 1
+        return None
+
+
+def exam_start(exam_date: Union[date, str, None], exam_time: Union[time, str, None]) -> Optional[datetime]:
+    if not exam_date or not exam_time:
+        return None
+    if isinstance(exam_date, str):
+        exam_date = date.fromisoformat(exam_date[:10])
+    if isinstance(exam_time, str):
+        exam_time = time.fromisoformat(exam_time[:8])
+    return datetime.combine(exam_date, exam_time.replace(tzinfo=None))
+
+
+def resource_keys(room: Optional[str], technician_id: Optional[str],
+                  start: datetime, end: datetime) -> List[Tuple[str, str, date]]:
+    """
+    Index keys an exam occupies: its room (case-insensitive) and its technician,
+    for each day [start, end) touches (two when the slot crosses midnight).
+    """
+    resources = []
+    if room and room.strip():
+        resources.append(("room", room.strip().lower()))
+    if technician_id:
+        resources.append(("technician", str(technician_id)))
+    keys = []
+    day, last_day = start.date(), max(start, end - timedelta(microseconds=1)).date()
+    while day <= last_day:
+        keys.extend((kind, value, day) for kind, value in resources)
+        day += timedelta(days=1)
+    return keys
+
+
+class BookingIndex:
+    """Room and technician bookings for one scheduling batch."""
+
+    def __init__(self, slot_minutes: int):
+        self.slot = timedelta(minutes=slot_minutes)
+        self._index = IntervalIndex()
+
+    def add_existing(self, rows: List[Dict[str, Any]]):
+        """Load already-scheduled exams (rows with id, room, technician_id, exam_date, exam_time, status)."""
+        for row in rows:
+            if (row.get("status") or "").lower() in INACTIVE_STATUSES:
+                continue
+            try:
+                start = exam_start(row.get("exam_date"), row.get("exam_time"))
+            except ValueError:
+                continue
+            if start is None:
+                continue
+            ref = {"exam_id": row.get("id")}
+            for key in resource_keys(row.get("room"), row.get("technician_id"), start, start + self.slot):
+                self._index.add(key, start, start + self.slot, ref)
+
+    def book(self, index: int, room: Optional[str], technician_id: Optional[str], start: datetime) -> List[Dict[str, Any]]:
+        """
+        Book batch item `index` unless its room or technician is taken.
+        Returns the conflicts (empty when the booking was added).
+        """
+        end = start + self.slot
+        keys = resource_keys(room, technician_id, start, end)
+        conflicts = []
+        for key in keys:
+            if any(conflict["resource"] == key[0] for conflict in conflicts):
+                # Already taken on the other side of midnight
+                continue
+            other = self._index.overlapping(key, start, end)
+            if other is not None:
+                conflicts.append({"resource": key[0], "value": room if key[0] == "room" else technician_id, **other})
+        if not conflicts:
+            for key in keys:
+                self._index.add(key, start, end, {"batch_index": index})
+        return conflicts
@@ -0,0 +1,137 @@
+"""
+Signed URL cache for exam images
+Signed URLs are reused until shortly before they expire, so a study that is
+re-opened while a radiologist scrolls is only signed once per expiry window.
+Paths storage could not sign (derivatives not made yet, or never: unsupported
+images) are remembered for SIGNED_URL_MISSING_TTL, and forgotten in every
+process as soon as the derivatives are stored (forget_missing).
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+try:
+    from .supabase_client import run_blocking, exam_images_bucket, observe_call
+    from .entity_cache import invalidation_bus
+except ImportError:
+    from supabase_client import run_blocking, exam_images_bucket, observe_call
+    from entity_cache import invalidation_bus
+
+# Lifetime requested from storage for each signed URL (seconds)
+SIGNED_URL_EXPIRY = int(os.getenv("SIGNED_URL_EXPIRY", "3600"))
+# URLs closer than this to expiry are re-signed instead of served from cache (seconds)
+SIGNED_URL_REFRESH_MARGIN = int(os.getenv("SIGNED_URL_REFRESH_MARGIN", "300"))
+# Maximum number of image paths kept in the cache
+SIGNED_URL_CACHE_SIZE = int(os.getenv("SIGNED_URL_CACHE_SIZE", "50000"))
+# Derivative paths storage could not sign are not asked for again for this long (seconds)
+SIGNED_URL_MISSING_TTL = int(os.getenv("SIGNED_URL_MISSING_TTL", "300"))
+# Redis channel announcing newly stored derivatives to the other processes
+SIGNED_URL_CHANNEL = os.getenv("SIGNED_URL_CHANNEL", "ezrad:signed-urls")
+
+
+class SignedUrlCache:
+    """Thread-safe LRU map of image_path -> (signed_url, expires_at); signed_url None marks a missing object."""
+
+    def __init__(self, max_entries: int = SIGNED_URL_CACHE_SIZE, refresh_margin: int = SIGNED_URL_REFRESH_MARGIN):
+        self.max_entries = max_entries
+        self.refresh_margin = refresh_margin
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, paths: Iterable[str]) -> Tuple[Dict[str, str], List[str]]:
+        """
+        Split paths into cached URLs that are still fresh and paths that need
+        signing. Paths recently found missing are in neither.
+        """
+        now = time.monotonic()
+        hits: Dict[str, str] = {}
+        misses: List[str] = []
+        seen = set()
+        with self._lock:
+            for path in paths:
+                if path in seen:
+                    continue
+                seen.add(path)
+                entry = self._entries.get(path)
+                if entry and entry[0] is None and entry[1] > now:
+                    continue
+                if entry and entry[0] is not None and entry[1] - now > self.refresh_margin:
+                    hits[path] = entry[0]
+                    self._entries.move_to_end(path)
+                else:
+                    misses.append(path)
+        return hits, misses
+
+    def store(self, urls: Dict[str, Optional[str]], expires_at: float):
+        with self._lock:
+            for path, url in urls.items():
+                self._entries[path] = (url, expires_at)
+                self._entries.move_to_end(path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, paths: Iterable[str]):
+        with self._lock:
+            for path in paths:
+                self._entries.pop(path, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+signed_url_cache = SignedUrlCache()
+
+
+def forget_missing(paths: Iterable[str]):
+    """Objects were just stored at `paths`: sign them on the next lookup, here and in other processes."""
+    paths = list(paths)
+    signed_url_cache.invalidate(paths)
+    if invalidation_bus.enabled:
+        invalidation_bus.send(SIGNED_URL_CHANNEL, {"paths": paths})
+
+
+def _stored_elsewhere(payload: Dict[str, Any]):
+    signed_url_cache.invalidate(payload.get("paths") or ())
+
+
+invalidation_bus.add_channel(SIGNED_URL_CHANNEL, _stored_elsewhere)
+
+
+def create_signed_urls(paths: List[str]) -> List[Dict[str, Any]]:
+    """Sign `paths` in one storage request (blocking)."""
+    with observe_call("storage:create_signed_urls"):
+        return exam_images_bucket().create_signed_urls(paths, SIGNED_URL_EXPIRY)
+
+
+async def get_signed_urls(image_paths: List[str], optional_paths: Iterable[str] = ()) -> Dict[str, str]:
+    """
+    Return a map of image_path -> signed URL, signing only paths that are missing
+    from the cache or about to expire (one batched storage call for all of them).
+    Paths storage didn't sign are left out of the map. Those among
+    `optional_paths` (derivatives, which may never exist) are not asked for again
+    for SIGNED_URL_MISSING_TTL; any other path is retried on the next call.
+    """
+    urls, misses = signed_url_cache.lookup(image_paths)
+    if not misses:
+        return urls
+
+    # Measure expiry from before the request so cached URLs never outlive the real ones
+    signed_at = time.monotonic()
+    signed_urls_response = await run_blocking(create_signed_urls, misses)
+
+    fresh = {}
+    for item in signed_urls_response:
+        signed_url = item.get("signedURL")
+        if item.get("path") and signed_url:
+            fresh[item["path"]] = signed_url
+
+    signed_url_cache.store(fresh, signed_at + SIGNED_URL_EXPIRY)
+    optional = set(optional_paths)
+    missing = {path: None for path in misses if path not in fresh and path in optional}
+    signed_url_cache.store(missing, signed_at + SIGNED_URL_MISSING_TTL)
+    urls.update(fresh)
+    return urls
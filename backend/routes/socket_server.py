@@ -2,136 +2,789 @@
 TCP Socket Server for receiving and uploading exam images directly to Supabase.
 """
 import asyncio
+import hashlib
+import json
 import os
 import uuid
-from supabase import create_client, Client
-from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import NamedTuple, Optional, Union
+
+try:
+    from .ingest_protocol import (
+        MAGIC, PROTOCOL_VERSION, SUPPORTED_FEATURES, HANDSHAKE, FRAME_HEADER,
+        EXAM_ID_SIZE, EXTENSION_SIZE, SIZE_FIELD_SIZE, FRAME_IMAGE, FRAME_BYE,
+        FRAME_RESUME, FRAME_CHUNK, FRAME_COMMIT, RESUMABLE_FRAMES, FEATURE_RESUMABLE,
+        UPLOAD_HEADER, OFFSET_FORMAT, COMPRESSIBLE_FRAMES, COMPRESSION_FEATURES, COMPRESSION_NAMES,
+        ACK_OK, ACK_FAILED, ACK_TOO_LARGE, ACK_BAD_FRAME, ACK_INCOMPLETE, ACK_OFFSET, ACK_REJECTED, Frame,
+        CompressionError, FrameError, Decompressor,
+        encode_handshake, decode_handshake, decode_frame_header, decode_upload_header, encode_ack,
+    )
+    from . import metrics, events
+    from .image_store import (
+        SpooledPayload, StorageUploadError, UploadRejected, content_image_path, upload_image,
+        insert_image_rows_sync, existing_image_row_sync, exam_exists_sync,
+    )
+    from .image_derivatives import create_derivatives
+    from .dicom_headers import read_dicom_header, image_row
+    from .upload_sessions import UploadSessionError, UploadSessionIncomplete, upload_sessions
+    from .forward_queue import STORE_AND_FORWARD, ForwardQueue
+except ImportError:
+    from ingest_protocol import (
+        MAGIC, PROTOCOL_VERSION, SUPPORTED_FEATURES, HANDSHAKE, FRAME_HEADER,
+        EXAM_ID_SIZE, EXTENSION_SIZE, SIZE_FIELD_SIZE, FRAME_IMAGE, FRAME_BYE,
+        FRAME_RESUME, FRAME_CHUNK, FRAME_COMMIT, RESUMABLE_FRAMES, FEATURE_RESUMABLE,
+        UPLOAD_HEADER, OFFSET_FORMAT, COMPRESSIBLE_FRAMES, COMPRESSION_FEATURES, COMPRESSION_NAMES,
+        ACK_OK, ACK_FAILED, ACK_TOO_LARGE, ACK_BAD_FRAME, ACK_INCOMPLETE, ACK_OFFSET, ACK_REJECTED, Frame,
+        CompressionError, FrameError, Decompressor,
+        encode_handshake, decode_handshake, decode_frame_header, decode_upload_header, encode_ack,
+    )
+    import metrics
+    import events
+    from image_store import (
+        SpooledPayload, StorageUploadError, UploadRejected, content_image_path, upload_image,
+        insert_image_rows_sync, existing_image_row_sync, exam_exists_sync,
+    )
+    from image_derivatives import create_derivatives
+    from dicom_headers import read_dicom_header, image_row
+    from upload_sessions import UploadSessionError, UploadSessionIncomplete, upload_sessions
+    from forward_queue import STORE_AND_FORWARD, ForwardQueue
 
 
 # --- Configuration ---
-# Load environment variables to connect to Supabase
-load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), ".env"))
+HOST = os.getenv("TCP_HOST", '127.0.0.1')
+PORT = int(os.getenv("TCP_PORT", "8001"))
+# Lets several ingest processes listen on the same port (SO_REUSEPORT; set by serve.py)
+REUSE_PORT = os.getenv("TCP_REUSE_PORT", "false").lower() in ("1", "true", "yes")
+# Shutdown: seconds connections get to finish the frames they have sent before they are cut off
+DRAIN_TIMEOUT = float(os.getenv("TCP_DRAIN_TIMEOUT", "30"))
+# Ingest processes run without the HTTP API (serve.py), so each answers GET /metrics and
+# GET /health/ingest on a port of its own: TCP_METRICS_PORT + its index (0 disables)
+METRICS_HOST = os.getenv("TCP_METRICS_HOST", HOST)
+METRICS_PORT = int(os.getenv("TCP_METRICS_PORT", "9101"))
+
+# --- Streaming ingest limits ---
+# Largest image body a client may announce; larger uploads are refused before any data is read.
+MAX_PAYLOAD_SIZE = int(os.getenv("TCP_MAX_PAYLOAD_SIZE", str(2 * 1024 * 1024 * 1024)))
+# Size of each read from the socket while receiving the image body.
+READ_CHUNK_SIZE = int(os.getenv("TCP_READ_CHUNK_SIZE", str(1024 * 1024)))
+# Bodies are spooled by image_store.SpooledPayload (TCP_SPOOL_MEMORY_LIMIT, TCP_SPOOL_DIR).
+# Framed mode: frames from one connection that may be uploading at the same time.
+MAX_INFLIGHT_PER_CONNECTION = int(os.getenv("TCP_MAX_INFLIGHT_PER_CONNECTION", "8"))
+# Resumable uploads: largest CHUNK frame body (sessions are in upload_sessions.UPLOAD_SESSION_DIR).
+MAX_CHUNK_SIZE = int(os.getenv("TCP_MAX_CHUNK_SIZE", str(64 * 1024 * 1024)))
+
+# --- Upload worker pool ---
+# Threads dedicated to storage/database uploads (separate from the event loop's default executor).
+UPLOAD_WORKERS = int(os.getenv("TCP_UPLOAD_WORKERS", "8"))
+# Received images allowed to wait for a free worker before the server stops reading sockets.
+INGEST_QUEUE_SIZE = int(os.getenv("TCP_INGEST_QUEUE_SIZE", "32"))
+
+
+class PayloadTooLargeError(Exception):
+    """Raised when a client announces an image larger than MAX_PAYLOAD_SIZE (or a compressed body expands past its limit)."""
+
+
+class FrameBody:
+    """
+    A body of `size` bytes on the wire, iterated in READ_CHUNK_SIZE reads and
+    decompressed as it streams when the frame is compressed (the whole body is
+    never buffered). Expanding past `limit` bytes raises PayloadTooLargeError;
+    after that or a CompressionError, drain() skips the rest so the connection
+    stays in step.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, size: int, compression: int = 0,
+                 limit: Optional[int] = None):
+        self.reader = reader
+        self.remaining = size
+        self.size = size
+        self.compression = compression
+        self.limit = limit
+        self.decoded = 0
+
+    def __aiter__(self):
+        return self._pieces()
+
+    async def _read(self) -> bytes:
+        # read() rather than readexactly(): bytes that arrived before a drop are still written
+        chunk = await self.reader.read(min(READ_CHUNK_SIZE, self.remaining))
+        if not chunk:
+            raise asyncio.IncompleteReadError(b"", self.remaining)
+        self.remaining -= len(chunk)
+        metrics.tcp_ingest_bytes_total.inc(len(chunk))
+        return chunk
+
+    async def _pieces(self):
+        decompressor = Decompressor(self.compression, READ_CHUNK_SIZE) if self.compression else None
+        while self.remaining > 0:
+            chunk = await self._read()
+            for piece in (decompressor.feed(chunk) if decompressor else (chunk,)):
+                self.decoded += len(piece)
+                if self.limit is not None and self.decoded > self.limit:
+                    raise PayloadTooLargeError(f"Body expands past the limit of {self.limit} bytes")
+                yield piece
+        if decompressor is not None:
+            decompressor.finish()
+            codec = COMPRESSION_NAMES[self.compression]
+            metrics.tcp_ingest_compressed_bytes_total.inc(self.size, codec=codec)
+            metrics.tcp_ingest_decompressed_bytes_total.inc(self.decoded, codec=codec)
+            if self.size:
+                metrics.tcp_ingest_compression_ratio.observe(self.decoded / self.size, codec=codec)
+
+    async def drain(self):
+        while self.remaining > 0:
+            await self._read()
+
 
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+async def read_payload(reader: asyncio.StreamReader, size: int, compression: int = 0) -> SpooledPayload:
+    """
+    Reads an image body of `size` bytes (compressed bytes for compressed frames)
+    from the stream into a spooled payload.
+    """
+    if size > MAX_PAYLOAD_SIZE:
+        raise PayloadTooLargeError(f"Payload of {size} bytes exceeds the limit of {MAX_PAYLOAD_SIZE} bytes")
+
+    body = FrameBody(reader, size, compression, MAX_PAYLOAD_SIZE)
+    payload = SpooledPayload()
+    try:
+        async for piece in body:
+            payload.write(piece)
+        payload.finish()
+    except (PayloadTooLargeError, CompressionError):
+        payload.close()
+        await body.drain()
+        raise
+    except BaseException:
+        payload.close()
+        raise
+    return payload
 
-if not SUPABASE_URL or not SUPABASE_KEY:
-    raise ValueError("Missing SUPABASE_URL or SUPABASE_KEY in environment!")
 
-# Initialize Supabase client
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-HOST = '127.0.0.1'
-PORT = 8001
+async def single_chunk(data: bytes):
+    yield data
+
 
 # --- Core Image Handling Logic ---
-def handle_image_upload(exam_id: str, file_ext: str, image_bytes: bytes):
+class StoredImage(NamedTuple):
+    image_path: str
+    # False when the same bytes were already stored for the exam
+    created: bool
+
+
+def store_image(exam_id: str, file_ext: str, image_data: Union[bytes, SpooledPayload]) -> StoredImage:
+    """
+    Uploads an image to Supabase Storage and records it in exam_images.
+    `image_data` is either the raw bytes or a SpooledPayload streamed from the socket.
+    Raises UploadRejected when retrying cannot help; any other exception is a
+    failure that may succeed later. Re-sent images are idempotent: they resolve
+    to the existing object and row.
+    """
+    # 1. Validate UUID
+    try:
+        uuid.UUID(exam_id)
+    except ValueError:
+        raise UploadRejected(f"Invalid UUID format for exam_id: {exam_id}")
+
+    # 2. Verify exam exists
+    if not exam_exists_sync(exam_id):
+        raise UploadRejected(f"Exam with id {exam_id} not found.")
+
+    # 3. Content-addressed path (the payload was hashed while it streamed in)
+    if isinstance(image_data, SpooledPayload):
+        digest = image_data.digest
+    else:
+        digest = hashlib.sha256(image_data).hexdigest()
+    storage_file_path = content_image_path(exam_id, digest, file_ext)
+    if existing_image_row_sync(exam_id, storage_file_path):
+        print(f"Image already stored for exam {exam_id} at {storage_file_path}; not storing a copy.")
+        return StoredImage(storage_file_path, False)
+
+    # 4. Upload to Supabase Storage
+    print(f"Uploading to storage at path: {storage_file_path}")
+    upload_image(storage_file_path, image_data)
+
+    print("Successfully uploaded to storage.")
+
+    # 5. Save the record in the database, with the DICOM header columns if it is one
+    source = image_data.upload_source() if isinstance(image_data, SpooledPayload) else image_data
+    header = read_dicom_header(source, file_ext)
+    inserted = insert_image_rows_sync([image_row(exam_id, storage_file_path, header)])
+
+    if not inserted:
+        # A concurrent upload of the same bytes stored the row first
+        if existing_image_row_sync(exam_id, storage_file_path):
+            return StoredImage(storage_file_path, False)
+        raise RuntimeError("Error saving to database: No data returned")
+
+    print(f"Successfully saved database record: {inserted[0]['id']}")
+    # Runs on an ingest worker thread; the broker hands the event to the loop
+    events.exam_image_added(exam_id, inserted[0])
+    return StoredImage(storage_file_path, True)
+
+
+def handle_image_upload(exam_id: str, file_ext: str, image_data: Union[bytes, SpooledPayload]) -> Optional[StoredImage]:
     """
     Handles the actual upload process to Supabase Storage and the database.
     This is a synchronous version of the logic from your FastAPI route.
+    Returns where the image is stored, or None if it was not saved this time;
+    raises UploadRejected if it never can be.
     """
-    print(f"Received image for exam_id: {exam_id}, size: {len(image_bytes)} bytes")
+    if isinstance(image_data, SpooledPayload):
+        image_size = image_data.size
+    else:
+        image_size = len(image_data)
+    print(f"Received image for exam_id: {exam_id}, size: {image_size} bytes")
     try:
-        # 1. Validate UUID
-        try:
-            uuid.UUID(exam_id)
-        except ValueError:
-            print(f"Error: Invalid UUID format for exam_id: {exam_id}")
-            return False
-
-        # 2. Verify exam exists
-        exam_check = supabase.table("exams").select("id").eq("id", exam_id).execute()
-        if not exam_check.data:
-            print(f"Error: Exam with id {exam_id} not found.")
-            return False
-
-        # 3. Generate a unique filename and path
-        unique_filename = f"{uuid.uuid4()}{file_ext}"
-        storage_file_path = f"{exam_id}/{unique_filename}"
-
-        # 4. Upload to Supabase Storage
-        print(f"Uploading to storage at path: {storage_file_path}")
-        storage_response = supabase.storage.from_("exam-images").upload(
-            storage_file_path, image_bytes
-        )
-
-        if storage_response.status_code != 200:
-            print(f"Error uploading to storage: {storage_response.text}")
-            return False
-        
-        print("Successfully uploaded to storage.")
-
-        # 5. Save the record in the database
-        db_insert = supabase.table("exam_images").insert({
-            "exam_id": exam_id,
-            "image_path": storage_file_path
-        }).execute()
-
-        if not db_insert.data:
-            print(f"Error saving to database: {getattr(db_insert, 'error', 'No data returned')}")
-            return False
-
-        print(f"Successfully saved database record: {db_insert.data[0]['id']}")
-        return True
-
+        return store_image(exam_id, file_ext, image_data)
+    except UploadRejected as e:
+        print(f"Error: {e}")
+        raise
+    except StorageUploadError as e:
+        print(f"Error uploading to storage: {e}")
     except Exception as e:
         print(f"An unexpected error occurred during upload: {e}")
-        return False
+    return None
+
+# --- Bounded Upload Pool ---
+# tcp_ingest_images_total outcome for each upload result
+ACK_OUTCOMES = {ACK_OK: "success", ACK_FAILED: "failure", ACK_REJECTED: "rejected"}
+
+class IngestPool:
+    """
+    Bounded ingest queue feeding a dedicated upload thread pool.
+    A connection must reserve a slot before it reads an image body, so once
+    every slot is taken the server stops reading from sockets and TCP flow
+    control slows the clients down. Slots are granted in FIFO order, which
+    keeps a single busy connection from starving the others.
+    """
+
+    def __init__(self, workers: int = UPLOAD_WORKERS, queue_size: int = INGEST_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._worker_tasks = []
+
+    async def start(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ezrad-ingest")
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.workers + self.queue_size)
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 0):
+        """
+        Stop the workers, first giving queued uploads (and their derivatives) up to
+        `timeout` seconds. Uploads still queued after that fail: their waiters get
+        ACK_FAILED and their spools and slots are released.
+        """
+        if timeout and self._queue is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                print(f"TCP ingest: {self._queue.qsize() + self.in_flight} upload(s) unfinished at shutdown")
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        while self._queue is not None and not self._queue.empty():
+            _, _, payload, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_result(ACK_FAILED)
+            payload.close()
+            self._slots.release()
+            self._queue.task_done()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def run(self, func, *args, **kwargs):
+        """Await blocking work of a connection (resumable session files, hashing) on the upload threads."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    async def receive(self, reader: asyncio.StreamReader, size: int, compression: int = 0) -> SpooledPayload:
+        """Wait for a free slot, then stream the body. The slot is held until its upload finishes."""
+        await self._slots.acquire()
+        try:
+            return await read_payload(reader, size, compression)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    async def submit(self, exam_id: str, file_ext: str, payload: SpooledPayload) -> int:
+        """Upload a payload that did not come through receive() (a committed resumable upload)."""
+        try:
+            await self._slots.acquire()
+        except BaseException:
+            payload.close()
+            raise
+        return await self.upload(exam_id, file_ext, payload)
+
+    async def upload(self, exam_id: str, file_ext: str, payload: SpooledPayload) -> int:
+        """
+        Queue a payload returned by receive() and wait for the upload result: ACK_OK,
+        ACK_FAILED or ACK_REJECTED. The pool closes the payload.
+        """
+        if STORE_AND_FORWARD:
+            # Durable on local disk is enough for the ack; the forward queue uploads it later
+            try:
+                status = ACK_OK if await forward_queue.put(exam_id, file_ext, payload) else ACK_FAILED
+            except UploadRejected:
+                status = ACK_REJECTED
+            finally:
+                payload.close()
+                self._slots.release()
+            metrics.tcp_ingest_images_total.inc(outcome="queued" if status == ACK_OK else ACK_OUTCOMES[status])
+            return status
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((exam_id, file_ext, payload, future))
+        return await future
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            exam_id, file_ext, payload, future = await self._queue.get()
+            self.in_flight += 1
+            try:
+                status = ACK_FAILED
+                try:
+                    stored = await loop.run_in_executor(
+                        self._executor, handle_image_upload, exam_id, file_ext, payload
+                    )
+                except UploadRejected:
+                    stored = None
+                    status = ACK_REJECTED
+                except Exception as e:
+                    print(f"Upload worker error for exam_id {exam_id}: {e}")
+                    stored = None
+
+                success = stored is not None
+                if success:
+                    self.completed += 1
+                    status = ACK_OK
+                else:
+                    self.failed += 1
+                if success and not stored.created:
+                    outcome = "duplicate"
+                else:
+                    outcome = ACK_OUTCOMES[status]
+                metrics.tcp_ingest_images_total.inc(outcome=outcome)
+                if not future.done():
+                    future.set_result(status)
+
+                # The client already has its ack; derivatives are made while the body is still spooled
+                if success and stored.created:
+                    await loop.run_in_executor(self._executor, create_derivatives, stored.image_path, payload)
+            finally:
+                if not future.done():
+                    # Cancelled by stop() mid-upload
+                    future.set_result(ACK_FAILED)
+                self.in_flight -= 1
+                payload.close()
+                self._slots.release()
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        running = self._queue is not None
+        return {
+            "running": running,
+            "workers": self.workers,
+            "queue_capacity": self.queue_size,
+            "queue_depth": self._queue.qsize() if running else 0,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+
+ingest_pool = IngestPool()
+forward_queue = ForwardQueue(store_image, create_derivatives)
+
+metrics.register_gauge_callback(
+    "ezrad_tcp_ingest_queue_depth", "Uploads waiting for a TCP ingest worker",
+    lambda: ingest_pool.stats()["queue_depth"])
+metrics.register_gauge_callback(
+    "ezrad_tcp_ingest_in_flight", "Uploads currently running on TCP ingest workers",
+    lambda: ingest_pool.in_flight)
+metrics.register_gauge_callback(
+    "ezrad_tcp_forward_queue_depth", "Acknowledged images waiting in the store-and-forward queue",
+    lambda: forward_queue.depth)
+metrics.register_gauge_callback(
+    "ezrad_tcp_forward_oldest_seconds", "Age of the oldest image waiting in the store-and-forward queue",
+    forward_queue.oldest_age)
+
+
+def get_ingest_stats() -> dict:
+    """Queue depth and in-flight counts of the TCP ingest pool (and the store-and-forward queue)."""
+    stats = ingest_pool.stats()
+    stats["connections"] = len(connections)
+    stats["draining"] = draining.is_set()
+    stats["store_and_forward"] = forward_queue.stats() if STORE_AND_FORWARD else {"enabled": False}
+    return stats
+
+
+def ingest_health() -> dict:
+    """Body of GET /health/ingest; "disabled" when this process doesn't run the ingest server."""
+    stats = get_ingest_stats()
+    if not stats["running"]:
+        return {"status": "disabled"}
+    return {"status": "healthy", "ingest": stats}
+
 
 # --- Async TCP Server Logic ---
+# Tasks of the open connections, and whether the server is shutting down
+connections = set()
+draining = asyncio.Event()
+
 async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
     """
     Callback function to handle each client connection.
+    Connections opening with the protocol MAGIC use the framed multi-image mode,
+    anything else is treated as a legacy single-image upload.
     """
     addr = writer.get_extra_info('peername')
     print(f"Received connection from {addr}")
+    task = asyncio.current_task()
+    connections.add(task)
 
     try:
-        # Protocol:
-        # 1. Read Exam ID (36 bytes, UUID string)
-        exam_id_bytes = await reader.readexactly(36)
-        exam_id = exam_id_bytes.decode('utf-8')
-
-        # 2. Read file extension (10 bytes, padded with spaces)
-        file_ext_bytes = await reader.readexactly(10)
-        file_ext = file_ext_bytes.decode('utf-8').strip()
-
-        # 3. Read image size (8 bytes, 64-bit integer)
-        size_bytes = await reader.readexactly(8)
-        image_size = int.from_bytes(size_bytes, 'big')
-
-        # 4. Read the image data
-        image_bytes = await reader.readexactly(image_size)
-        
-        # Process the upload in a separate thread to avoid blocking the event loop
-        loop = asyncio.get_running_loop()
-        success = await loop.run_in_executor(
-            None, handle_image_upload, exam_id, file_ext, image_bytes
-        )
-
-        # 5. Send response back to client
-        if success:
-            writer.write(b"SUCCESS")
+        prefix = await reader.readexactly(len(MAGIC))
+        if prefix == MAGIC:
+            await handle_framed_connection(reader, writer, addr)
         else:
-            writer.write(b"FAILURE")
-        await writer.drain()
+            await handle_legacy_upload(reader, writer, addr, prefix)
 
     except asyncio.IncompleteReadError:
         print(f"Connection from {addr} closed unexpectedly or sent malformed data.")
     except Exception as e:
         print(f"An error occurred with connection {addr}: {e}")
     finally:
+        connections.discard(task)
         print(f"Closing connection with {addr}")
         writer.close()
-        await writer.wait_closed()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            # Dropped links are routine for resumable uploads
+            pass
+
+async def handle_legacy_upload(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, addr, prefix: bytes):
+    """
+    Single image per connection, answered with SUCCESS or FAILURE.
+    `prefix` holds the bytes already consumed while sniffing for the framed protocol.
+    """
+    # Protocol:
+    # 1. Read Exam ID (36 bytes, UUID string)
+    exam_id_bytes = prefix + await reader.readexactly(EXAM_ID_SIZE - len(prefix))
+    exam_id = exam_id_bytes.decode('utf-8')
+
+    # 2. Read file extension (10 bytes, padded with spaces)
+    file_ext_bytes = await reader.readexactly(EXTENSION_SIZE)
+    file_ext = file_ext_bytes.decode('utf-8').strip()
+
+    # 3. Read image size (8 bytes, 64-bit integer)
+    size_bytes = await reader.readexactly(SIZE_FIELD_SIZE)
+    image_size = int.from_bytes(size_bytes, 'big')
+
+    # 4. Stream the image data into a spooled payload once the ingest pool has room
+    try:
+        payload = await ingest_pool.receive(reader, image_size)
+    except PayloadTooLargeError as e:
+        print(f"Rejecting upload from {addr}: {e}")
+        writer.write(b"FAILURE")
+        await writer.drain()
+        return
+
+    # Process the upload on the dedicated worker pool to avoid blocking the event loop
+    status = await ingest_pool.upload(exam_id, file_ext, payload)
+
+    # 5. Send response back to client
+    if status == ACK_OK:
+        writer.write(b"SUCCESS")
+    else:
+        writer.write(b"FAILURE")
+    await writer.drain()
+
+async def send_ack(writer: asyncio.StreamWriter, write_lock: asyncio.Lock, seq: int, status: int):
+    """Write a single ack; the lock keeps acks from concurrent uploads from interleaving."""
+    async with write_lock:
+        writer.write(encode_ack(seq, status))
+        await writer.drain()
+
+async def process_frame(frame: Frame, payload: SpooledPayload, writer: asyncio.StreamWriter, write_lock: asyncio.Lock):
+    """Upload one framed image and acknowledge it by sequence number."""
+    try:
+        status = await ingest_pool.upload(frame.exam_id, frame.file_ext, payload)
+    except Exception as e:
+        print(f"Error processing frame {frame.seq}: {e}")
+        status = ACK_FAILED
+
+    try:
+        await send_ack(writer, write_lock, frame.seq, status)
+    except ConnectionError:
+        print(f"Could not acknowledge frame {frame.seq}: connection lost")
+
+async def handle_upload_frame(frame: Frame, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                              write_lock: asyncio.Lock, session_id: str, offset: int, total_size: int):
+    """RESUME and CHUNK frames of a resumable upload; their body (after UPLOAD_HEADER) is read here."""
+    body_size = frame.size - UPLOAD_HEADER.size
+    if frame.frame_type == FRAME_RESUME:
+        try:
+            uuid.UUID(frame.exam_id)
+            session = await ingest_pool.run(upload_sessions.create, frame.exam_id, frame.file_ext, total_size, session_id=session_id)
+        except (ValueError, UploadSessionError) as e:
+            print(f"Cannot resume upload {session_id}: {e}")
+            await send_ack(writer, write_lock, frame.seq, ACK_REJECTED)
+            return
+        async with write_lock:
+            writer.write(encode_ack(frame.seq, ACK_OFFSET) + OFFSET_FORMAT.pack(session.next_offset))
+            await writer.drain()
+        return
+
+    # CHUNK: bytes are recorded as they are written, so a chunk cut off mid-way still counts
+    body = FrameBody(reader, body_size, frame.compression)
+    try:
+        session = await ingest_pool.run(upload_sessions.get, session_id)
+        if frame.compression:
+            # Decoded and checked in memory first, so a corrupt chunk never reaches the part file
+            body.limit = min(session.size - offset, MAX_CHUNK_SIZE)
+            chunks = single_chunk(b"".join([piece async for piece in body]))
+        elif offset + body_size > session.size:
+            raise UploadSessionError(f"Chunk runs past the end of the {session.size}-byte upload")
+        else:
+            chunks = body
+        await upload_sessions.receive(session, offset, chunks, ingest_pool.run)
+    except (UploadSessionError, PayloadTooLargeError, CompressionError) as e:
+        print(f"Rejecting chunk {frame.seq} of upload {session_id}: {e}")
+        await body.drain()
+        await send_ack(writer, write_lock, frame.seq, ACK_FAILED)
+        return
+    await send_ack(writer, write_lock, frame.seq, ACK_OK)
+
+async def process_commit(frame: Frame, session_id: str, writer: asyncio.StreamWriter, write_lock: asyncio.Lock):
+    """Store a completed resumable upload through the ingest pool and acknowledge the COMMIT frame."""
+    status = ACK_FAILED
+    snapshot_path = None
+    adopted = False
+    try:
+        session, snapshot_path = await ingest_pool.run(upload_sessions.snapshot, session_id)
+        payload = await ingest_pool.run(SpooledPayload.from_file, snapshot_path)
+        # The pool owns (and closes) the payload, and with it the snapshot, from here on
+        adopted = True
+        status = await ingest_pool.submit(session.exam_id, session.file_ext, payload)
+        if status != ACK_FAILED:
+            # Kept on failure, so the client can commit again
+            await ingest_pool.run(upload_sessions.finish, session_id)
+    except UploadSessionIncomplete as e:
+        print(f"Commit of upload {session_id}: {e}")
+        status = ACK_INCOMPLETE
+    except Exception as e:
+        print(f"Error committing upload {session_id}: {e}")
+    finally:
+        if snapshot_path is not None and not adopted:
+            try:
+                os.remove(snapshot_path)
+            except FileNotFoundError:
+                pass
+
+    try:
+        await send_ack(writer, write_lock, frame.seq, status)
+    except ConnectionError:
+        print(f"Could not acknowledge commit {frame.seq}: connection lost")
+
+async def handle_framed_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, addr):
+    """
+    Versioned framed mode: one connection carries any number of images for any exams.
+    Frames are uploaded concurrently (up to MAX_INFLIGHT_PER_CONNECTION) and acked by sequence id.
+    """
+    # 1. Finish reading the handshake and agree on version/features
+    handshake = MAGIC + await reader.readexactly(HANDSHAKE.size - len(MAGIC))
+    version, features = decode_handshake(handshake)
+    if version < 1:
+        print(f"Unsupported protocol version {version} from {addr}")
+        return
+    accepted_version = min(version, PROTOCOL_VERSION)
+    accepted_features = features & SUPPORTED_FEATURES
+    writer.write(encode_handshake(accepted_version, accepted_features))
+    await writer.drain()
+    print(f"Framed session v{accepted_version} established with {addr}")
+
+    write_lock = asyncio.Lock()
+    window = asyncio.Semaphore(MAX_INFLIGHT_PER_CONNECTION)
+    pending = set()
+    drained = asyncio.ensure_future(draining.wait())
+
+    def on_frame_done(task):
+        pending.discard(task)
+        window.release()
+
+    try:
+        while True:
+            # 2. Read the next frame header; a draining server ends the session between frames
+            header = await next_frame_header(reader, drained)
+            if header is None:
+                print(f"Ending framed session with {addr}: server is shutting down")
+                break
+            try:
+                frame = decode_frame_header(header)
+            except FrameError as e:
+                # The body can't be attributed to an exam, so the session ends here
+                print(f"Rejecting frame {e.seq} from {addr}: {e}")
+                await send_ack(writer, write_lock, e.seq, ACK_BAD_FRAME)
+                break
+
+            if frame.frame_type == FRAME_BYE:
+                break
+            if frame.compression and (frame.frame_type not in COMPRESSIBLE_FRAMES
+                                      or not accepted_features & COMPRESSION_FEATURES.get(frame.compression, 0)):
+                print(f"Frame {frame.seq} from {addr} uses compression {frame.compression:#x}, which was not negotiated")
+                await send_ack(writer, write_lock, frame.seq, ACK_BAD_FRAME)
+                break
+            if frame.frame_type in RESUMABLE_FRAMES and accepted_features & FEATURE_RESUMABLE:
+                body_size = frame.size - UPLOAD_HEADER.size
+                if body_size < 0 or body_size > (MAX_CHUNK_SIZE if frame.frame_type == FRAME_CHUNK else 0):
+                    print(f"Rejecting frame {frame.seq} from {addr}: bad resumable frame size {frame.size}")
+                    await send_ack(writer, write_lock, frame.seq, ACK_TOO_LARGE if body_size > 0 else ACK_BAD_FRAME)
+                    break
+                upload_id, offset, total_size = decode_upload_header(await reader.readexactly(UPLOAD_HEADER.size))
+                if frame.frame_type != FRAME_COMMIT:
+                    await handle_upload_frame(frame, reader, writer, write_lock, upload_id.hex(), offset, total_size)
+                    continue
+                # Commits are stored in the background like images
+                await window.acquire()
+                task = asyncio.create_task(process_commit(frame, upload_id.hex(), writer, write_lock))
+                pending.add(task)
+                task.add_done_callback(on_frame_done)
+                continue
+            if frame.frame_type != FRAME_IMAGE:
+                print(f"Unknown frame type {frame.frame_type} from {addr}")
+                await send_ack(writer, write_lock, frame.seq, ACK_BAD_FRAME)
+                break
+            if frame.size > MAX_PAYLOAD_SIZE:
+                # The body cannot be skipped cheaply, so the session ends here
+                print(f"Rejecting frame {frame.seq} from {addr}: {frame.size} bytes exceeds limit")
+                await send_ack(writer, write_lock, frame.seq, ACK_TOO_LARGE)
+                break
+
+            # 3. Stop reading from the socket while the in-flight window or the ingest pool is full
+            await window.acquire()
+            try:
+                payload = await ingest_pool.receive(reader, frame.size, frame.compression)
+            except (PayloadTooLargeError, CompressionError) as e:
+                # The rest of the body was skipped, so the session can carry on
+                window.release()
+                print(f"Rejecting frame {frame.seq} from {addr}: {e}")
+                await send_ack(writer, write_lock, frame.seq,
+                               ACK_TOO_LARGE if isinstance(e, PayloadTooLargeError) else ACK_BAD_FRAME)
+                continue
+            except BaseException:
+                window.release()
+                raise
+
+            # 4. Upload in the background and keep reading the next frame
+            task = asyncio.create_task(process_frame(frame, payload, writer, write_lock))
+            pending.add(task)
+            task.add_done_callback(on_frame_done)
+    finally:
+        drained.cancel()
+        # Every frame that was fully received still gets uploaded and acked
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+async def next_frame_header(reader: asyncio.StreamReader, drained: asyncio.Future) -> Optional[bytes]:
+    """The next frame header, or None once the server starts draining while the client is between frames."""
+    if drained.done():
+        return None
+    read = asyncio.ensure_future(reader.readexactly(FRAME_HEADER.size))
+    await asyncio.wait((read, drained), return_when=asyncio.FIRST_COMPLETED)
+    if read.done():
+        return read.result()
+    # A frame cut off here was never acked, so the client sends it again elsewhere
+    read.cancel()
+    return None
+
+async def drain_connections(timeout: float = DRAIN_TIMEOUT):
+    """
+    Let open connections finish: framed sessions stop after the frame being
+    received and wait for its ack, legacy uploads complete. Connections still
+    open after `timeout` seconds are cancelled.
+    """
+    draining.set()
+    if not connections:
+        return
+    print(f"TCP server draining {len(connections)} connection(s) (up to {timeout:.0f}s)")
+    _, unfinished = await asyncio.wait(set(connections), timeout=timeout)
+    for task in unfinished:
+        task.cancel()
+    if unfinished:
+        print(f"TCP server: cut off {len(unfinished)} connection(s) still open after {timeout:.0f}s")
+        await asyncio.gather(*unfinished, return_exceptions=True)
+
+async def handle_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Answer one HTTP/1.0 GET for /metrics or /health/ingest, then close the connection."""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        # Headers are read and ignored
+        while await asyncio.wait_for(reader.readline(), timeout=5) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        path = parts[1].split("?", 1)[0] if len(parts) >= 2 and parts[0] in ("GET", "HEAD") else None
+        if path == "/metrics":
+            status, content_type, body = "200 OK", "text/plain; version=0.0.4", metrics.render_prometheus()
+        elif path == "/health/ingest":
+            status, content_type, body = "200 OK", "application/json", json.dumps(ingest_health())
+        elif path is None:
+            status, content_type, body = "405 Method Not Allowed", "text/plain", "Method not allowed\n"
+        else:
+            status, content_type, body = "404 Not Found", "text/plain", "Not found\n"
+        data = body.encode("utf-8")
+        writer.write(f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode("latin-1"))
+        if parts[:1] != ["HEAD"]:
+            writer.write(data)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server(port: int):
+    """Listener for the ingest process's /metrics and /health/ingest; close() it on shutdown."""
+    server = await asyncio.start_server(handle_metrics_request, METRICS_HOST, port)
+    print(f"Ingest metrics on http://{METRICS_HOST}:{port}/metrics and /health/ingest")
+    return server
 
 async def start_server():
     """
-    Starts the asyncio TCP server.
+    Starts the asyncio TCP server. Cancelling it drains: new connections are
+    refused while open ones finish (see drain_connections).
     """
-    server = await asyncio.start_server(handle_connection, HOST, PORT)
-    print(f"TCP server started, listening on {HOST}:{PORT}")
-    async with server:
+    global draining
+    # A fresh event per run, bound to this event loop
+    draining = asyncio.Event()
+    await ingest_pool.start()
+    if STORE_AND_FORWARD:
+        # Recovers images acknowledged before a restart
+        await forward_queue.start()
+    server = None
+    try:
+        server = await asyncio.start_server(handle_connection, HOST, PORT, reuse_port=REUSE_PORT or None)
+        print(f"TCP server started, listening on {HOST}:{PORT} "
+              f"({ingest_pool.workers} upload workers, queue size {ingest_pool.queue_size}"
+              + (", shared port" if REUSE_PORT else "")
+              + (f", store-and-forward via {forward_queue.directory}" if STORE_AND_FORWARD else "") + ")")
         await server.serve_forever()
+    finally:
+        if server is not None:
+            server.close()
+        await drain_connections()
+        await ingest_pool.stop(DRAIN_TIMEOUT)
+        if STORE_AND_FORWARD:
+            await forward_queue.stop()
 
 if __name__ == '__main__':
     # This allows running the server standalone for testing
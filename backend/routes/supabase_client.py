@@ -0,0 +1,150 @@
+"""
+Shared Supabase data-access layer for EZRAD
+Every router and the TCP ingest server use the single client defined here, so
+all PostgREST and storage traffic goes through one pooled set of HTTP connections.
+The Supabase client is synchronous; async route handlers run its blocking calls
+on a dedicated thread pool through `execute()` / `run_blocking()` so a slow
+PostgREST call never stalls the event loop.
+"""
+
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
+import httpx
+from supabase import create_client, Client
+from dotenv import load_dotenv
+
+try:
+    # Newer supabase-py releases accept a caller-supplied httpx client
+    from supabase.lib.client_options import SyncClientOptions
+except ImportError:
+    SyncClientOptions = None
+
+try:
+    from . import metrics
+except ImportError:
+    import metrics
+
+# Load environment variables
+load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), "..", ".env"))
+
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+
+if not SUPABASE_URL or not SUPABASE_KEY:
+    raise ValueError("Missing SUPABASE_URL or SUPABASE_KEY in environment!")
+
+# Threads available for blocking Supabase calls, and HTTP connections kept in the pool
+DB_POOL_SIZE = int(os.getenv("SUPABASE_POOL_SIZE", "20"))
+DB_MAX_CONNECTIONS = int(os.getenv("SUPABASE_MAX_CONNECTIONS", str(DB_POOL_SIZE * 2)))
+DB_TIMEOUT = float(os.getenv("SUPABASE_TIMEOUT", "30"))
+
+EXAM_IMAGES_BUCKET = "exam-images"
+
+
+# Connection pool under the shared client (None when supabase-py manages its own)
+_http_transport = None
+
+
+def _create_shared_client() -> Client:
+    """Create the process-wide client on top of one pooled httpx connection set."""
+    global _http_transport
+    if SyncClientOptions is None:
+        return create_client(SUPABASE_URL, SUPABASE_KEY)
+
+    # The transport is ours so shutdown() can close its connections; the pool
+    # reconnects on demand, so the client stays usable for a later lifespan
+    _http_transport = httpx.HTTPTransport(
+        limits=httpx.Limits(
+            max_connections=DB_MAX_CONNECTIONS,
+            max_keepalive_connections=DB_POOL_SIZE,
+        ),
+    )
+    http_client = httpx.Client(transport=_http_transport, timeout=DB_TIMEOUT, follow_redirects=True)
+    return create_client(SUPABASE_URL, SUPABASE_KEY, options=SyncClientOptions(httpx_client=http_client))
+
+
+def _create_executor() -> ThreadPoolExecutor:
+    # Threads are only started once calls arrive
+    return ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="ezrad-db")
+
+
+supabase: Client = _create_shared_client()
+
+_db_executor = _create_executor()
+
+
+def query_target(query) -> str:
+    """Metrics label for a query builder: the table name, or rpc:<function> for RPC calls."""
+    request = getattr(query, "request", None)
+    path = str(getattr(request, "path", None) or getattr(query, "path", "") or "")
+    parts = [part for part in path.split("?")[0].split("/") if part]
+    if len(parts) >= 2 and parts[-2] == "rpc":
+        return f"rpc:{parts[-1]}"
+    return parts[-1] if parts else "unknown"
+
+
+@contextmanager
+def observe_call(target: str):
+    """Record the count, outcome and duration of one Supabase call."""
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        metrics.supabase_calls_total.inc(table=target, outcome=outcome)
+        metrics.supabase_call_duration_seconds.observe(time.perf_counter() - started, table=target)
+
+
+def execute_sync(query):
+    """Execute a query builder on the calling thread, recording call metrics."""
+    with observe_call(query_target(query)):
+        return query.execute()
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Run blocking work (storage calls, header parsing, ...) on the data-access thread
+    pool. The Supabase calls inside record their own metrics: queries through
+    execute_sync(), storage calls under observe_call("storage:<operation>").
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, partial(func, *args, **kwargs))
+
+
+async def execute(query):
+    """Await a PostgREST query builder without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, execute_sync, query)
+
+
+def exam_images_bucket():
+    """Storage bucket holding exam images."""
+    return supabase.storage.from_(EXAM_IMAGES_BUCKET)
+
+
+def storage_upload_succeeded(storage_response) -> bool:
+    """
+    Older storage clients return the raw HTTP response from upload(), newer ones
+    return an UploadResponse and raise on failure.
+    """
+    status_code = getattr(storage_response, "status_code", None)
+    return status_code is None or status_code == 200
+
+
+def shutdown():
+    """
+    Release the data-access thread pool and close the pooled HTTP connections.
+    A fresh (idle) pool replaces the old one, so the app can be started again in
+    the same process, as test clients and embedded servers do.
+    """
+    global _db_executor
+    executor, _db_executor = _db_executor, _create_executor()
+    executor.shutdown(wait=False)
+    if _http_transport is not None:
+        _http_transport.close()
@@ -7,22 +7,10 @@ from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel, validator
 from typing import Optional, List
 from datetime import datetime
-import os
-from supabase import create_client, Client
-from dotenv import load_dotenv
+from .supabase_client import supabase, execute
+from .entity_cache import tech_cache, ALL_TECHS
 import uuid
 
-# Load environment variables
-load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), "..", ".env"))
-
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-
-if not SUPABASE_URL or not SUPABASE_KEY:
-    raise ValueError("Missing SUPABASE_URL or SUPABASE_KEY in environment!")
-
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-
 # Create router
 router = APIRouter()
 
@@ -96,9 +84,10 @@ async def create_tech(tech: TechCreate):
         if tech.phone is not None:
             insert_data["phone"] = tech.phone
             
-        result = supabase.table("technicians").insert(insert_data).execute()
+        result = await execute(supabase.table("technicians").insert(insert_data))
         
         if result.data:
+            tech_cache.invalidate(ALL_TECHS)
             return result.data[0]
         else:
             raise HTTPException(status_code=400, detail="Failed to create technician")
@@ -110,8 +99,11 @@ async def create_tech(tech: TechCreate):
 async def get_all_techs():
     """Get all technicians from the database"""
     try:
-        result = supabase.table("technicians").select("*").execute()
-        return result.data
+        async def load():
+            result = await execute(supabase.table("technicians").select("*"))
+            return result.data
+
+        return await tech_cache.get_or_load(ALL_TECHS, load)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
@@ -125,12 +117,15 @@ async def get_tech(tech_id: str):  # Changed to str for UUID
         except ValueError:
             raise HTTPException(status_code=400, detail="Invalid UUID format")
             
-        result = supabase.table("technicians").select("*").eq("id", tech_id).execute()
-        
-        if not result.data:
+        async def load():
+            result = await execute(supabase.table("technicians").select("*").eq("id", tech_id))
+            return result.data[0] if result.data else None
+
+        tech = await tech_cache.get_or_load(tech_id, load)
+        if tech is None:
             raise HTTPException(status_code=404, detail="Technician not found")
             
-        return result.data[0]
+        return tech
     except HTTPException:
         raise
     except Exception as e:
@@ -146,11 +141,13 @@ async def delete_tech(tech_id: str):  # Changed to str for UUID
         except ValueError:
             raise HTTPException(status_code=400, detail="Invalid UUID format")
             
-        result = supabase.table("technicians").delete().eq("id", tech_id).execute()
+        result = await execute(supabase.table("technicians").delete().eq("id", tech_id))
         
         if not result.data:
             raise HTTPException(status_code=404, detail="Technician not found")
             
+        tech_cache.invalidate(tech_id, ALL_TECHS)
+
         return {"message": "Technician deleted successfully"}
     except HTTPException:
         raise
@@ -161,7 +158,7 @@ async def delete_tech(tech_id: str):  # Changed to str for UUID
 async def search_techs_by_name(name: str):
     """Search technicians by name (case-insensitive partial match)"""
     try:
-        result = supabase.table("technicians").select("*").ilike("full_name", f"%{name}%").execute()
+        result = await execute(supabase.table("technicians").select("*").ilike("full_name", f"%{name}%"))
         return result.data
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
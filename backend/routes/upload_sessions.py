@@ -0,0 +1,327 @@
+"""
+Resumable upload sessions shared by the HTTP upload routes and the TCP ingest server
+A session is opened for one image of known size. Chunks may arrive in any order
+and over any number of connections: each is written at its offset into a part
+file and the received byte ranges are recorded in a JSON manifest beside it.
+A dropped connection only loses bytes that never arrived; the client asks for
+the received ranges and carries on from there. Once every byte is present the
+session is committed and the part file goes through the normal ingest path.
+
+Sessions live on disk (UPLOAD_SESSION_DIR), so they survive restarts and are
+shared by every worker process on the host.
+"""
+
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: sessions are still locked within a process
+    fcntl = None
+
+UPLOAD_SESSION_DIR = os.getenv("UPLOAD_SESSION_DIR") or os.path.join(tempfile.gettempdir(), "ezrad-upload-sessions")
+# Idle sessions are discarded after this many seconds (every chunk extends the deadline)
+UPLOAD_SESSION_TTL = float(os.getenv("UPLOAD_SESSION_TTL", str(24 * 3600)))
+UPLOAD_SESSION_MAX_SIZE = int(os.getenv("UPLOAD_SESSION_MAX_SIZE", str(2 * 1024 * 1024 * 1024)))
+
+_SESSION_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+class UploadSessionError(Exception):
+    """Raised when a request doesn't fit its session (bad offset, size mismatch, incomplete commit)."""
+
+
+class UploadSessionNotFound(UploadSessionError):
+    """Raised for unknown, expired or already committed sessions."""
+
+
+class UploadSessionIncomplete(UploadSessionError):
+    """Raised when a session is committed before every byte has arrived."""
+
+
+class UploadSessionComplete(UploadSessionError):
+    """Raised for a write to a session that has every byte (a commit may be hashing its data)."""
+
+
+def _flush_to_disk(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def merge_range(ranges: List[List[int]], start: int, end: int) -> List[List[int]]:
+    """Add [start, end) to a sorted list of disjoint ranges, coalescing neighbours."""
+    merged = []
+    for current in sorted(ranges + [[start, end]]):
+        if merged and current[0] <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], current[1])
+        else:
+            merged.append(list(current))
+    return merged
+
+
+class UploadSession:
+    """Manifest of one resumable upload."""
+
+    def __init__(self, session_id: str, exam_id: str, file_ext: str, size: int,
+                 sha256: Optional[str] = None, received: Optional[List[List[int]]] = None,
+                 created_at: Optional[float] = None, expires_at: Optional[float] = None):
+        self.id = session_id
+        self.exam_id = exam_id
+        self.file_ext = file_ext
+        self.size = size
+        self.sha256 = sha256
+        self.received = received or []
+        self.created_at = created_at or time.time()
+        self.expires_at = expires_at or self.created_at + UPLOAD_SESSION_TTL
+
+    @property
+    def next_offset(self) -> int:
+        """End of the contiguous prefix received so far: where a sequential client resumes."""
+        if self.received and self.received[0][0] == 0:
+            return self.received[0][1]
+        return 0
+
+    @property
+    def complete(self) -> bool:
+        return self.next_offset == self.size
+
+    def missing(self) -> List[List[int]]:
+        gaps, position = [], 0
+        for start, end in self.received:
+            if start > position:
+                gaps.append([position, start])
+            position = end
+        if position < self.size:
+            gaps.append([position, self.size])
+        return gaps
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "id": self.id, "exam_id": self.exam_id, "file_ext": self.file_ext, "size": self.size,
+            "sha256": self.sha256, "received": self.received,
+            "created_at": self.created_at, "expires_at": self.expires_at,
+        }
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Public status, as returned by the HTTP routes."""
+        return {
+            "upload_id": self.id,
+            "exam_id": self.exam_id,
+            "file_ext": self.file_ext,
+            "size": self.size,
+            "received": self.received,
+            "next_offset": self.next_offset,
+            "complete": self.complete,
+            "expires_at": datetime.fromtimestamp(self.expires_at, timezone.utc).isoformat(),
+        }
+
+
+class UploadSessionStore:
+    """Sessions as <id>.part (data) + <id>.json (manifest) files in one directory."""
+
+    def __init__(self, directory: str = UPLOAD_SESSION_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def _path(self, session_id: str, suffix: str) -> str:
+        if not _SESSION_ID.match(session_id or ""):
+            raise UploadSessionNotFound("Unknown upload session")
+        return os.path.join(self.directory, session_id + suffix)
+
+    @contextmanager
+    def _locked(self, session_id: str):
+        """Serialise manifest updates for a session across threads and, where flock exists, processes."""
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            try:
+                lock_file = open(self._path(session_id, ".lock"), "a")
+            except FileNotFoundError:
+                # No session has been opened in this directory yet
+                raise UploadSessionNotFound("Unknown upload session")
+            with lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if not os.path.exists(self._path(session_id, ".json")):
+                        # Looked up an unknown session, or removed it: don't leave the lock file behind
+                        try:
+                            os.remove(lock_file.name)
+                        except FileNotFoundError:
+                            pass
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load(self, session_id: str) -> UploadSession:
+        try:
+            with open(self._path(session_id, ".json")) as f:
+                session = UploadSession(**{("session_id" if k == "id" else k): v for k, v in json.load(f).items()})
+        except (FileNotFoundError, ValueError, TypeError):
+            raise UploadSessionNotFound("Unknown upload session")
+        if session.expires_at < time.time():
+            self._remove(session_id)
+            raise UploadSessionNotFound("Upload session expired")
+        return session
+
+    def _save(self, session: UploadSession):
+        # Write-then-rename so a crash never leaves a half-written manifest
+        manifest_path = self._path(session.id, ".json")
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(session.to_json(), f)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    def _remove(self, session_id: str):
+        for suffix in (".json", ".lock", ".part"):
+            try:
+                os.remove(self._path(session_id, suffix))
+            except FileNotFoundError:
+                pass
+
+    def create(self, exam_id: str, file_ext: str, size: int, sha256: Optional[str] = None,
+               session_id: Optional[str] = None) -> UploadSession:
+        """
+        Open a session (a fresh id unless the client supplies one). Opening an id
+        that already exists for the same image returns it unchanged, so clients
+        that pick their own ids can simply re-open after a reconnect.
+        """
+        if size < 0 or size > UPLOAD_SESSION_MAX_SIZE:
+            raise UploadSessionError(f"Upload size must be between 0 and {UPLOAD_SESSION_MAX_SIZE} bytes")
+        os.makedirs(self.directory, exist_ok=True)
+        self.purge_expired()
+        session_id = session_id or uuid.uuid4().hex
+        with self._locked(session_id):
+            try:
+                session = self._load(session_id)
+            except UploadSessionNotFound:
+                session = None
+            if session is not None:
+                if (session.exam_id, session.file_ext, session.size) != (exam_id, file_ext, size):
+                    raise UploadSessionError("Upload session exists for a different image")
+                return session
+            session = UploadSession(session_id, exam_id, file_ext, size, sha256)
+            with open(self._path(session_id, ".part"), "wb") as f:
+                f.truncate(size)
+            self._save(session)
+            return session
+
+    def get(self, session_id: str) -> UploadSession:
+        with self._locked(session_id):
+            return self._load(session_id)
+
+    def _record(self, session_id: str, start: int, end: int) -> UploadSession:
+        with self._locked(session_id):
+            session = self._load(session_id)
+            session.received = merge_range(session.received, start, end)
+            session.expires_at = time.time() + UPLOAD_SESSION_TTL
+            self._save(session)
+            return session
+
+    def _open_part(self, session_id: str):
+        """
+        The part file, opened for writing. Refused once the session is complete:
+        snapshot() shares the file with the commit, whose bytes must not change
+        after they have been hashed.
+        """
+        with self._locked(session_id):
+            if self._load(session_id).complete:
+                raise UploadSessionComplete("Upload is already complete; commit it")
+            return open(self._path(session_id, ".part"), "r+b")
+
+    async def receive(self, session: UploadSession, offset: int, chunks: AsyncIterator[bytes],
+                      run: Callable[..., Awaitable[Any]]) -> UploadSession:
+        """
+        Write a chunk stream at `offset`. Whatever arrived is recorded even if the
+        stream breaks off, so the next attempt resumes from the last byte received.
+        `run` awaits the file I/O on the caller's thread pool (run_blocking, or the
+        TCP ingest pool's).
+        """
+        if offset < 0 or offset > session.size:
+            raise UploadSessionError(f"Offset must be between 0 and {session.size}")
+        data_file = await run(self._open_part, session.id)
+        data_file.seek(offset)
+        written = 0
+        try:
+            async for chunk in chunks:
+                if offset + written + len(chunk) > session.size:
+                    raise UploadSessionError(f"Chunk runs past the end of the {session.size}-byte upload")
+                await run(data_file.write, chunk)
+                written += len(chunk)
+        finally:
+            try:
+                if written:
+                    # Data must be on disk before the manifest claims it
+                    await run(_flush_to_disk, data_file)
+                    session = await run(self._record, session.id, offset, offset + written)
+            finally:
+                data_file.close()
+        return session
+
+    def snapshot(self, session_id: str) -> Tuple[UploadSession, str]:
+        """
+        For a complete session, a hard link (or copy) of its data file that the
+        caller owns and removes. A complete session accepts no more writes, so the
+        link's bytes stay fixed. The session itself stays until finish(), so a
+        commit that fails downstream can simply be retried.
+        """
+        with self._locked(session_id):
+            session = self._load(session_id)
+            if not session.complete:
+                raise UploadSessionIncomplete(f"Upload is incomplete; missing byte ranges {session.missing()}")
+            part_path = self._path(session_id, ".part")
+            snapshot_path = os.path.join(self.directory, f"{session_id}.{uuid.uuid4().hex}.commit")
+            try:
+                os.link(part_path, snapshot_path)
+            except OSError:
+                shutil.copyfile(part_path, snapshot_path)
+            return session, snapshot_path
+
+    def finish(self, session_id: str):
+        """Remove a committed session."""
+        with self._locked(session_id):
+            self._remove(session_id)
+
+    def delete(self, session_id: str):
+        with self._locked(session_id):
+            self._load(session_id)
+            self._remove(session_id)
+
+    def purge_expired(self):
+        """Remove sessions past their deadline (run whenever a session is opened)."""
+        now = time.time()
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if name.endswith(".commit"):
+                # Left behind by a commit interrupted by a crash
+                try:
+                    if os.path.getmtime(path) + UPLOAD_SESSION_TTL < now:
+                        os.remove(path)
+                except OSError:
+                    pass
+                continue
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(path) as f:
+                    expired = json.load(f).get("expires_at", 0) < now
+            except (OSError, ValueError):
+                continue
+            if expired:
+                self._remove(name[:-len(".json")])
+
+
+upload_sessions = UploadSessionStore()
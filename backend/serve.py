@@ -0,0 +1,245 @@
+"""
+Production launcher for EZRAD.
+Runs the HTTP API as N uvicorn worker processes and the TCP ingest server in
+processes of its own, so HTTP throughput scales across cores without every
+worker trying to bind the ingest port. HTTP workers start with
+TCP_SERVER_ENABLED=false; with several ingest processes they share TCP_PORT
+through SO_REUSEPORT and the kernel spreads connections between them.
+
+    python serve.py --workers 4 --ingest-processes 2   # supervise both
+    python serve.py http --workers 4                   # HTTP only (ingest runs elsewhere)
+    python serve.py ingest                             # one ingest process
+
+Every process reads the same environment and .env file. A process that exits
+unexpectedly is restarted. SIGTERM or SIGINT drains everything: uvicorn stops
+accepting requests and finishes the ones in flight, and each ingest process
+refuses new connections while open ones finish the frames they have sent
+(both within --drain-timeout seconds).
+
+Each process keeps its own caches, exam event stream and metrics. /metrics on
+the HTTP port reports whichever uvicorn worker answered it, and HTTP workers
+have no ingest pool (/health/ingest says "disabled"); ingest process i serves
+its own /metrics and /health/ingest on TCP_METRICS_PORT + i (default 9101). Set
+CACHE_INVALIDATION_REDIS_URL (and install redis) so an exam deleted through one
+HTTP worker is forgotten by the others and by the ingest processes, and so the
+dashboard's event stream (/api/v1/events/exams) carries changes from every
+worker and images received over TCP. Without it, SSE clients only see changes
+made by the worker they are connected to and no TCP image events.
+
+With store-and-forward, ingest process i > 0 queues under
+TCP_FORWARD_DIR/ingest-<i> so no two processes recover the same entries.
+Ingest process 0 takes over the queues of indexes no longer running (after
+--ingest-processes was lowered).
+"""
+import argparse
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+HTTP_HOST = os.getenv("HTTP_HOST", "0.0.0.0")
+HTTP_PORT = int(os.getenv("HTTP_PORT", "8000"))
+HTTP_WORKERS = int(os.getenv("HTTP_WORKERS", str(os.cpu_count() or 1)))
+INGEST_PROCESSES = int(os.getenv("TCP_INGEST_PROCESSES", "1"))
+DRAIN_TIMEOUT = float(os.getenv("TCP_DRAIN_TIMEOUT", "30"))
+# Restart delay for a process that exited, doubled while it keeps failing
+RESTART_DELAY = 1.0
+RESTART_MAX_DELAY = 30.0
+# A process that ran this long counts as healthy again
+RESTART_RESET_AFTER = 60.0
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def http_command(args) -> list:
+    return [
+        sys.executable, "-m", "uvicorn", "main:app",
+        "--host", args.host, "--port", str(args.port), "--workers", str(args.workers),
+        "--timeout-graceful-shutdown", str(int(args.drain_timeout)),
+    ]
+
+
+def ingest_command(index: int, processes: int) -> list:
+    return [sys.executable, os.path.join(BACKEND_DIR, "serve.py"), "ingest",
+            "--index", str(index), "--ingest-processes", str(processes)]
+
+
+class Child:
+    """One supervised process and its restart state."""
+
+    def __init__(self, name: str, command: list, env: dict):
+        self.name = name
+        self.command = command
+        self.env = env
+        self.process = None
+        self.started_at = 0.0
+        self.delay = RESTART_DELAY
+        self.restart_at = None
+
+    def start(self):
+        # Own session: a Ctrl+C in the terminal reaches only the supervisor, which forwards one SIGTERM
+        self.process = subprocess.Popen(self.command, env=self.env, cwd=BACKEND_DIR, start_new_session=os.name == "posix")
+        self.started_at = time.monotonic()
+        self.restart_at = None
+        print(f"serve: started {self.name} (pid {self.process.pid})")
+
+    def check(self):
+        """Restart the process once it has exited and its backoff has passed."""
+        now = time.monotonic()
+        if self.restart_at is not None:
+            if now >= self.restart_at:
+                self.start()
+            return
+        code = self.process.poll()
+        if code is None:
+            return
+        if now - self.started_at >= RESTART_RESET_AFTER:
+            self.delay = RESTART_DELAY
+        print(f"serve: {self.name} exited with code {code}; restarting in {self.delay:.0f}s")
+        self.restart_at = now + self.delay
+        self.delay = min(RESTART_MAX_DELAY, self.delay * 2)
+
+    def terminate(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+
+
+def supervise(children: list, drain_timeout: float) -> int:
+    """Run `children` until SIGTERM/SIGINT, then drain them and return."""
+    stopping = []
+
+    def request_stop(signum, frame):
+        if not stopping:
+            print(f"serve: {signal.Signals(signum).name} received, draining")
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    for child in children:
+        child.start()
+    while not stopping:
+        time.sleep(0.5)
+        if not stopping:
+            for child in children:
+                child.check()
+
+    for child in children:
+        child.terminate()
+    # uvicorn and the ingest server each stop within drain_timeout; allow for their own shutdown on top
+    deadline = time.monotonic() + drain_timeout + 10
+    for child in children:
+        if child.process is None:
+            continue
+        try:
+            child.process.wait(timeout=max(0.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            print(f"serve: {child.name} did not stop in time; killing it")
+            child.process.kill()
+            child.process.wait()
+    print("serve: stopped")
+    return 0
+
+
+def adopt_orphaned_forward_dirs(forward_queue, processes: int):
+    """Move queued images of ingest-<i> directories with i >= processes into process 0's queue."""
+    try:
+        names = os.listdir(forward_queue.directory)
+    except FileNotFoundError:
+        return
+    for name in names:
+        index = name[len("ingest-"):]
+        if not name.startswith("ingest-") or not index.isdigit() or int(index) < processes:
+            continue
+        moved = forward_queue.adopt(os.path.join(forward_queue.directory, name))
+        if moved:
+            print(f"Ingest process 0: took over {moved} queued image(s) from {name}")
+
+
+def run_ingest(index: int, processes: int = 1) -> int:
+    """One ingest process: the TCP server alone, drained on SIGTERM/SIGINT."""
+    # Imported here so the supervisor itself never loads the routes (or connects to Supabase)
+    from routes import socket_server
+    from routes.entity_cache import start_invalidation_listener, stop_invalidation_listener
+    from routes.supabase_client import shutdown as shutdown_data_access
+
+    if index > 0:
+        # Each process recovers only its own store-and-forward entries
+        socket_server.forward_queue.directory = os.path.join(socket_server.forward_queue.directory, f"ingest-{index}")
+    else:
+        adopt_orphaned_forward_dirs(socket_server.forward_queue, processes)
+
+    async def serve():
+        server_task = asyncio.current_task()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, server_task.cancel)
+            except NotImplementedError:
+                # Windows: Ctrl+C still interrupts, just without draining
+                pass
+        start_invalidation_listener()
+        metrics_server = None
+        try:
+            if socket_server.METRICS_PORT:
+                metrics_server = await socket_server.start_metrics_server(socket_server.METRICS_PORT + index)
+            await socket_server.start_server()
+        except asyncio.CancelledError:
+            print(f"Ingest process {index} stopped")
+        finally:
+            if metrics_server is not None:
+                metrics_server.close()
+            stop_invalidation_listener()
+
+    try:
+        asyncio.run(serve())
+    finally:
+        shutdown_data_access()
+    return 0
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Run the EZRAD HTTP API and TCP ingest server.")
+    parser.add_argument("mode", nargs="?", choices=("all", "http", "ingest"), default="all",
+                        help="all: supervise HTTP workers and ingest processes (default)")
+    parser.add_argument("--host", default=HTTP_HOST, help="HTTP bind address")
+    parser.add_argument("--port", type=int, default=HTTP_PORT, help="HTTP port")
+    parser.add_argument("--workers", type=int, default=HTTP_WORKERS, help="HTTP worker processes")
+    parser.add_argument("--ingest-processes", type=int, default=INGEST_PROCESSES,
+                        help="TCP ingest processes sharing TCP_PORT")
+    parser.add_argument("--drain-timeout", type=float, default=DRAIN_TIMEOUT,
+                        help="Seconds in-flight requests and uploads get to finish on shutdown")
+    parser.add_argument("--index", type=int, default=0, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv) -> int:
+    args = parse_args(argv)
+    if args.mode == "ingest":
+        return run_ingest(args.index, args.ingest_processes)
+
+    env = dict(os.environ, TCP_DRAIN_TIMEOUT=str(args.drain_timeout))
+    children = [Child(f"http ({args.workers} workers)", http_command(args), dict(env, TCP_SERVER_ENABLED="false"))]
+    if args.mode == "all":
+        if args.ingest_processes > 1 and not hasattr(socket, "SO_REUSEPORT"):
+            print("serve: several ingest processes need SO_REUSEPORT, which this platform lacks")
+            return 2
+        ingest_env = dict(env, TCP_REUSE_PORT="true" if args.ingest_processes > 1 else "false")
+        children += [Child(f"ingest {index}", ingest_command(index, args.ingest_processes), ingest_env)
+                     for index in range(args.ingest_processes)]
+    if not os.getenv("CACHE_INVALIDATION_REDIS_URL") and (len(children) > 1 or args.workers > 1):
+        print("serve: CACHE_INVALIDATION_REDIS_URL is not set; cached entities may be stale in other processes "
+              "until their TTL expires, and dashboards only get exam events from the worker they are connected to "
+              "(none for TCP uploads)")
+    return supervise(children, args.drain_timeout)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
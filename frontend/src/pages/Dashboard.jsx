@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 // ImageInfoModal is no longer imported here
 import { 
   Activity, 
@@ -88,34 +88,17 @@ const Dashboard = ({ onNavigate, user, logout, onOpenModal }) => {
     return examDate > now && examDate <= in24Hours;
   };
 
-  const fetchPatientById = async (patientId) => {
-    try {
-      const response = await fetch(`http://localhost:8000/api/v1/patients/${patientId}`);
-      if (!response.ok) throw new Error(`Failed to fetch patient ${patientId}`);
-      const patientData = await response.json();
-      return {
-        id: patientData.id,
-        name: `${patientData.last_name}, ${patientData.first_name}`,
-        firstName: patientData.first_name,
-        lastName: patientData.last_name,
-        fullData: patientData
-      };
-    } catch (error) {
-      console.error(`Error fetching patient ${patientId}:`, error);
-      return { id: patientId, name: 'Unknown Patient', fullData: null };
-    }
-  };
-
-  const fetchPatientsForExams = async (exams) => {
-    const patientIds = [...new Set(exams.map(exam => exam.patient_id).filter(Boolean))];
-    if (patientIds.length === 0) return {};
-    const patientPromises = patientIds.map(id => fetchPatientById(id));
-    const patients = await Promise.allSettled(patientPromises);
-    const patientMap = {};
-    patients.forEach((result, index) => {
-      patientMap[patientIds[index]] = result.status === 'fulfilled' ? result.value : { id: patientIds[index], name: 'Unknown Patient', fullData: null };
-    });
-    return patientMap;
+  // Exams are fetched with expand=true, so the patient summary is embedded in each row
+  const patientFromExam = (exam) => {
+    const patient = exam.patient;
+    if (!patient) return null;
+    return {
+      id: patient.id,
+      name: `${patient.last_name}, ${patient.first_name}`,
+      firstName: patient.first_name,
+      lastName: patient.last_name,
+      fullData: patient
+    };
   };
 
   const calculateStatistics = (exams) => {
@@ -138,8 +121,8 @@ const Dashboard = ({ onNavigate, user, logout, onOpenModal }) => {
     return stats;
   };
 
-  const formatExamForDisplay = (exam, patientMap = {}) => {
-    const patient = patientMap[exam.patient_id];
+  const formatExamForDisplay = (exam) => {
+    const patient = patientFromExam(exam);
     return {
       id: formatExamId(exam.id, exam.created_at),
       patient: patient ? patient.name : (exam.patient_name || 'Unknown Patient'),
@@ -151,22 +134,28 @@ const Dashboard = ({ onNavigate, user, logout, onOpenModal }) => {
     };
   };
 
+  // Latest exam list, shared by the initial fetch and the live event stream
+  const examsRef = useRef([]);
+
+  const applyExams = (allExamsData) => {
+    examsRef.current = allExamsData;
+    setAllExams(allExamsData);
+    const todayString = new Date().toISOString().split('T')[0];
+    const todaysExams = allExamsData.filter(exam => (exam.scheduled_time || exam.exam_date || exam.created_at)?.split('T')[0] === todayString);
+    setTodayExams(todaysExams);
+    const examsToDisplay = (todaysExams.length > 0 ? todaysExams : allExamsData).slice(0, 4);
+    setDisplayExams(examsToDisplay.map(exam => formatExamForDisplay(exam)));
+    setStatistics(calculateStatistics(allExamsData));
+    setLastRefresh(new Date());
+  };
+
   const fetchExams = async () => {
     setIsLoading(true);
     setError(null);
     try {
-      const allExamsResponse = await fetch('http://localhost:8000/api/v1/exams/?limit=100');
+      const allExamsResponse = await fetch('http://localhost:8000/api/v1/exams/?limit=100&expand=true');
       if (!allExamsResponse.ok) throw new Error('Failed to fetch exams');
-      const allExamsData = await allExamsResponse.json();
-      setAllExams(allExamsData);
-      const todayString = new Date().toISOString().split('T')[0];
-      const todaysExams = allExamsData.filter(exam => (exam.scheduled_time || exam.exam_date || exam.created_at)?.split('T')[0] === todayString);
-      setTodayExams(todaysExams);
-      const examsToDisplay = (todaysExams.length > 0 ? todaysExams : allExamsData).slice(0, 4);
-      const patientMap = await fetchPatientsForExams(examsToDisplay);
-      setDisplayExams(examsToDisplay.map(exam => formatExamForDisplay(exam, patientMap)));
-      setStatistics(calculateStatistics(allExamsData));
-      setLastRefresh(new Date());
+      applyExams(await allExamsResponse.json());
     } catch (err) {
       console.error('Error fetching exams:', err);
       setError('Failed to load exam data. Please check the connection.');
@@ -176,10 +165,30 @@ const Dashboard = ({ onNavigate, user, logout, onOpenModal }) => {
     }
   };
 
+  // Deltas from the server; created exams embed their patient, updates keep the one already shown
+  const upsertExam = (exam) => {
+    const existing = examsRef.current.find(e => e.id === exam.id);
+    const merged = { ...existing, ...exam, patient: exam.patient || existing?.patient };
+    const others = examsRef.current.filter(e => e.id !== exam.id);
+    applyExams(existing ? examsRef.current.map(e => (e.id === exam.id ? merged : e)) : [merged, ...others]);
+  };
+
   useEffect(() => {
     fetchExams();
-    const interval = setInterval(fetchExams, 60000);
-    return () => clearInterval(interval);
+    const events = new EventSource('http://localhost:8000/api/v1/events/exams');
+    events.addEventListener('exam.created', (e) => upsertExam(JSON.parse(e.data)));
+    events.addEventListener('exam.updated', (e) => upsertExam(JSON.parse(e.data)));
+    events.addEventListener('exam.deleted', (e) => {
+      const { id } = JSON.parse(e.data);
+      applyExams(examsRef.current.filter(exam => exam.id !== id));
+    });
+    events.addEventListener('resync', fetchExams);
+    // Slow safety refresh in case the stream is blocked by a proxy
+    const interval = setInterval(fetchExams, 300000);
+    return () => {
+      events.close();
+      clearInterval(interval);
+    };
   }, []);
 
   // This now calls the prop passed down from main.jsx